@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Time physics.step() for the different engines at various object counts.
+
+Run with:
+
+  python3 benchmark.py
+  python3 benchmark.py --counts 100 1000 --engines cheesy
+  python3 benchmark.py --engines pymunk pymunk/autotune
+
+The vectorized engine loses to pymunk at the default counts, it takes a lot
+of bodies to make its fixed numpy overhead pay off. To see where it wins:
+
+  python3 benchmark.py --counts 50000 100000 --engines pymunk vectorized --steps 10
+
+This doesn't open a window: the objects are plain stand-ins with a pymunk
+body and shapes, which is all the physics engines look at.
+"""
+
+import argparse
+import math
+import random
+import sys
+import time
+import types
+
+import pymunk
+
+import commands
+import physics
+
+
+class Ball:
+  collides_with = ['Ball']
+  collision_type = 1
+  hits = 0
+
+  def __init__(self, x, y, radius):
+    mass = 1.0
+    self.body = pymunk.Body(mass, pymunk.moment_for_circle(mass, 0, radius))
+    self.body.position = (x, y)
+    self.body.velocity = (random.uniform(-100, 100), random.uniform(-100, 100))
+    self.shapes = {'body': pymunk.Circle(self.body, radius)}
+    self.shapes['body'].elasticity = 0.8
+    self.shapes['body'].collision_type = self.collision_type
+
+  def handle_collision_with(self, other):
+    Ball.hits += 1
+
+
+def build_world(engine_name, count, broadphase='grid', autotune=False, fps=120, radius=5, density=0.1):
+  """Make an engine holding `count` balls spread out so that about `density`
+  of the area is covered, no matter how many there are."""
+  config = types.SimpleNamespace(
+      gravity=0,
+      fps=fps,
+      broadphase=broadphase,
+      grid_cell_size=None,
+      autotune=autotune,
+      iterations=None,
+      collision_slop=None,
+      spatial_hash=None,
+      threads=None,
+      sleep_time=None,
+      idle_speed=None)
+  game = types.SimpleNamespace(config=config)
+  game.commands = commands.CommandBuffer(game)
+  engine = physics.IMPLEMENTATIONS[engine_name](game, {'Ball': Ball})
+
+  side = math.sqrt(count * math.pi * radius ** 2 / density)
+  for _ in range(count):
+    engine.add_object(Ball(random.uniform(0, side), random.uniform(0, side), radius))
+  return engine
+
+
+def time_steps(engine, steps, dt):
+  engine.step(dt)  # Warm up, lets lazy setup (like the cheesy grid) happen.
+  tuner = getattr(engine, 'tuner', None)
+  if tuner and tuner.autotune:
+    for _ in range(2 * tuner.interval):  # Give the autotuner a chance to settle
+      engine.step(dt)
+  start = time.perf_counter()
+  for _ in range(steps):
+    engine.step(dt)
+  return (time.perf_counter() - start) / steps
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--counts', type=int, nargs='+', default=[100, 1000, 10000])
+  parser.add_argument('--engines', nargs='+', default=['cheesy', 'cheesy/all-pairs', 'pymunk', 'vectorized'])
+  parser.add_argument('--steps', type=int, default=20)
+  parser.add_argument('--fps', type=int, default=120)
+  parser.add_argument(
+      '--max-all-pairs',
+      type=int,
+      default=1000,
+      help='Skip the all-pairs broadphase above this many objects, it takes forever')
+  args = parser.parse_args()
+
+  random.seed(1234)
+  budget = 1000 / args.fps
+  print(f'{"engine":<20} {"objects":>8} {"ms/step":>10} {"% of " + str(args.fps) + "Hz budget":>18}')
+  for engine_spec in args.engines:
+    engine_name, _, variant = engine_spec.partition('/')
+    for count in args.counts:
+      if variant == 'all-pairs' and count > args.max_all_pairs:
+        print(f'{engine_spec:<20} {count:>8} {"skipped":>10}')
+        continue
+      engine = build_world(
+          engine_name,
+          count,
+          broadphase='all-pairs' if variant == 'all-pairs' else 'grid',
+          autotune=variant == 'autotune',
+          fps=args.fps)
+      ms = time_steps(engine, args.steps, 1 / args.fps) * 1000
+      print(f'{engine_spec:<20} {count:>8} {ms:>10.2f} {100 * ms / budget:>17.0f}%')
+
+
+if __name__ == '__main__':
+  sys.exit(main() or 0)
@@ -0,0 +1,148 @@
+import numpy as np
+
+
+class Contact:
+  """What collision_<Dst>_<phase>(contact) handlers get: one contact between
+  `src` (an object of the class the handler lives on) and `dst`.
+
+  normal points from src to dst, impulse and total_ke are only filled in for
+  post_solve (zero before that), first_contact says if they weren't touching
+  last step. `arbiter` is the pymunk.Arbiter underneath, in case you need
+  more, but mind that its shapes may be in either order.
+  """
+
+  __slots__ = ('src', 'dst', 'game', 'arbiter', 'flipped')
+
+  def __init__(self, src, dst, game, arbiter, flipped=False):
+    self.src = src
+    self.dst = dst
+    self.game = game
+    self.arbiter = arbiter
+    self.flipped = flipped  # arbiter.shapes are (dst, src)
+
+  @property
+  def normal(self):
+    normal = self.arbiter.normal
+    return -normal if self.flipped else normal
+
+  @property
+  def impulse(self):
+    impulse = self.arbiter.total_impulse
+    return -impulse if self.flipped else impulse
+
+  @property
+  def total_ke(self):
+    return self.arbiter.total_ke
+
+  @property
+  def first_contact(self):
+    return self.arbiter.is_first_contact
+
+
+class ContactEvents:
+  """Every contact between two classes during one physics step, as arrays.
+
+  This is what `collision_<Dst>_batch(events, game)` handlers get, once per
+  step, instead of a Python call per contact. Row k is one contact:
+
+    src, dst       registry handles of the two objects (src is the class the
+                   handler lives on)
+    normal         unit normal pointing from src to dst
+    impulse        total impulse the solver applied
+    total_ke       energy lost to the collision
+    first_contact  True if they weren't touching last step
+
+  The arrays are preallocated and reused between steps, so don't hold on to
+  them past the handler call (copy them if you need to).
+  """
+
+  def __init__(self, registry, capacity=256):
+    self.registry = registry
+    self.count = 0
+    self._allocate(capacity)
+
+  def _allocate(self, capacity):
+    old_count = self.count
+    fields = {
+        '_src': ((capacity,), np.int64),
+        '_dst': ((capacity,), np.int64),
+        '_normal': ((capacity, 2), np.float64),
+        '_impulse': ((capacity, 2), np.float64),
+        '_total_ke': ((capacity,), np.float64),
+        '_first_contact': ((capacity,), bool),
+    }
+    for name, (shape, dtype) in fields.items():
+      new = np.zeros(shape, dtype=dtype)
+      old = getattr(self, name, None)
+      if old is not None:
+        new[:old_count] = old[:old_count]
+      setattr(self, name, new)
+    self.capacity = capacity
+
+  def __len__(self):
+    return self.count
+
+  def clear(self):
+    self.count = 0
+
+  def _reserve(self, extra):
+    needed = self.count + extra
+    if needed > self.capacity:
+      capacity = self.capacity
+      while capacity < needed:
+        capacity *= 2
+      self._allocate(capacity)
+
+  def append(self, src, dst, normal, impulse, total_ke, first_contact):
+    self._reserve(1)
+    k = self.count
+    self._src[k] = src
+    self._dst[k] = dst
+    self._normal[k] = normal
+    self._impulse[k] = impulse
+    self._total_ke[k] = total_ke
+    self._first_contact[k] = first_contact
+    self.count += 1
+
+  def extend(self, src, dst, normal, impulse, total_ke, first_contact):
+    """Like append() but every argument is an array, one row per contact."""
+    extra = len(src)
+    if not extra:
+      return
+    self._reserve(extra)
+    rows = slice(self.count, self.count + extra)
+    self._src[rows] = src
+    self._dst[rows] = dst
+    self._normal[rows] = normal
+    self._impulse[rows] = impulse
+    self._total_ke[rows] = total_ke
+    self._first_contact[rows] = first_contact
+    self.count += extra
+
+  @property
+  def src(self):
+    return self._src[:self.count]
+
+  @property
+  def dst(self):
+    return self._dst[:self.count]
+
+  @property
+  def normal(self):
+    return self._normal[:self.count]
+
+  @property
+  def impulse(self):
+    return self._impulse[:self.count]
+
+  @property
+  def total_ke(self):
+    return self._total_ke[:self.count]
+
+  @property
+  def first_contact(self):
+    return self._first_contact[:self.count]
+
+  def objects(self, handles):
+    """Turn an array of handles into objects (None for deleted ones)."""
+    return [self.registry.get(handle) for handle in handles.tolist()]
@@ -2,12 +2,13 @@
 import logging
 import math
 from random import random, randint
-import time
 
 import pyglet
 import pymunk
 
 from objects import GameObject
+import projectiles
+import regions
 import resources
 
 KEY = pyglet.window.key
@@ -22,15 +23,14 @@ class Asteroid(GameObject):
     self.circle_body(mass, radius)
 
   @staticmethod
-  def collision_Bullet_begin(arbiter, space, data):
-    asteroid_shape, bullet_shape = arbiter.shapes
-    game = data['game']
-
-    # This can fail because pymunk is silly.
-    try:
-      asteroid_obj = game.get_object_from_body(asteroid_shape.body)
-      bullet_obj = game.get_object_from_body(bullet_shape.body)
-    except KeyError:
+  def collision_Bullet_begin(contact):
+    game = contact.game
+    asteroid_obj = contact.src
+    bullet_obj = contact.dst
+
+    # Deletes only happen after the step, so another bullet (or another
+    # asteroid) may have gotten to one of us first this step.
+    if asteroid_obj.deleted or bullet_obj.deleted:
       return False
 
     radius = asteroid_obj.shapes['body'].radius
@@ -57,17 +57,10 @@ class Asteroid(GameObject):
  
 
 class Bullet(GameObject):
-  image = resources.bullet_image
+  # Bullets are projectiles (see projectiles.py), this class is just what
+  # they look like to the collision handlers, nothing makes instances of it.
   collides_with = ['Asteroid']
 
-  def create_body(self, mass=1.0, radius=4, lifespan=0.5, **unused):
-    self.expiration_time = time.time() + lifespan
-    self.circle_body(mass, radius)
-
-  def update(self, now, dt):
-    if now > self.expiration_time:
-      self.delete()
-
 
 class Player(GameObject):
   image = resources.player_image
@@ -92,7 +85,7 @@ class Player(GameObject):
     self.brake_damping = 0.03
     self.min_velocity = 50.0
     self.max_velocity = 600.0
-    self.last_fired = 0.0
+    self.last_fired = -self.bullet_delay  # Game time starts at 0, we can fire right away
 
     # Child sprite for the engine flame
     self.engine = pyglet.sprite.Sprite(resources.engine_image)
@@ -100,39 +93,52 @@ class Player(GameObject):
     self.engine.visible = False
     self.children.append(self.engine)
 
-  def update(self, now, dt):
+  def pre_step(self, dt):
+    # We're kinematic, so steer by setting velocities before the step and let
+    # the physics move us, that way we properly bump into things.
+    velocity = self.body.velocity
+    angular_velocity = 0.0
     if self.keys[KEY.LEFT]:
-      self.body.angle += self.rotate_speed * dt
+      angular_velocity = self.rotate_speed
 
     elif self.keys[KEY.RIGHT]:
-      self.body.angle -= self.rotate_speed * dt
+      angular_velocity = -self.rotate_speed
 
     elif self.keys[KEY.UP]:
-      self.engine.visible = True
       direction = pymunk.Vec2d(-math.cos(self.body.angle), -math.sin(self.body.angle))
-      self.body.velocity += direction * self.thrust * dt
+      velocity += direction * self.thrust * dt
 
     elif self.keys[KEY.DOWN]:
-      self.body.velocity *= 1 - self.brake_damping
-      if self.body.velocity.length < self.min_velocity:
-        self.body.velocity = pymunk.Vec2d(0, 0)
+      velocity *= 1 - self.brake_damping
+      if velocity.length < self.min_velocity:
+        velocity = pymunk.Vec2d(0, 0)
+
+    self.drive(velocity, angular_velocity)
 
-    if not self.keys[KEY.UP]:
-      self.engine.visible = False
+  def update(self, now, dt):
+    self.engine.visible = self.keys[KEY.UP] and not (self.keys[KEY.LEFT] or self.keys[KEY.RIGHT])
+    self.follow()
 
     if self.keys[KEY.SPACE]:
-      self.fire()
+      self.fire(now)
 
-    self.update_engine()
+    self.update_engine(now)
+
+  def follow(self):
+    """Keep the camera on us, without looking past the edges of the world."""
+    width, height = self.game.window.get_size()
+    left, bottom, right, top = self.game.world_bounds
+    x = min(max(self.x - width / 2, left), right - width)
+    y = min(max(self.y - height / 2, bottom), top - height)
+    self.game.camera = (x, y)
 
-  def update_engine(self):
+  def update_engine(self, now=0.0):
     self.engine.rotation = self.rotation
     self.engine.x = self.x
     self.engine.y = self.y
-    self.engine.scale = 1.0 + (math.sin(20 * time.time()) / 10)
+    self.engine.scale = 1.0 + (math.sin(20 * now) / 10)
 
-  def fire(self):
-    now = time.time()
+  def fire(self, now):
     if now - self.last_fired > self.bullet_delay:
       # Pyglet uses negative degrees
       angle_radians = -math.radians(self.rotation)
@@ -141,29 +147,16 @@ class Player(GameObject):
       ship_radius = self.image.width / 2
       bullet_x = self.x + math.cos(angle_radians) * ship_radius
       bullet_y = self.y + math.sin(angle_radians) * ship_radius
-      new_bullet = Bullet(x=bullet_x, y=bullet_y)
 
       # Give it some speed
       direction = pymunk.Vec2d(-math.cos(self.body.angle), -math.sin(self.body.angle))
-      new_bullet.body.velocity = direction * self.bullet_speed
-
-      self.game.add_object(new_bullet)
+      self.game.bullets.fire((bullet_x, bullet_y), direction * self.bullet_speed, lifespan=0.5)
       self.last_fired = now
 
   @staticmethod
-  def collision_Asteroid_separate(arbiter, space, data):
+  def collision_Asteroid_separate(contact):
     logging.info('Player collided with Asteroid')
-    # I have no idea why this is (dst, src) despite everything else begin (src, dst). But it consistently is...
-    asteroid_shape, player_shape = arbiter.shapes
-    game = data['game']
-
-    # This can fail because pymunk is silly.
-    try:
-      asteroid_obj = game.get_object_from_body(asteroid_shape.body)
-      player_obj = game.get_object_from_body(player_shape.body)
-    except KeyError:
-      logging.warning(f'Failed to lookup player,asteroid objects from shapes={arbiter.shapes}')
-      return False
+    player_obj = contact.src
 
     logging.info('Deleting player object')
     player_obj.delete()
@@ -171,7 +164,6 @@ class Player(GameObject):
 
 
 def configure(config):
-  config.physics = 'pymunk'
   config.gravity = 0
   config.fps = 120
   config.fullscreen = True
@@ -181,37 +173,39 @@ def configure(config):
 
 
 def init(game):
+  # The world is --world-screens screens across and up, and the camera
+  # follows the player around it.
+  width, height = game.window.get_size()
+  screens = game.config.world_screens
   min_x, min_y = 0, 0
-  max_x, max_y = game.window.get_size()
-
-  def wrap_around(body):
-    new_x, new_y = body.position
-    if new_x > max_x:
-      new_x = min_x
-    elif new_x < min_x:
-      new_x = max_x
-    if new_y > max_y:
-      new_y = min_y
-    elif new_y < min_y:
-      new_y = max_y
-
-    if body.position != (new_x, new_y):
-      body.position = (new_x, new_y)
-      return True
-
-  def wrap_objects():
-    for body in game.physics.space.bodies:
-      if wrap_around(body):
-        game.physics.space.reindex_shapes_for_body(body)
+  max_x, max_y = width * screens, height * screens
+  game.world_bounds = (min_x, min_y, max_x, max_y)
+
+  # The physics engine does the wrapping, ghosts let asteroids bump into
+  # each other across the edges too.
+  game.physics.set_wrap((min_x, min_y, max_x, max_y), ghosts=True)
+
+  # Past a screen or so from the camera, asteroids get packed away and
+  # only drift, so bigger worlds don't cost (much) more per frame.
+  game.regions = None
+  if screens > 1 and game.config.regions:
+    def focus():
+      camera_x, camera_y = game.camera
+      return (camera_x + width / 2, camera_y + height / 2)
+    game.regions = regions.RegionSystem(game, [Asteroid], region_size=(width / 2, height / 2), focus=focus)
+    game.systems.append(game.regions)
 
   # Damping makes interactions settle down nicely but also causes our asteroids to just "stop" at some point.
   #game.physics.space.damping = 0.8
-  game.post_physics_step = wrap_objects
+
+  game.bullets = projectiles.ProjectileSystem(game, Bullet)
+  game.systems.append(game.bullets)
 
   player = Player(x=max_x / 2, y=max_y / 2)
   game.add_object(player)
+  player.follow()
 
-  num_asteroids = 100
+  num_asteroids = 100 * screens * screens
   for i in range(num_asteroids):
     asteroid = Asteroid(x=randint(0, max_x), y=randint(0, max_y), scale=1.0)
     game.add_object(asteroid)
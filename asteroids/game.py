@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import math
 import importlib
 import logging
@@ -7,14 +8,56 @@ import sys
 import time
 
 import pyglet
+if '--headless' in sys.argv:
+  # Has to be decided before anything imports pyglet.gl, which connects to
+  # the display. Headless pyglet still has a GL context for loading images,
+  # it just doesn't need a display for it.
+  pyglet.options['headless'] = True
+  pyglet.options['audio'] = ('silent',)
+from pyglet import gl
 import pymunk
 
 from objects import GameObject
+import clock
+import commands
+import hooks
+import pacer
 import physics
 import resources
 import settings
 
 
+def overriding_classes(classes, method_name):
+  """The GameObject classes that override method_name, minus subclasses of
+  ones that are already in there."""
+  default = getattr(GameObject, method_name)
+  overriding = [cls for cls in classes if getattr(cls, method_name) is not default]
+  return [
+      cls for cls in overriding
+      if not any(other is not cls and issubclass(cls, other) for other in overriding)]
+
+
+class HeadlessWindow:
+  """Stands in for the window with --headless. It has a size, and game
+  modules can set event handlers on it, but no events ever come."""
+
+  def __init__(self, width, height):
+    self.width = width
+    self.height = height
+
+  def get_size(self):
+    return self.width, self.height
+
+  def push_handlers(self, *handlers):
+    pass
+
+  def set_mouse_visible(self, visible=True):
+    pass
+
+  def clear(self):
+    pass
+
+
 class Game:
   def __init__(self, config):
     self.config = config
@@ -22,6 +65,8 @@ class Game:
     # Load our game module, let it customize the config
     self.module = importlib.import_module(config.module_name)
     self.module.configure(config)
+    if config.physics_fps:
+      config.fps = config.physics_fps  # The command line beats the module
 
     game_object_classes = {}
     for obj in vars(self.module).values():
@@ -31,18 +76,31 @@ class Game:
       except TypeError:
         continue
 
+    # Only objects that actually do something in update()/pre_step() get them
+    # called. Subclasses come along with their parent class' registry view.
+    self.updating_classes = overriding_classes(game_object_classes.values(), 'update')
+    self.pre_step_classes = overriding_classes(game_object_classes.values(), 'pre_step')
+
     self.object_by_body = {}
+    self.commands = commands.CommandBuffer(self)
     physics_class = physics.IMPLEMENTATIONS[config.physics]
     self.physics = physics_class(self, game_object_classes)
+    if config.profile_collisions:
+      self.physics.profile_collisions(True)
 
-    self.window = pyglet.window.Window(
-        fullscreen=config.fullscreen,
-        width=config.window_width,
-        height=config.window_height,
-        vsync=config.vsync)
-
-    self.fps_display = pyglet.window.FPSDisplay(window=self.window)
+    if config.headless:
+      self.window = HeadlessWindow(*config.headless_size)
+      self.fps_display = None
+    else:
+      self.window = pyglet.window.Window(
+          fullscreen=config.fullscreen,
+          width=config.window_width,
+          height=config.window_height,
+          vsync=config.vsync)
+      self.fps_display = pyglet.window.FPSDisplay(window=self.window)
+    self.bg_batch = pyglet.graphics.Batch()
     self.main_batch = pyglet.graphics.Batch()
+    self.hud_batch = pyglet.graphics.Batch()
     self.keys = pyglet.window.key.KeyStateHandler()
     self.window.push_handlers(self, self.keys)
     self.player = pyglet.media.Player()
@@ -51,27 +109,132 @@ class Game:
     # up our simulation gracefully.
     self.uncomputed_time = 0.0
 
+    # Simulation time, for anything that needs to know what time it is. See
+    # clock.SimulationClock, and F5-F7 in on_key_press().
+    self.clock = clock.SimulationClock(config.time_scale)
+
+    # Game code to run every step, every frame, every so often or when
+    # there's time to spare, see hooks.HookScheduler.
+    self.hooks = hooks.HookScheduler(self)
+
+    # Overload protection, see steps_owed(). The counters are for anyone
+    # who wants to know how far behind we've been.
+    self.overloaded_frames = 0  # Frames that owed more than config.max_steps
+    self.skipped_time = 0.0  # Seconds of owed simulation thrown away
+    self.slowed_time = 0.0  # Seconds of real time the 'slow' policy didn't simulate
+    self.load_scale = 1.0  # How fast the 'slow' policy is running things
+
+    # World position of the window's bottom left corner. The HUD stays put.
+    self.camera = (0.0, 0.0)
+
+    # Pipelined mode: the physics steps owed after an update() run on a
+    # background thread during the next on_draw(), see draw_pipelined().
+    self.pipeline = None
+    if config.pipeline:
+      self.pipeline = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='physics')
+    self.due_steps = 0
+
+    # Interpolation: with a --render-fps, sprites get drawn part way between
+    # where bodies were before the last physics step and where they are now,
+    # so physics can run slower than the screen and still look smooth.
+    self.interpolating = bool(config.render_fps) and not config.headless
+    if self.interpolating and self.pipeline is not None:
+      logging.warning('Pipelined mode doesn\'t interpolate, sprites will only move on physics steps')
+      self.interpolating = False
+    self.body_transforms = {}  # obj -> (x, y, angle) as of the last sync
+    self.tweens = {}  # obj -> (previous, current) transforms to draw between
+
+    # Things that step along with the physics, like projectiles.ProjectileSystem.
+    # Each one needs step(dt), called after every physics step, and ones that
+    # draw something can have a sync(), called once per frame.
+    self.systems = []
+
+    # Collision profiler table, see on_key_press()
+    self.profile_label = pyglet.text.Label(
+        '',
+        font_name='Courier New',
+        font_size=10,
+        x=10,
+        y=self.window.height - 10,
+        anchor_y='top',
+        width=self.window.width - 20,
+        multiline=True,
+        batch=self.hud_batch)
+    self.profile_label_age = 0.0
+
+    # Overload counters, only shown once something's been dropped or slowed.
+    self.overload_label = pyglet.text.Label(
+        '',
+        font_name='Courier New',
+        font_size=10,
+        x=self.window.width - 10,
+        y=10,
+        anchor_x='right',
+        batch=self.hud_batch)
+    self.overload_label_counts = None
+
+    # Frame pacing, see run(). The label shows how steady it is.
+    self.pacer = pacer.FramePacer(1 / (config.render_fps or config.fps), synced=config.vsync)
+    self.pacer_label = pyglet.text.Label(
+        '',
+        font_name='Courier New',
+        font_size=10,
+        x=self.window.width - 10,
+        y=28,
+        anchor_x='right',
+        batch=self.hud_batch)
+    self.pacer_label_age = 0.0
+
     self.module.init(self)
 
-  def add_object(self, obj):
+  def add_object(self, obj, background=False):
     """Add an object to the game. The object must by a pyglet Sprite that has
     a pymunk .body and .shapes. Maybe something also about collision mask???
+
+    During a physics step this gets queued up and happens after the step.
     """
+    obj.deleted = False
+    if self.commands.deferring:
+      self.commands.spawn(obj, background=background)
+      return
+    self._add_object(obj, background=background)
+
+  def _add_object(self, obj, background=False):
     #logging.debug(f'Game.add_object() obj={obj}')
     self.object_by_body[obj.body] = obj
     obj.game = self
-    obj.batch = self.main_batch
+    obj.batch = self.bg_batch if background else self.main_batch
     obj.keys = self.keys
-    self.physics.add_object(obj)
+    if not background:
+      self.physics.add_object(obj)
 
     # Don't forget to draw the child sprites
     for child in obj.children:
       child.batch = self.main_batch
 
   def remove_object(self, obj):
+    """Remove an object from the game. Deleting something twice is fine,
+    and during a physics step this gets queued up like add_object()."""
+    if obj.deleted:
+      logging.debug(f'Game.remove_object() obj={obj} already deleted')
+      return
+    obj.deleted = True
+    if self.commands.deferring:
+      self.commands.delete(obj)
+      return
+    self._remove_object(obj)
+
+  def _remove_object(self, obj):
     logging.debug(f'Game.remove_object() obj={obj}')
     self.physics.remove_object(obj)
     del self.object_by_body[obj.body]
+    self.body_transforms.pop(obj, None)
+    self.tweens.pop(obj, None)
+    # GameObject.delete() is remove_object(), the sprite's own delete() is
+    # what takes it out of the batch.
+    pyglet.sprite.Sprite.delete(obj)
+    for child in obj.children:
+      child.delete()
 
   def get_object_from_body(self, body):
     return self.object_by_body[body]
@@ -83,44 +246,333 @@ class Game:
     self.player.play()
 
   def run(self):
-    seconds_per_frame = 1 / self.config.fps  # delay between game updates
-    pyglet.clock.schedule_interval(self.update, seconds_per_frame)
-    pyglet.app.run()
+    if self.config.headless:
+      return self.run_headless()
+
+    # Our own main loop rather than pyglet.app.run(), so frames go out on
+    # time and always in the same order: events, update, draw, flip, then
+    # wait for the next one (see pacer.FramePacer).
+    window = self.window
+    while not window.has_exit:
+      dt = self.pacer.wait()
+      pyglet.clock.tick()  # pyglet's own scheduled stuff, like media players
+      window.dispatch_events()
+      if window.has_exit:
+        break
+      self.update(dt)
+      window.switch_to()
+      window.dispatch_event('on_draw')
+      window.flip()
+      self.hooks.run_idle(self.pacer.time_left())
+    window.close()
+
+  def run_headless(self):
+    """--headless: update() back to back with no waiting and no drawing,
+    one physics step each (more with a --time-scale over 1), for
+    config.steps steps (or until Ctrl-C if that's 0). Logs how many steps a
+    second we manage."""
+    physics_dt = 1 / self.config.fps
+    steps = self.config.steps
+    logging.info(f'Running headless, {steps or "unlimited"} steps of {physics_dt * 1000:.2f}ms')
+    first_step, start_time = self.clock.steps, self.clock.time
+    start = last_report = time.perf_counter()
+    try:
+      while not steps or self.clock.steps - first_step < steps:
+        self.update(physics_dt)
+        self.hooks.run_idle(0.0)  # Never any time to spare, only overdue ones run
+        now = time.perf_counter()
+        if now - last_report >= 5.0:
+          done = self.clock.steps - first_step
+          logging.info(f'{done} steps, {done / (now - start):.0f} steps/s')
+          last_report = now
+    except KeyboardInterrupt:
+      pass
+    elapsed = time.perf_counter() - start
+    done = self.clock.steps - first_step
+    game_time = self.clock.time - start_time
+    rate = done / elapsed if elapsed else 0.0
+    logging.info(
+        f'{done} steps ({game_time:.1f}s of game time) in {elapsed:.1f}s: '
+        f'{rate:.0f} steps/s, {game_time / elapsed if elapsed else 0.0:.1f}x real time, {len(self.physics.objects)} objects')
+    return rate
 
   def update(self, dt):
     #logging.debug(f'Game.update: dt={int(dt * 1000)}ms')
-    now = time.time()
-    self.uncomputed_time += dt
+    real_dt = dt
+    dt = self.clock.scaled(dt)  # How much of that to simulate, none while paused
 
     # To keep the physics behavior nice and stable we should *always* pass the
     # same dt value to physics.step(). But because this function gets called
     # with various delays we have to track uncomputed time explicitly.
     physics_dt = 1 / self.config.fps
-    while self.uncomputed_time > physics_dt:
-      #logging.debug('physics step')
-      self.physics.step(physics_dt)
-      self.uncomputed_time -= physics_dt
-      self.post_physics_step()
+    steps = self.steps_owed(dt, physics_dt)
+    if self.pipeline is not None:
+      # Steps on_draw() didn't get to (no redraw last time round) run now,
+      # the ones we owe for this frame get done while it draws.
+      for _ in range(self.due_steps):
+        self.physics_step(physics_dt)
+        self.post_physics_step()
+        self.hooks.run_step()
+      self.due_steps = steps
+    else:
+      for step in range(steps):
+        if self.interpolating and step == steps - 1:
+          # Where things are right before the last step is where drawing
+          # interpolates from.
+          self.sync_sprites(self.physics.sync_bodies())
+        self.physics_step(physics_dt)
+        self.post_physics_step()
+        self.hooks.run_step()
 
-    # Update sprite positions/angles from physics shapes
-    for obj in self.physics.objects:
-      #logging.debug(f'updating obj {obj}: body.angle={obj.body.angle} pos.x={obj.body.position.x} pos.y={obj.body.position.y}')
-      obj.rotation = math.degrees(-obj.body.angle) + 180
-      obj.position = obj.body.position
-      obj.update(now, dt)
-      #if obj.body.body_type == pymunk.Body.KINEMATIC:  #XXX
-      #  self.physics.space.reindex_shapes_for_body(obj.body)
+    # Update sprite positions/angles from physics shapes. Anything objects
+    # spawn or delete in update() happens once everybody has had their turn.
+    # Only bodies that moved, static and sleeping ones keep their sprites.
+    if self.config.headless:
+      self.physics.sync_bodies()  # Game code still wants to see bodies move
+    elif self.interpolating:
+      self.sync_sprites(self.physics.sync_bodies(), stepped=steps > 0)
+      self.tween_sprites(min(self.uncomputed_time / physics_dt, 1.0))
+    else:
+      for obj in self.physics.sync_bodies():
+        body = obj.body
+        x, y = body.position
+        self.place_sprite(obj, x, y, body.angle)
+    if not self.config.headless:
+      for system in self.systems:
+        sync = getattr(system, 'sync', None)
+        if sync is not None:
+          sync()
+    now = self.clock.time
+    with self.commands.deferred():
+      for cls in self.updating_classes:
+        for obj in self.physics.registry.view(cls):
+          obj.update(now, dt)
+    self.hooks.run('frame')
 
     # detect game win / loss conditions
     # update hud
+    self.update_profile_label(real_dt)
+    self.update_overload_label()
+    self.update_pacer_label(real_dt)
+
+  def steps_owed(self, dt, physics_dt):
+    """How many physics steps to run for dt more seconds of simulation time.
+
+    Never more than config.max_steps, or a slow frame (GC pause, window
+    drag) makes the next one slower still until we never catch up again.
+    What happens to the time we don't get to is up to config.overload:
+      drop: forget about it, the simulation just pauses for a moment.
+      slow: run the simulation slower than real time while we can't keep
+        up, and speed back up gradually once we can.
+      spread: keep owing it and catch up over the next frames, as long as
+        it's less than a second behind.
+    """
+    max_steps = self.config.max_steps
+    policy = self.config.overload
+    if policy == 'slow':
+      self.slowed_time += dt * (1 - self.load_scale)
+      dt *= self.load_scale
+    self.uncomputed_time += dt
+
+    steps = int(self.uncomputed_time / physics_dt)
+    if not max_steps or steps <= max_steps:
+      if policy == 'slow' and steps < max_steps:
+        self.load_scale = min(self.load_scale + 0.02, 1.0)
+      self.uncomputed_time -= steps * physics_dt
+      return steps
+
+    self.overloaded_frames += 1
+    self.uncomputed_time -= max_steps * physics_dt
+    if policy == 'spread':
+      backlog = 1.0
+    else:
+      backlog = physics_dt  # Keep the part of a step we'd have kept anyway
+      if policy == 'slow':
+        self.load_scale = max(self.load_scale * 0.8, 0.1)
+    if self.uncomputed_time > backlog:
+      skipped = (self.uncomputed_time - backlog) // physics_dt * physics_dt
+      self.skipped_time += skipped
+      self.uncomputed_time -= skipped
+    return max_steps
+
+  def sync_sprites(self, moved, stepped=False):
+    """Interpolated version of updating sprites from bodies.
+
+    moved is what physics.sync_bodies() says moved. If a physics step just
+    happened (stepped), everything it moved gets tweened between where it
+    was before and where it is now until the next step, see tween_sprites().
+    Anything else that moved (game code moving bodies by hand) just goes
+    there."""
+    transforms = self.body_transforms
+    tweens = {} if stepped else self.tweens
+    for obj in moved:
+      body = obj.body
+      x, y = body.position
+      current = (x, y, body.angle)
+      previous = transforms.get(obj, current)
+      transforms[obj] = current
+      if stepped and not self.wrapped_between(previous, current):
+        tweens[obj] = (previous, current)
+      else:
+        tweens.pop(obj, None)
+        self.place_sprite(obj, *current)
+    if stepped:
+      # Whatever the last step didn't move is done tweening.
+      for obj, (_, current) in self.tweens.items():
+        if obj not in tweens:
+          self.place_sprite(obj, *current)
+      self.tweens = tweens
+
+  def tween_sprites(self, alpha):
+    """Put tweening sprites alpha of the way from where their body was
+    before the last step to where it is now. Drawing is a step behind the
+    physics that way, but smooth."""
+    for obj, ((x0, y0, angle0), (x1, y1, angle1)) in self.tweens.items():
+      self.place_sprite(obj, x0 + (x1 - x0) * alpha, y0 + (y1 - y0) * alpha, angle0 + (angle1 - angle0) * alpha)
+
+  def wrapped_between(self, previous, current):
+    """Did a body wrap around the world between two transforms? Those
+    shouldn't get drawn sliding across the whole screen."""
+    bounds = self.physics.wrap_bounds
+    if not bounds:
+      return False
+    left, bottom, right, top = bounds
+    return (abs(current[0] - previous[0]) > (right - left) / 2
+            or abs(current[1] - previous[1]) > (top - bottom) / 2)
+
+  def place_sprite(self, obj, x, y, angle):
+    # One go instead of setting .position and .rotation, which would work out
+    # the sprite's vertices twice. GameObject.update() is something else.
+    pyglet.sprite.Sprite.update(obj, x=x, y=y, rotation=math.degrees(-angle) + 180)
+
+  def physics_step(self, physics_dt):
+    #logging.debug('physics step')
+    with self.commands.deferred():
+      # Kinematic things say where they're going first, so the step moves
+      # them along with everything else and collision handlers see it.
+      for cls in self.pre_step_classes:
+        for obj in self.physics.registry.view(cls):
+          obj.pre_step(physics_dt)
+      self.physics.pre_step(physics_dt)
+      self.physics.step(physics_dt)
+      for system in self.systems:
+        system.step(physics_dt)
+    self.clock.advance(physics_dt)
+
+  def physics_steps(self, physics_dt, steps):
+    for _ in range(steps):
+      self.physics_step(physics_dt)
+
+  def update_profile_label(self, dt):
+    if not self.physics.profiler.enabled:
+      self.profile_label.text = ''
+      return
+    # Twice a second is plenty, relaying out the label isn't free.
+    self.profile_label_age += dt
+    if self.profile_label.text and self.profile_label_age < 0.5:
+      return
+    self.profile_label_age = 0.0
+    text = self.physics.profiler.table()
+    if any(self.hooks.hooks.values()):
+      text += '\n\n' + self.hooks.table()
+    self.profile_label.text = text
+
+  def update_overload_label(self):
+    counts = (self.overloaded_frames, round(self.skipped_time, 1), round(self.slowed_time, 1), round(self.load_scale, 2))
+    if counts == self.overload_label_counts:
+      return
+    self.overload_label_counts = counts
+    frames, skipped, slowed, scale = counts
+    if not frames:
+      self.overload_label.text = ''
+      return
+    text = f'overloaded {frames} frames, skipped {skipped:.1f}s'
+    if self.config.overload == 'slow':
+      text += f', slowed {slowed:.1f}s, speed {scale:.2f}x'
+    self.overload_label.text = text
+
+  def update_pacer_label(self, dt):
+    self.pacer_label_age += dt
+    if self.pacer_label_age < 0.5:
+      return
+    self.pacer_label_age = 0.0
+    stats = self.pacer.stats()
+    if stats is None:
+      return
+    self.pacer_label.text = (
+        f'frame p50 {stats["p50"]:.1f} p95 {stats["p95"]:.1f} p99 {stats["p99"]:.1f}ms, '
+        f'jitter p99 {stats["jitter_p99"]:.2f}ms, {stats["late_frames"]} late')
+
+  def on_key_press(self, symbol, modifiers):
+    """Engine hotkeys. Anything else is left for the game module."""
+    KEY = pyglet.window.key
+    if symbol == KEY.F3:
+      profiler = self.physics.profiler
+      self.physics.profile_collisions(not profiler.enabled)
+      logging.info(f'Collision profiler {"on" if profiler.enabled else "off"}')
+      return pyglet.event.EVENT_HANDLED
+    if symbol == KEY.F4:
+      self.physics.profiler.dump(self.config.profile_file)
+      logging.info(f'Collision profile saved to {self.config.profile_file}')
+      return pyglet.event.EVENT_HANDLED
+    if symbol in (KEY.F5, KEY.F6, KEY.F7):
+      if symbol == KEY.F5:
+        self.clock.toggle_pause()
+      elif symbol == KEY.F6:
+        self.clock.scale /= 2
+      else:
+        self.clock.scale *= 2
+      logging.info(f'Simulation {"paused" if self.clock.paused else "running"} at {self.clock.scale:g}x')
+      return pyglet.event.EVENT_HANDLED
 
   def post_physics_step(self):
-    """Override this to do whatever you want."""
+    """Override this to do whatever you want. Runs after every physics step,
+    see self.hooks for things that don't need to. With --pipeline the calls
+    for a frame's steps all come after the last one, see draw_pipelined()."""
 
   def on_draw(self):
+    if self.pipeline is not None and self.due_steps:
+      self.draw_pipelined()
+    else:
+      self.draw()
+
+  def draw_pipelined(self):
+    """Draw this frame while the physics steps owed since update() run on
+    the pipeline thread. The sprites were synced before, so what gets drawn
+    is the state as of then, and pymunk lets go of the GIL while it steps,
+    so the two really do overlap.
+
+    Spawns and deletes from the steps (collision handlers, and game code
+    run from them) touch the batches, and anything else they queue with
+    commands.call() (sounds, say) wants this thread too, so it all waits
+    until both are done.
+
+    So do post_physics_step() and the step and interval hooks. They're game
+    code and free to touch pyglet, so they can't run on the pipeline thread
+    between the steps. Instead they get called once per step afterwards,
+    and all of those calls see the world and self.clock as of the last
+    step. Anything that needs to see each step's state, run without
+    --pipeline."""
+    steps, self.due_steps = self.due_steps, 0
+    with self.commands.held():
+      in_flight = self.pipeline.submit(self.physics_steps, 1 / self.config.fps, steps)
+      try:
+        self.draw()
+      finally:
+        in_flight.result()
+    for _ in range(steps):
+      self.post_physics_step()
+      self.hooks.run_step()
+
+  def draw(self):
     #logging.debug('Game.on_draw')
     self.window.clear()
+    gl.glPushMatrix()
+    gl.glTranslatef(-self.camera[0], -self.camera[1], 0)
+    self.bg_batch.draw()
     self.main_batch.draw()
+    gl.glPopMatrix()
+    self.hud_batch.draw()
     self.fps_display.draw()
 
 
@@ -138,7 +590,11 @@ def main():
       datefmt="%m%d %H:%M:%S",
       level=logging.DEBUG if config.debug else logging.INFO)
 
-  game = Game(config)
+  try:
+    game = Game(config)
+  except settings.ConfigError as error:
+    print(error)  # The module didn't like something in it
+    return 1
   game.run()
 
 if __name__ == '__main__':
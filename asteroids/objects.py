@@ -3,27 +3,13 @@ import pymunk
 import logging
 
 
-class CollisionTyped(type):
-  """This metaclass for GameObject lets us allocate a unique collision ID to
-  each GameObject subclass."""
-  __map = {}
-
-  def __new__(cls, name, bases, dct):
-    new = super().__new__(cls, name, bases, dct)
-
-    if name != 'GameObject':
-      new.collision_type = 2 ** len(CollisionTyped.__map)
-      print(f'AWESOME NEW POWER OF 2: {name} class collision_type={new.collision_type}')
-      assert new.collision_type not in CollisionTyped.__map
-      CollisionTyped.__map[new.collision_type] = new
-
-    return new
-
-
-class GameObject(pyglet.sprite.Sprite, metaclass=CollisionTyped):
+class GameObject(pyglet.sprite.Sprite):
   # pyglet resource
   image = None
 
+  # Handed out per Game to the classes it uses, see categories.CategoryRegistry
+  collision_type = 0
+
   # Names of all the GameObject subclasses we can collide with
   collides_with = []
 
@@ -80,6 +66,27 @@ class GameObject(pyglet.sprite.Sprite, metaclass=CollisionTyped):
   def update(self, now, dt):
     pass
 
+  def pre_step(self, dt):
+    """Called right before every physics step. Kinematic objects should
+    decide where they're going here, with move_to(), drive() or teleport()."""
+
+  def move_to(self, position, angle=None):
+    """Sweep to position (and angle) during the next physics step, pushing
+    things out of the way, then stop."""
+    self.game.physics.move_to(self, position, angle)
+
+  def drive(self, velocity, angular_velocity=None):
+    """Keep moving at velocity (and spinning at angular_velocity)."""
+    self.game.physics.drive(self, velocity, angular_velocity)
+
+  def teleport(self, position, angle=None):
+    """Jump to position (and angle) without hitting anything on the way."""
+    self.game.physics.teleport(self, position, angle)
+
+  def handle_collision_with(self, other):
+    """Called by CheesyPhysics when we overlap with another object that we
+    collide with. Override this to do something about it."""
+
   def delete(self):
     logging.debug(f'GameObject.delete() self={self}')
     self.game.remove_object(self)
@@ -1,121 +1,2126 @@
 #!/usr/bin/env python3
 
+import atexit
+import collections
+import itertools
 import logging
+import math
+import multiprocessing
+import queue
+
+import numpy as np
 import pymunk
+try:
+  import pymunk.batch
+except ImportError:  # pymunk < 6.6
+  pass
+
+import categories
+import contacts
+import profiler
+import registry
+import spatial
+import tuner
+import worker
 
 
 ALL_MASKS = pymunk.ShapeFilter.ALL_MASKS
 
 
+# What the raycast queries return: the object, where the ray hit it, the
+# surface normal there, and how far along the ray (0 = start, 1 = end).
+RayHit = collections.namedtuple('RayHit', ['obj', 'point', 'normal', 'alpha'])
+
+
 class PhysicsEngineBase:
   """Base Class for physics engine implementations."""
 
   def __init__(self, game, object_classes):
     self.game = game
-    self.objects = []
+    self.registry = registry.ObjectRegistry(object_classes.values())
     self.object_classes = object_classes
+    self.class_ids = {cls: i for i, cls in enumerate(object_classes.values())}
+    # Who collides with who, and the collision types/filters that says so.
+    self.categories = categories.CategoryRegistry(object_classes.values())
+    self.profiler = profiler.CollisionProfiler()
+    self.wrap_bounds = None
+    self.wrap_ghosts = False
+    self.largest_radius = {}  # cls -> biggest bounding radius added so far, see partner_reach()
+    self.synced_bodies = {}  # obj -> (x, y, angle) its sprite last got, see sync_bodies()
+
+    # Kinematic bodies waiting for the next pre_step(), see move_to() and friends
+    self.kinematic_targets = {}  # obj -> (position, angle or None)
+    self.arriving = set()  # Objects that move_to()'d last step
+    self.teleported = set()  # Objects whose shapes need reindexing
+
+    self.frozen = {}  # obj -> (mass, moment) it had before freeze()
+
+    # Opt-in batched collision events: a collision_<Dst>_batch(events, game)
+    # method gets every contact with Dst from the whole step in one call,
+    # instead of a Python call per contact. See contacts.ContactEvents.
+    self.contact_handlers = []  # (src class, dst class, method, events)
+    for src_class in object_classes.values():
+      for dst_class in self.categories.partners[src_class]:
+        method = getattr(src_class, f'collision_{dst_class.__name__}_batch', None)
+        if method:
+          logging.info(f'Batched collision handler for {src_class.__name__} to {dst_class.__name__}')
+          self.contact_handlers.append(
+              (src_class, dst_class, method, contacts.ContactEvents(self.registry)))
+
     self.init()
 
   def init(self):
     """Subclass-specific initialization"""
 
+  @property
+  def objects(self):
+    """Dense list of every object, see registry.ObjectRegistry for the rules."""
+    return self.registry.objects
+
   def add_object(self, obj):
-    if obj in self.objects:
+    if obj in self.registry:
       raise Exception(f'Object {obj} already added')
 
-    self.objects.append(obj)
+    self.registry.add(obj)
+    # So handlers and queries get from a shape to its object without lookups
+    obj.body.game_object = obj
+    for shape in obj.shapes.values():
+      shape.game_object = obj
+
+    cls = type(obj)
+    radius = max(bounding_radius(shape) for shape in obj.shapes.values())
+    if radius > self.largest_radius.get(cls, 0.0):
+      self.largest_radius[cls] = radius
 
   def remove_object(self, obj):
-    if obj not in self.objects:
+    if obj not in self.registry:
       raise Exception(f'Object {obj} does not exist in the physics!')
 
-    self.objects.remove(obj)
+    self.registry.remove(obj)
+    self.synced_bodies.pop(obj, None)
+    self.kinematic_targets.pop(obj, None)
+    self.arriving.discard(obj)
+    self.teleported.discard(obj)
+    self.frozen.pop(obj, None)
 
   def step(self, dt):
     """Compute physics changes elapsed during 'dt' seconds."""
     raise NotImplementedError()
 
+  def sync_bodies(self):
+    """Called once per frame before sprites get updated from obj.body.
+
+    Engines that keep their state somewhere other than the pymunk bodies
+    should copy it into them here.
+
+    Returns the objects whose body moved or turned since the last call, Game
+    only updates their sprites. Static and sleeping bodies don't show up."""
+    moved = []
+    synced = self.synced_bodies
+    for obj in self.objects:
+      body = obj.body
+      x, y = body.position
+      state = (x, y, body.angle)
+      if synced.get(obj) != state:
+        synced[obj] = state
+        moved.append(obj)
+    return moved
+
+  def touch(self, obj):
+    """Let the engine know game code changed obj.body (e.g. applied an
+    impulse), for engines that keep their own copy of body state."""
+
+  # Kinematic bodies. Moving them by setting body.position after a step means
+  # they jump through things without the collision handlers noticing, so
+  # instead game code says where they should go (ideally from
+  # GameObject.pre_step()) and pre_step() sets that up right before the next
+  # step.
+
+  def drive(self, obj, velocity, angular_velocity=None):
+    """Keep obj moving at velocity (and spinning at angular_velocity) until
+    told otherwise."""
+    self.kinematic_targets.pop(obj, None)
+    self.arriving.discard(obj)
+    obj.body.velocity = velocity
+    if angular_velocity is not None:
+      obj.body.angular_velocity = angular_velocity
+    self.touch(obj)
+
+  def move_to(self, obj, position, angle=None):
+    """Have obj sweep to position (and angle) over the next step, pushing
+    whatever is in the way, then stop there."""
+    self.kinematic_targets[obj] = (position, angle)
+
+  def teleport(self, obj, position, angle=None):
+    """Put obj at position (and angle) right away, without touching
+    anything on the way."""
+    obj.body.position = position
+    if angle is not None:
+      obj.body.angle = angle
+    self.teleported.add(obj)
+    self.touch(obj)
+
+  def pre_step(self, dt):
+    """Called by Game right before every step(dt), after the objects' own
+    pre_step() had a go."""
+    # Whatever got where it was going last step and has nowhere new to go stops.
+    for obj in self.arriving:
+      if obj not in self.kinematic_targets:
+        obj.body.velocity = (0, 0)
+        obj.body.angular_velocity = 0
+        self.touch(obj)
+    self.arriving = set(self.kinematic_targets)
+
+    for obj, ((x, y), angle) in self.kinematic_targets.items():
+      body = obj.body
+      body_x, body_y = body.position
+      body.velocity = ((x - body_x) / dt, (y - body_y) / dt)
+      if angle is not None:
+        body.angular_velocity = (angle - body.angle) / dt
+      self.touch(obj)
+    self.kinematic_targets.clear()
+
+    if self.teleported:
+      self.reindex(self.teleported)
+      self.teleported.clear()
+
+  def reindex(self, objs):
+    """Let the broadphase know these objects were moved by hand."""
+
+  # Level of detail: things that have come to rest can be frozen into static
+  # bodies, which never collide with each other, so a settled pile costs next
+  # to nothing. See hydrosim's lod.py for what decides when.
+
+  def freeze(self, objs):
+    """Turn dynamic objects static where they are."""
+    for obj in objs:
+      body = obj.body
+      if body.body_type != pymunk.Body.DYNAMIC or not body.mass > 0 or obj in self.frozen:
+        continue
+      self.frozen[obj] = (body.mass, body.moment)
+      self.set_body_type(obj, pymunk.Body.STATIC)
+
+  def thaw(self, objs):
+    """Undo freeze(), the objects start out at rest."""
+    for obj in objs:
+      saved = self.frozen.pop(obj, None)
+      if saved is not None:
+        self.set_body_type(obj, pymunk.Body.DYNAMIC, *saved)
+
+  def set_body_type(self, obj, body_type, mass=None, moment=None):
+    """Switch obj.body between static and dynamic. Dynamic needs the mass
+    and moment back, pymunk forgets them (our shapes have no density)."""
+    body = obj.body
+    body.body_type = body_type
+    if body_type == pymunk.Body.DYNAMIC:
+      body.mass, body.moment = mass, moment
+      body.velocity = (0, 0)
+      body.angular_velocity = 0
+
+  def set_wrap(self, bounds, ghosts=False):
+    """Make the world wrap around like in Asteroids: anything leaving the
+    (left, bottom, right, top) bounds comes back in on the other side.
+    bounds=None turns it off again.
+
+    With ghosts, things near an edge also collide with things just across
+    it, instead of passing through each other at the seam."""
+    self.wrap_bounds = tuple(bounds) if bounds is not None else None
+    self.wrap_ghosts = ghosts and bounds is not None
+
+  def partner_reach(self, cls):
+    """The biggest bounding radius of anything cls collides with, so far.
+
+    Two things touch across a seam when their distances to it add up to
+    less than their radii do, so a ghost margin of just the object's own
+    radius misses pairs that are both a bit away from the edge. Own radius
+    plus this covers them."""
+    return max((self.largest_radius.get(other, 0.0) for other in self.categories.partners.get(cls, ())), default=0.0)
+
+  def wrap_offsets(self, positions, margins):
+    """Which ghost copies each position needs, as a list of (row, offset)
+    for the rows within their margin of an edge (see partner_reach() for
+    how big that needs to be).
+
+    Only things near the right/top edges get ghosts (moved across to the
+    left/bottom), so each pair across a seam is only seen once."""
+    left, bottom, right, top = self.wrap_bounds
+    width, height = right - left, top - bottom
+    near_right = positions[:, 0] > right - margins
+    near_top = positions[:, 1] > top - margins
+    near_bottom = positions[:, 1] < bottom + margins
+    offsets = []
+    for row in np.flatnonzero(near_right | near_top).tolist():
+      if near_right[row]:
+        offsets.append((row, (-width, 0.0)))
+        if near_top[row]:
+          offsets.append((row, (-width, -height)))
+        elif near_bottom[row]:
+          offsets.append((row, (-width, height)))
+      if near_top[row]:
+        offsets.append((row, (0.0, -height)))
+    return offsets
+
+  def wrapped(self, positions):
+    """positions moved back inside the wrap bounds."""
+    left, bottom, right, top = self.wrap_bounds
+    low = np.array((left, bottom))
+    return low + np.mod(positions - low, (right - left, top - bottom))
+
+  # Spatial queries. These all return game objects (not shapes), and take an
+  # optional cls to only look for objects of that class (or a tuple of them).
+  #
+  # The versions here work for any engine off query_candidates() plus
+  # pymunk's per-shape tests, engines override them with something faster.
+
+  def query_candidates(self, bb):
+    """Objects whose bounding box may overlap bb (left, bottom, right, top).
+    Engines with some kind of index should override this."""
+    return self.objects
+
+  def _candidate_shapes(self, bb, cls):
+    for obj in self.query_candidates(bb):
+      if cls is not None and not isinstance(obj, cls):
+        continue
+      for shape in obj.shapes.values():
+        shape.cache_bb()  # Bodies may have moved since the shape last looked
+        yield obj, shape
+
+  def query_radius(self, point, radius, cls=None):
+    """Objects with a shape within radius of point."""
+    x, y = point
+    found = {}
+    for obj, shape in self._candidate_shapes((x - radius, y - radius, x + radius, y + radius), cls):
+      if obj not in found and shape.point_query(point).distance <= radius:
+        found[obj] = None
+    return list(found)
+
+  def query_box(self, bb, cls=None):
+    """Objects with a shape whose bounding box overlaps bb (left, bottom,
+    right, top), same as pymunk's bb_query."""
+    query_bb = pymunk.BB(*bb)
+    found = {}
+    for obj, shape in self._candidate_shapes(bb, cls):
+      if obj not in found and shape.bb.intersects(query_bb):
+        found[obj] = None
+    return list(found)
+
+  def raycast(self, start, end, radius=0, cls=None):
+    """Every object the ray from start to end (optionally fattened by radius)
+    hits, as RayHits ordered from start to end."""
+    (x0, y0), (x1, y1) = start, end
+    bb = (min(x0, x1) - radius, min(y0, y1) - radius, max(x0, x1) + radius, max(y0, y1) + radius)
+    hits = {}
+    for obj, shape in self._candidate_shapes(bb, cls):
+      info = shape.segment_query(start, end, radius)
+      if info.shape is not None and (obj not in hits or info.alpha < hits[obj].alpha):
+        hits[obj] = RayHit(obj, info.point, info.normal, info.alpha)
+    return sorted(hits.values(), key=lambda hit: hit.alpha)
+
+  def raycast_first(self, start, end, radius=0, cls=None):
+    """The first RayHit along the ray, or None."""
+    hits = self.raycast(start, end, radius, cls)
+    return hits[0] if hits else None
+
+  def nearest(self, point, cls=None, max_distance=math.inf):
+    """The object whose surface is closest to point, or None if nothing is
+    within max_distance."""
+    x, y = point
+    bb = (x - max_distance, y - max_distance, x + max_distance, y + max_distance)
+    best, best_distance = None, max_distance
+    for obj, shape in self._candidate_shapes(bb, cls):
+      distance = shape.point_query(point).distance
+      if distance <= best_distance:
+        best, best_distance = obj, distance
+    return best
+
+  # Batched flavours, for when lots of things ask at once (AI, bullets).
+
+  def raycast_many(self, starts, ends, radius=0, cls=None):
+    """raycast_first() for each (start, end), as a list of RayHit or None."""
+    starts = np.asarray(starts, dtype=np.float64).tolist()
+    ends = np.asarray(ends, dtype=np.float64).tolist()
+    return [self.raycast_first(start, end, radius, cls) for start, end in zip(starts, ends)]
+
+  def query_radius_many(self, points, radius, cls=None):
+    """query_radius() for each point, as a list of lists."""
+    points = np.asarray(points, dtype=np.float64).tolist()
+    return [self.query_radius(point, radius, cls) for point in points]
+
+  def profile_collisions(self, enabled):
+    """Switch the collision handler profiler (see profiler.py) on or off."""
+    self.profiler.enabled = enabled
+    self.bind_collision_handlers()
+
+  def bind_collision_handlers(self):
+    """(Re)attach collision handler methods, each one through
+    handler_for() so they pick up the profiler when it's on."""
+
+  def handler_for(self, src_class, dst_class, phase, method):
+    if not self.profiler.enabled:
+      return method
+    return self.profiler.wrap(src_class, dst_class, phase, method)
+
+  def call_handlers(self, obj_a, obj_b, phase, normal, impulse, ke, first):
+    """Call both objects' handlers for this phase, each with itself as
+    src. Returns False if any of them did.
+
+    For engines without pymunk callbacks, they look methods up in
+    self.handlers[src class][dst class][phase]."""
+    accept = True
+    for src, dst, sign in ((obj_a, obj_b, 1), (obj_b, obj_a, -1)):
+      method = self.handlers.get(type(src), {}).get(type(dst), {}).get(phase)
+      if method is None:
+        continue
+      arbiter = Arbiter(
+          shapes=(src.shapes['body'], dst.shapes['body']),
+          normal=normal * sign if normal is not None else pymunk.Vec2d(0, 0),
+          total_impulse=impulse * sign if normal is not None else pymunk.Vec2d(0, 0),
+          total_ke=ke,
+          is_first_contact=first)
+      if method(contacts.Contact(src, dst, self.game, arbiter)) is False:
+        accept = False
+      if type(src) is type(dst):
+        break  # Same class, it's the same handler both ways
+    return accept
+
+  def record_contacts(self, a_handle, a_class, b_handle, b_class, normal, impulse, total_ke, first_contact):
+    """Sort one step's worth of contacts (as arrays, one row per contact,
+    with the normal pointing from a to b) into the batch handlers' buffers.
+
+    Contacts between two objects of the same class show up once, in no
+    particular order."""
+    for src_class, dst_class, _, events in self.contact_handlers:
+      src_id = self.class_ids[src_class]
+      dst_id = self.class_ids[dst_class]
+      forward = (a_class == src_id) & (b_class == dst_id)
+      events.extend(
+          a_handle[forward], b_handle[forward], normal[forward],
+          impulse[forward], total_ke[forward], first_contact[forward])
+      if src_id != dst_id:
+        backward = (a_class == dst_id) & (b_class == src_id)
+        events.extend(
+            b_handle[backward], a_handle[backward], -normal[backward],
+            -impulse[backward], total_ke[backward], first_contact[backward])
+
+  def deliver_contacts(self):
+    """Hand the recorded contacts to the batch handlers, once per step."""
+    with self.game.commands.deferred():
+      for src_class, dst_class, method, events in self.contact_handlers:
+        if len(events):
+          if self.profiler.enabled:
+            self.profiler.call((src_class.__name__, dst_class.__name__, 'batch'), method, events, self.game)
+          else:
+            method(events, self.game)
+        events.clear()
+
 
 class CheesyPhysics(PhysicsEngineBase):
+  """Homegrown engine: moves bodies along their velocities and tells objects
+  when they overlap, but doesn't do any collision response.
 
-  def step(self, now, dt):
-    # Collision detect
-    for i in range(len(self.objects)):
-      for j in range(i + 1, len(self.objects)):
-        obj1 = self.objects[i]
-        obj2 = self.objects[j]
+  Overlaps are found with spatial.grid_pairs() off everybody's bounding
+  circle, filtered against the collides_with class metadata in numpy, and
+  only what's left goes through pymunk's shape-vs-shape narrowphase and the
+  handlers in Python. The uniform grid (see spatial.py) is only kept around
+  for queries.
+  """
+
+  all_pairs_below = 48  # Fewer things than this just check every pair
+  large_cells = 4  # Things wider than this many cells count as large
+
+  def init(self):
+    self.gravity = pymunk.Vec2d(0, -self.game.config.gravity)
+    self.broadphase = self.game.config.broadphase
+    self.cell_size = self.game.config.grid_cell_size
+    self.grid = None
+    self.grid_stale = False  # Things moved since the grid last saw them
+    self.extents = {}  # obj -> (bounding radius, class id)
+    self.pair_cell_size = None  # Picked on the first step, see _candidate_pairs()
+    self.pairs_sized_for = 0
 
-        if obj1.collides_with(obj2):
-          obj1.handle_collision_with(obj2)
-          obj2.handle_collision_with(obj1)
+    # Both sides have to agree they collide, same as pymunk's ShapeFilter.
+    self.colliding_classes = {
+        (src_class, dst_class)
+        for src_class, partners in self.categories.partners.items()
+        for dst_class in partners}
+    # The same as a table of class ids, with one more row and column for
+    # classes we weren't told about.
+    self.colliding_ids = np.zeros((len(self.class_ids) + 1,) * 2, dtype=bool)
+    for src_class, dst_class in self.colliding_classes:
+      self.colliding_ids[self.class_ids[src_class], self.class_ids[dst_class]] = True
 
-    # Objects to add, delete
+  def add_object(self, obj):
+    super().add_object(obj)
+    self.extents[obj] = (
+        max(bounding_radius(shape) for shape in obj.shapes.values()),
+        self.class_ids.get(type(obj), len(self.class_ids)))
+    if self.grid is not None:
+      self.grid.insert(obj, spatial.object_bb(obj))
+      if not self.cell_size and len(self.grid) > 2 * self.grid_sized_for:
+        self.grid = None  # Lots of new stuff, pick a new cell size next query.
+
+  def remove_object(self, obj):
+    super().remove_object(obj)
+    del self.extents[obj]
+    if self.grid is not None:
+      self.grid.remove(obj)
+
+  def set_wrap(self, bounds, ghosts=False):
+    if ghosts:
+      logging.warning('CheesyPhysics has no wrap ghosts, things will pass through each other at the seams')
+    super().set_wrap(bounds)
+
+  def rebuild_grid(self):
+    bbs = {obj: spatial.object_bb(obj) for obj in self.objects}
+    cell_size = self.cell_size or spatial.pick_cell_size(bbs.values())
+    logging.debug(f'CheesyPhysics grid rebuilt with cell_size={cell_size} for {len(bbs)} objects')
+    self.grid = spatial.SpatialGrid(cell_size)
+    self.grid_sized_for = len(bbs)
+    self.grid_stale = False
+    for obj, bb in bbs.items():
+      self.grid.insert(obj, bb)
+
+  def step(self, dt):
+    # Move everything that can move. This is plain tuple math on purpose,
+    # Vec2d arithmetic is surprisingly slow.
+    gx, gy = self.gravity * dt
+    if self.wrap_bounds:
+      left, bottom, right, top = self.wrap_bounds
+      width, height = right - left, top - bottom
+    points = []
+    static = []
     for obj in self.objects:
-      obj.update(now, dt)
+      body = obj.body
+      body_type = body.body_type
+      if body_type == pymunk.Body.STATIC:
+        points.append(body.position)
+        static.append(True)
+        continue
+      vx, vy = body.velocity
+      if body_type == pymunk.Body.DYNAMIC and (gx or gy):
+        vx += gx
+        vy += gy
+        body.velocity = (vx, vy)
+      x, y = body.position
+      x, y = x + vx * dt, y + vy * dt
+      if self.wrap_bounds:
+        x = left + (x - left) % width
+        y = bottom + (y - bottom) % height
+      body.position = (x, y)
+      points.append((x, y))
+      static.append(False)
+      if body.angular_velocity:
+        body.angle += body.angular_velocity * dt
+    self.grid_stale = True
+
+    # Collision detect
+    if self.broadphase == 'grid':
+      pairs = self._candidate_pairs(points, static)
+    else:
+      for obj in self.objects:
+        spatial.object_bb(obj)  # Fresh shape data for the narrowphase
+      pairs = [
+          (obj1, obj2) for obj1, obj2 in itertools.combinations(self.objects, 2)
+          if (type(obj1), type(obj2)) in self.colliding_classes
+          # Floors and frozen piles (see hydrosim's lod.py) can't do anything to each other
+          and not obj1.body.body_type == obj2.body.body_type == pymunk.Body.STATIC]
+
+    for obj1, obj2 in pairs:
+      if self.touching(obj1, obj2):
+        obj1.handle_collision_with(obj2)
+        obj2.handle_collision_with(obj1)
+
+  def _candidate_pairs(self, points, static):
+    """Pairs of objects whose bounding circles overlap, that collide with
+    each other and aren't both static, all worked out in numpy.
+
+    Things many cells wide (like hydrosim's screen wide floors) would make
+    the pair search look way too far out for everybody, so those get a
+    bounding box check against everybody instead, same as SpatialGrid's
+    'large' set."""
+    objs = self.objects
+    if len(objs) < 2:
+      return []
+    positions = np.array(points, dtype=np.float64).reshape(-1, 2)
+    radius, class_id = np.array([self.extents[obj] for obj in objs]).T
+    class_id = class_id.astype(np.intp)
+    static = np.array(static)
+    cell_size = self.cell_size or self.pair_cell_size
+    if not cell_size or len(objs) > 2 * self.pairs_sized_for:
+      # Same idea as spatial.pick_cell_size(): about the median diameter.
+      cell_size = self.pair_cell_size = max(2 * float(np.median(radius)), 1.0)
+      self.pairs_sized_for = len(objs)
+
+    large = 2 * radius > self.large_cells * cell_size
+    small = np.flatnonzero(~large)
+    if len(small) <= self.all_pairs_below:
+      i, j = np.triu_indices(len(small), 1)  # Not worth sorting into cells
+    else:
+      i, j = spatial.grid_pairs(positions[small], cell_size, 2 * radius[small].max())
+    i, j = small[i], small[j]
+    delta = positions[i] - positions[j]
+    reach = radius[i] + radius[j]
+    keep = (delta * delta).sum(axis=1) <= reach * reach
+    i, j = [i[keep]], [j[keep]]
+
+    if large.any():
+      left, bottom = (positions - radius[:, None]).T
+      right, top = (positions + radius[:, None]).T
+      done = np.zeros(len(objs), dtype=bool)
+      for row in np.flatnonzero(large).tolist():
+        done[row] = True
+        bl, bb, br, bt = spatial.object_bb(objs[row])
+        hits = np.flatnonzero(~done & (left <= br) & (bl <= right) & (bottom <= bt) & (bb <= top))
+        i.append(np.full(len(hits), row))
+        j.append(hits)
+    i, j = np.concatenate(i), np.concatenate(j)
+
+    keep = self.colliding_ids[class_id[i], class_id[j]] & ~(static[i] & static[j])
+    i, j = i[keep].tolist(), j[keep].tolist()
+    # The narrowphase needs fresh shape data, and we skipped object_bb().
+    for row in set(i) | set(j):
+      for shape in objs[row].shapes.values():
+        shape.cache_bb()
+    return [(objs[a], objs[b]) for a, b in zip(i, j)]
+
+  def reindex(self, objs):
+    if self.grid is not None and not self.grid_stale:
+      for obj in objs:
+        self.grid.update(obj, spatial.object_bb(obj))
+
+  def query_candidates(self, bb):
+    if self.grid is None:
+      self.rebuild_grid()
+    elif self.grid_stale:
+      # Only queries need the grid, so it catches up with the last step
+      # here instead of in step().
+      for obj in self.objects:
+        self.grid.update(obj, spatial.object_bb(obj))
+      self.grid_stale = False
+    return self.grid.query(bb)
+
+  def touching(self, obj1, obj2):
+    for shape1 in obj1.shapes.values():
+      for shape2 in obj2.shapes.values():
+        if shape1.shapes_collide(shape2).points:
+          return True
+    return False
+
+
+class Arbiter:
+  """Just enough of pymunk.Arbiter for collision handlers to run on engines
+  that don't have a pymunk.Space."""
+
+  def __init__(self, shapes, normal, total_impulse, total_ke, is_first_contact):
+    self.shapes = shapes
+    self.normal = normal
+    self.total_impulse = total_impulse
+    self.total_ke = total_ke
+    self.is_first_contact = is_first_contact
 
 
 class PymunkPhysics(PhysicsEngineBase):
 
   def init(self):
-    self.space = pymunk.Space()
+    self.space = tuner.SpaceTuner.make_space(self.game.config)
     self.space.gravity = (0, -self.game.config.gravity)
+    self.tuner = tuner.SpaceTuner(self.space, self.game.config)
 
+    # One pymunk handler per pair of classes, whichever side the methods are
+    # on. Having one for each direction leaves it up to pymunk which one runs
+    # and in what shape order.
+    self.bindings = []  # (pymunk handler, src class, dst class, phase, method)
     for src_class in self.object_classes.values():
-      for dst_class_name in src_class.collides_with:
-        dst_class = self.object_classes[dst_class_name]
-
-        # Attach handler function if we have one
-        handler = self.space.add_collision_handler(
-            src_class.collision_type,
-            dst_class.collision_type)
-
-        handler.data['game'] = self.game
-
+      for dst_class in self.categories.partners[src_class]:
         for phase in ['begin', 'pre_solve', 'post_solve', 'separate']:
           method_name = f'collision_{dst_class.__name__}_{phase}'
           method = getattr(src_class, method_name, None)
           if method:
             logging.info(f'Collision handler method for {src_class.__name__} to {dst_class.__name__} {phase}')
-            logging.info(f'Handler({src_class.__name__}={src_class.collision_type},{dst_class.__name__}={dst_class.collision_type})')
-            method = self._decorate_collision_handler(method)
-            setattr(handler, phase, method)
+            first, second = sorted((src_class, dst_class), key=lambda cls: cls.collision_type)
+            handler = self.space.add_collision_handler(first.collision_type, second.collision_type)
+            self.bindings.append((handler, src_class, dst_class, phase, method))
+    self.bind_collision_handlers()
+
+    # Classes past the category limit get through each other's filters, throw
+    # out the pairs that shouldn't collide before anything else sees them.
+    for cls in self.categories.overflow:
+      self.space.add_wildcard_collision_handler(cls.collision_type).begin = self._overflow_begin
+
+    if self.contact_handlers and not hasattr(pymunk, 'batch'):
+      raise Exception('collision_*_batch handlers need pymunk 6.6 or newer (pymunk.batch)')
+    self.body_lookup = {}  # body.id -> object, ghost bodies included
+    self.body_table = None  # Sorted array version of body_lookup, made when needed
+    self.arbiter_buffer = pymunk.batch.Buffer() if self.contact_handlers else None
+    self.body_buffer = pymunk.batch.Buffer() if hasattr(pymunk, 'batch') else None
+
+    self.ghosts = {}  # (obj, offset) -> ghost body, see set_wrap()
+
+    # (x, y, angle) each body table row's sprite last got, NaN for never.
+    self.synced_state = np.empty((0, 3))
+    self.synced_ids = np.empty(0, dtype=np.uintp)
 
-  def _decorate_collision_handler(self, func):
+    # Resting bodies fall asleep and cost (nearly) nothing until something
+    # touches them. Off unless configured.
+    config = self.game.config
+    if config.sleep_time is not None:
+      self.space.sleep_time_threshold = config.sleep_time
+    if config.idle_speed is not None:
+      self.space.idle_speed_threshold = config.idle_speed
+    self.ghost_radius = {}  # obj -> its bounding radius, for ghost margins
 
-    def wrapper(*args, **kwargs):
-      logging.info(f'Collision Handler {func.__name__}')
-      return func(*args, **kwargs)
+  def bind_collision_handlers(self):
+    methods = {}  # (handler, phase) -> [(src class, dst class, method)]
+    for handler, src_class, dst_class, phase, method in self.bindings:
+      methods.setdefault((handler, phase), []).append(
+          (src_class, dst_class, self.handler_for(src_class, dst_class, phase, method)))
+    for (handler, phase), handler_methods in methods.items():
+      if len(handler_methods) == 1 and not self.profiler.enabled:
+        callback = self._direct_callback(*handler_methods[0])
+      else:
+        callback = self._dispatcher([(src_class, method) for src_class, _, method in handler_methods])
+      setattr(handler, phase, callback)
 
-    return wrapper
+  def _direct_callback(self, src_class, dst_class, method):
+    """The pymunk callback for a pair where only one side has a method:
+    nothing to loop over or look up, just the Contact it needs.
 
+    pymunk hands over arbiter.shapes in the order of the handler's collision
+    types (see __init__), so which side is src is known up front."""
+    game = self.game
+    Contact = contacts.Contact
+
+    if src_class.collision_type <= dst_class.collision_type:
+      def callback(arbiter, space, data):
+        shape_a, shape_b = arbiter.shapes
+        return method(Contact(shape_a.game_object, shape_b.game_object, game, arbiter)) is not False
+    else:
+      def callback(arbiter, space, data):
+        shape_a, shape_b = arbiter.shapes
+        return method(Contact(shape_b.game_object, shape_a.game_object, game, arbiter, flipped=True)) is not False
+
+    return callback
+
+  def _dispatcher(self, methods):
+    """A pymunk callback that hands each method a Contact with its own
+    object as src."""
+    game = self.game
+
+    def dispatch(arbiter, space, data):
+      shape_a, shape_b = arbiter.shapes
+      obj_a, obj_b = shape_a.game_object, shape_b.game_object
+      accept = True
+      for src_class, method in methods:
+        if type(obj_a) is src_class:
+          contact = contacts.Contact(obj_a, obj_b, game, arbiter)
+        else:
+          contact = contacts.Contact(obj_b, obj_a, game, arbiter, flipped=True)
+        if method(contact) is False:
+          accept = False
+      return accept
+
+    return dispatch
+
+  def _overflow_begin(self, arbiter, space, data):
+    shape_a, shape_b = arbiter.shapes
+    classes = self.categories.classes
+    return self.categories.interacts(
+        classes[shape_a.collision_type - 1], classes[shape_b.collision_type - 1])
 
   def add_object(self, obj):
     super().add_object(obj)
     self.space.add(obj.body, *obj.shapes.values())
-    
-    collision_mask = 0
-    for other_gameobj_class_name in obj.collides_with:
-      other_gameobj_class = self.object_classes[other_gameobj_class_name]
-      collision_mask |= other_gameobj_class.collision_type
+    self.body_lookup[obj.body.id] = obj
+    self.body_table = None
 
-    filter = pymunk.ShapeFilter(categories=obj.collision_type, mask=collision_mask)
-    logging.debug(f'Configuring {obj} with filter={filter}')
+    filter = self.categories.filter_for(type(obj))
 
-    # Optimization, comment it out if collides_with ain't right.
+    # One filter per class, shared by every shape, see categories.py.
     for shape in obj.shapes.values():
       shape.filter = filter
 
   def remove_object(self, obj):
     super().remove_object(obj)
     self.space.remove(obj.body, *obj.shapes.values())
+    del self.body_lookup[obj.body.id]
+    self.body_table = None
+    self.ghost_radius.pop(obj, None)
+    for key in [key for key in self.ghosts if key[0] is obj]:
+      self._remove_ghost(key)
 
+  def set_body_type(self, obj, body_type, mass=None, moment=None):
+    # Chipmunk can crash changing the type of a body in the space when it's
+    # part of a sleeping pile, so take it out while we do it.
+    shapes = obj.shapes.values()
+    self.space.remove(obj.body, *shapes)
+    super().set_body_type(obj, body_type, mass, moment)
+    self.space.add(obj.body, *shapes)
+    self.body_table = None
 
   def step(self, dt):
-    self.space.step(dt)
+    # Spawns and deletes made by collision handlers get applied in a post-step
+    # callback, which is the only time pymunk lets us touch the space.
+    if self.wrap_ghosts:
+      self._update_ghosts()
+    with self.game.commands.deferred(on_queued=self._schedule_flush):
+      self.tuner.timed_step(self.space.step, dt)
+    if self.ghosts:
+      self._apply_ghost_impulses()
+    if self.contact_handlers:
+      self._record_arbiters()
+      self.deliver_contacts()
+    if self.wrap_bounds:
+      self._wrap()
+
+  def reindex(self, objs):
+    for obj in objs:
+      self.space.reindex_shapes_for_body(obj.body)
+
+  def _get_body_table(self):
+    """body_lookup as arrays sorted by body id: (ids, objects, handles,
+    class ids, is_ghost), for turning pymunk.batch output into objects."""
+    if self.body_table is None:
+      ids = np.fromiter(self.body_lookup.keys(), dtype=np.uintp, count=len(self.body_lookup))
+      order = np.argsort(ids)
+      objs = list(self.body_lookup.values())
+      objs = [objs[index] for index in order.tolist()]
+      self.body_table = (
+          ids[order],
+          objs,
+          np.array([obj.handle for obj in objs], dtype=np.int64),
+          np.array([self.class_ids.get(type(obj), -1) for obj in objs], dtype=np.int64),
+          np.array([obj.body.id != id for obj, id in zip(objs, ids[order].tolist())], dtype=bool))
+    return self.body_table
+
+  def _body_positions(self):
+    """Positions of every movable, non-ghost body as (objects, positions
+    array), read in one go with pymunk.batch when we have it."""
+    if self.body_buffer is None:
+      objs = [obj for obj in self.objects if obj.body.body_type != pymunk.Body.STATIC]
+      return objs, np.array([tuple(obj.body.position) for obj in objs]).reshape(-1, 2)
+
+    fields = pymunk.batch.BodyFields
+    self.body_buffer.clear()
+    pymunk.batch.get_space_bodies(self.space, fields.BODY_ID | fields.POSITION, self.body_buffer)
+    ids = np.frombuffer(self.body_buffer.int_buf(), dtype=np.uintp)
+    positions = np.frombuffer(self.body_buffer.float_buf(), dtype=np.float64).reshape(-1, 2)
+    table_ids, table_objs, _, _, is_ghost = self._get_body_table()
+    index = np.minimum(np.searchsorted(table_ids, ids), max(len(table_ids) - 1, 0))
+    keep = np.flatnonzero((table_ids[index] == ids) & ~is_ghost[index]) if len(table_ids) else []
+    objs = [table_objs[i] for i in index[keep].tolist()]
+    # Static bodies never move, the caller doesn't care about them.
+    keep_objs = [k for k, obj in enumerate(objs) if obj.body.body_type != pymunk.Body.STATIC]
+    return [objs[k] for k in keep_objs], positions[keep][keep_objs]
+
+  def sync_bodies(self):
+    if self.body_buffer is None:
+      return super().sync_bodies()
+
+    # Read every body in one go, and compare to what the sprites got last
+    # time, so the only Python code per body is for the ones that moved.
+    fields = pymunk.batch.BodyFields
+    self.body_buffer.clear()
+    pymunk.batch.get_space_bodies(self.space, fields.BODY_ID | fields.POSITION | fields.ANGLE, self.body_buffer)
+    ids = np.frombuffer(self.body_buffer.int_buf(), dtype=np.uintp)
+    state = np.frombuffer(self.body_buffer.float_buf(), dtype=np.float64).reshape(-1, 3)
+    table_ids, table_objs, _, _, is_ghost = self._get_body_table()
+    if not len(table_ids):
+      return []
+
+    if self.synced_ids is not table_ids:
+      # The table got rebuilt, carry over what we know about bodies still in it.
+      synced = np.full((len(table_ids), 3), np.nan)
+      if len(self.synced_ids):
+        old = np.minimum(np.searchsorted(self.synced_ids, table_ids), len(self.synced_ids) - 1)
+        known = self.synced_ids[old] == table_ids
+        synced[known] = self.synced_state[old[known]]
+      self.synced_state, self.synced_ids = synced, table_ids
+
+    index = np.minimum(np.searchsorted(table_ids, ids), len(table_ids) - 1)
+    keep = (table_ids[index] == ids) & ~is_ghost[index]
+    index, state = index[keep], state[keep]
+    changed = (self.synced_state[index] != state).any(axis=1)  # NaN counts as changed
+    index = index[changed]
+    self.synced_state[index] = state[changed]
+    return [table_objs[i] for i in index.tolist()]
+
+  def _wrap(self):
+    """Move bodies that left the wrap bounds back in on the other side. The
+    bounds check is one array operation, only bodies that actually wrapped
+    get touched (and reindexed) from Python."""
+    objs, positions = self._body_positions()
+    wrapped = self.wrapped(positions)
+    for row in np.flatnonzero((wrapped != positions).any(axis=1)).tolist():
+      body = objs[row].body
+      body.position = tuple(wrapped[row])
+      self.space.reindex_shapes_for_body(body)
+
+  def _update_ghosts(self):
+    """Make sure everything near an edge has a ghost copy across it (and
+    nothing else does), and line the ghosts up with their owners."""
+    objs, positions = self._body_positions()
+    # Own radius plus the biggest partner's, see partner_reach().
+    reach = {cls: self.partner_reach(cls) for cls in self.largest_radius}
+    margins = np.array([self._ghost_radius(obj) + reach[type(obj)] for obj in objs]).reshape(-1)
+    wanted = {(objs[row], offset) for row, offset in self.wrap_offsets(positions, margins)}
+    for key in [key for key in self.ghosts if key not in wanted]:
+      self._remove_ghost(key)
+    for key in wanted:
+      if key not in self.ghosts:
+        self._add_ghost(*key)
+
+    for (obj, (dx, dy)), ghost in self.ghosts.items():
+      body = obj.body
+      x, y = body.position
+      ghost.position = (x + dx, y + dy)
+      ghost.angle = body.angle
+      ghost.velocity = body.velocity
+      ghost.angular_velocity = body.angular_velocity
+      ghost.velocity_before = ghost.velocity
+      ghost.angular_velocity_before = ghost.angular_velocity
+      self.space.reindex_shapes_for_body(ghost)
+
+  def _ghost_radius(self, obj):
+    radius = self.ghost_radius.get(obj)
+    if radius is None:
+      radius = self.ghost_radius[obj] = max(bounding_radius(shape) for shape in obj.shapes.values())
+    return radius
+
+  def _add_ghost(self, obj, offset):
+    body = obj.body
+    if body.body_type == pymunk.Body.DYNAMIC:
+      ghost = pymunk.Body(body.mass, body.moment)
+      ghost.velocity_func = _ghost_velocity
+    else:
+      ghost = pymunk.Body(body_type=pymunk.Body.KINEMATIC)
+    shapes = [copy_shape(shape, ghost) for shape in obj.shapes.values()]
+    for shape in shapes:
+      # Ghosts don't collide with each other, or seams would count twice.
+      shape.filter = pymunk.ShapeFilter(GHOST_GROUP, shape.filter.categories, shape.filter.mask)
+    ghost.game_object = obj  # So handlers see the real thing
+    for shape in shapes:
+      shape.game_object = obj
+    self.space.add(ghost, *shapes)
+    self.ghosts[(obj, offset)] = ghost
+    self.body_lookup[ghost.id] = obj
+    self.body_table = None
+
+  def _remove_ghost(self, key):
+    ghost = self.ghosts.pop(key)
+    self.space.remove(ghost, *ghost.shapes)
+    del self.body_lookup[ghost.id]
+    self.body_table = None
+
+  def _apply_ghost_impulses(self):
+    """Whatever a ghost got hit with this step happens to its owner."""
+    for (obj, _), ghost in self.ghosts.items():
+      if obj.deleted or ghost.body_type != pymunk.Body.DYNAMIC:
+        continue
+      body = obj.body
+      body.velocity += ghost.velocity - ghost.velocity_before
+      body.angular_velocity += ghost.angular_velocity - ghost.angular_velocity_before
+
+  def _record_arbiters(self):
+    """Pull every arbiter out of the space in one go with pymunk.batch and
+    record the ones that touched this step."""
+    fields = pymunk.batch.ArbiterFields
+    buffer = self.arbiter_buffer
+    buffer.clear()
+    pymunk.batch.get_space_arbiters(
+        self.space,
+        fields.BODY_A_ID | fields.BODY_B_ID | fields.TOTAL_IMPULSE
+        | fields.TOTAL_KE | fields.IS_FIRST_CONTACT | fields.NORMAL
+        | fields.CONTACT_COUNT,
+        buffer)
+    ints = np.frombuffer(buffer.int_buf(), dtype=np.uintp).reshape(-1, 4)
+    floats = np.frombuffer(buffer.float_buf(), dtype=np.float64).reshape(-1, 5)
+    # The space keeps arbiters around for a few steps after things stop
+    # touching, those have no contact points.
+    touching = ints[:, 3] > 0
+    ints, floats = ints[touching], floats[touching]
+    if not len(ints):
+      return
+
+    ids, _, handles, class_ids, _ = self._get_body_table()
+    a = np.searchsorted(ids, ints[:, 0])
+    b = np.searchsorted(ids, ints[:, 1])
+    # searchsorted gives the spot a body would go even if it isn't in the
+    # table (say, one added since it was built), same as Worker._publish(),
+    # so check both ends are really there.
+    known = np.flatnonzero((a < len(ids)) & (b < len(ids)))
+    known = known[(ids[a[known]] == ints[known, 0]) & (ids[b[known]] == ints[known, 1])]
+    if not len(known):
+      return
+    a, b, ints, floats = a[known], b[known], ints[known], floats[known]
+    self.record_contacts(
+        handles[a], class_ids[a], handles[b], class_ids[b],
+        normal=floats[:, 3:5],
+        impulse=floats[:, 0:2],
+        total_ke=floats[:, 2],
+        first_contact=ints[:, 2].astype(bool))
+
+  def _schedule_flush(self):
+    # Only one callback per key, so this is a no-op after the first time.
+    self.space.add_post_step_callback(self._flush_commands, self.game.commands)
+
+  def _flush_commands(self, space, key):
+    self.game.commands.flush()
+
+  def _query_filter(self, cls):
+    mask = pymunk.ShapeFilter().mask if cls is None else self.categories.query_mask(cls)
+    return pymunk.ShapeFilter(categories=categories.QUERY_CATEGORY, mask=mask)
+
+  def _query_objects(self, shapes, cls):
+    """Unique objects for a bunch of shapes, in order."""
+    found = {}
+    for shape in shapes:
+      obj = shape.game_object
+      if cls is None or isinstance(obj, cls):
+        found[obj] = None
+    return list(found)
+
+  def query_radius(self, point, radius, cls=None):
+    infos = self.space.point_query(point, radius, self._query_filter(cls))
+    return self._query_objects((info.shape for info in infos), cls)
+
+  def query_box(self, bb, cls=None):
+    return self._query_objects(self.space.bb_query(pymunk.BB(*bb), self._query_filter(cls)), cls)
+
+  def raycast(self, start, end, radius=0, cls=None):
+    hits = {}
+    for info in self.space.segment_query(start, end, radius, self._query_filter(cls)):
+      obj = info.shape.game_object
+      if (cls is None or isinstance(obj, cls)) and (obj not in hits or info.alpha < hits[obj].alpha):
+        hits[obj] = RayHit(obj, info.point, info.normal, info.alpha)
+    return sorted(hits.values(), key=lambda hit: hit.alpha)
+
+  # Classes with the same partners share a category bit (see categories.py),
+  # so the query filter alone can let other classes through. pymunk's single
+  # answer is still right whenever it's a cls, as nothing of cls can be any
+  # closer, otherwise go through all the hits.
+
+  def raycast_first(self, start, end, radius=0, cls=None):
+    query_filter = self._query_filter(cls)
+    info = self.space.segment_query_first(start, end, radius, query_filter)
+    if info is not None and cls is not None and not isinstance(info.shape.game_object, cls):
+      infos = [info for info in self.space.segment_query(start, end, radius, query_filter)
+               if isinstance(info.shape.game_object, cls)]
+      info = min(infos, key=lambda info: info.alpha, default=None)
+    if info is None:
+      return None
+    return RayHit(info.shape.game_object, info.point, info.normal, info.alpha)
+
+  def nearest(self, point, cls=None, max_distance=math.inf):
+    query_filter = self._query_filter(cls)
+    info = self.space.point_query_nearest(point, max_distance, query_filter)
+    if info is not None and cls is not None and not isinstance(info.shape.game_object, cls):
+      infos = [info for info in self.space.point_query(point, max_distance, query_filter)
+               if isinstance(info.shape.game_object, cls)]
+      info = min(infos, key=lambda info: info.distance, default=None)
+    if info is None:
+      return None
+    return info.shape.game_object
+
+  @property
+  def gravity(self):
+    return self.space.gravity
+
+  @gravity.setter
+  def gravity(self, value):
+    self.space.gravity = value
+    # Sleeping bodies don't notice gravity changing by themselves.
+    if self.space.sleep_time_threshold != math.inf:
+      for body in self.space.bodies:
+        if body.body_type == pymunk.Body.DYNAMIC:
+          body.activate()
+
+
+# Shape filter group for wrap ghosts, shapes in the same group never collide.
+GHOST_GROUP = 1
+
+
+def _ghost_velocity(body, gravity, damping, dt):
+  # The owner already gets gravity, the ghost only passes on collisions.
+  pymunk.Body.update_velocity(body, (0, 0), damping, dt)
+
+
+def copy_shape(shape, body):
+  """A copy of shape attached to body."""
+  if isinstance(shape, pymunk.Circle):
+    copy = pymunk.Circle(body, shape.radius, shape.offset)
+  elif isinstance(shape, pymunk.Segment):
+    copy = pymunk.Segment(body, shape.a, shape.b, shape.radius)
+  else:
+    copy = pymunk.Poly(body, shape.get_vertices(), radius=shape.radius)
+  for attr in ('elasticity', 'friction', 'collision_type', 'filter', 'sensor', 'surface_velocity'):
+    setattr(copy, attr, getattr(shape, attr))
+  return copy
+
+
+def bounding_radius(shape):
+  """Radius of a circle around the body's origin that covers the shape."""
+  if isinstance(shape, pymunk.Circle):
+    return shape.offset.length + shape.radius
+  if isinstance(shape, pymunk.Segment):
+    return max(shape.a.length, shape.b.length) + shape.radius
+  return max(v.length for v in shape.get_vertices()) + shape.radius
+
+
+class VectorizedPhysics(PhysicsEngineBase):
+  """Struct-of-arrays engine: every object's state lives in one row of a
+  bunch of numpy arrays, and a step is a handful of batched array operations
+  instead of Python code per object.
+
+  Objects are simulated as circles (anything that isn't a circle uses its
+  bounding circle), except that non-dynamic Segment objects (hydrosim's
+  Floors) are walls.
+
+  Game code keeps using obj.body, with a catch: the arrays are the real
+  state. sync_bodies() copies them into the bodies once per frame, and a
+  body only gets read back when it was just added, is kinematic (game code
+  steers those every frame), was handed to a collision handler, or somebody
+  called touch() on it.
+
+  Don't expect it to beat pymunk at game sizes. Every step pays a fixed
+  numpy overhead (~0.4 ms at 100 bodies vs pymunk's 0.03), and copying rows
+  back into the bodies costs about as much as pymunk's whole step. It only
+  pulls ahead somewhere past 50k bodies, see benchmark.py.
+  """
+
+  ITERATIONS = 4  # Contact solver passes per step
+  ROW_FIELDS = (
+      'position', 'velocity', 'angle', 'angular_velocity', 'radius', 'inv_mass',
+      'elasticity', 'friction', 'type_id', 'handle', 'dynamic', 'synced')
+
+  def init(self):
+    self._gravity = np.array((0.0, -float(self.game.config.gravity)))
+    self.count = 0
+    self.capacity = 0
+    self.row_of = {}  # obj -> row in the arrays
+    self.row_objects = []
+    self._grow(256)
+
+    self.walls = []  # Segment objects, in seg_* array order
+    self.synced_walls = {}  # wall -> (x, y, angle) its sprite last got
+    self._rebuild_walls()
+
+    self.kinematic = set()
+    self.untouched = set()  # Objects whose body we need to read back
+    self.stale = False
+    self.cells = None  # spatial.PointGrid of the rows for queries, see _cell_index()
+
+    # Handler lookup: handlers[src_class][dst_class][phase] = method
+    self.type_ids = self.class_ids
+    # One spare row/column of False for type_id -1 (classes we don't know)
+    self.handled = np.zeros((len(self.type_ids) + 1, len(self.type_ids) + 1), dtype=bool)
+    # Same, per phase, so contacts only pay for the handlers they actually have
+    self.phases = {phase: np.zeros_like(self.handled) for phase in ('begin', 'pre_solve', 'post_solve', 'separate')}
+    self.bindings = []  # (src class, dst class, phase, method)
+    for src_class in self.object_classes.values():
+      for dst_class in self.categories.partners[src_class]:  # Both sides have to list each other
+        for phase in ['begin', 'pre_solve', 'post_solve', 'separate']:
+          method = getattr(src_class, f'collision_{dst_class.__name__}_{phase}', None)
+          if method:
+            logging.info(f'Collision handler method for {src_class.__name__} to {dst_class.__name__} {phase}')
+            self.bindings.append((src_class, dst_class, phase, method))
+            for matrix in (self.handled, self.phases[phase]):
+              matrix[self.type_ids[src_class], self.type_ids[dst_class]] = True
+              matrix[self.type_ids[dst_class], self.type_ids[src_class]] = True
+
+    self.bind_collision_handlers()
+
+    self.touching = {}  # (handle, handle) -> (obj_a, obj_b) for handled pairs
+    self.ignored = set()  # Pairs whose begin handler said no, until they separate
+    self.handed = {}  # Objects handlers saw this step (a dict, to keep them in order)
+
+    # Same again for batch handlers, plus last step's contacts (as slot pair
+    # keys) so we can tell which ones are new.
+    self.batched = np.zeros_like(self.handled)
+    for src_class, dst_class, _, _ in self.contact_handlers:
+      self.batched[self.type_ids[src_class], self.type_ids[dst_class]] = True
+      self.batched[self.type_ids[dst_class], self.type_ids[src_class]] = True
+    self.batched_pair_keys = np.empty(0, dtype=np.int64)
+    self.batched_hit_keys = np.empty(0, dtype=np.int64)
+
+  def bind_collision_handlers(self):
+    self.handlers = {}
+    for src_class, dst_class, phase, method in self.bindings:
+      self.handlers.setdefault(src_class, {}).setdefault(dst_class, {})[phase] = (
+          self.handler_for(src_class, dst_class, phase, method))
+
+  def _grow(self, capacity):
+    self.position = self._resized(getattr(self, 'position', None), (capacity, 2), np.float64)
+    self.velocity = self._resized(getattr(self, 'velocity', None), (capacity, 2), np.float64)
+    for name in ('angle', 'angular_velocity', 'radius', 'inv_mass', 'elasticity', 'friction'):
+      setattr(self, name, self._resized(getattr(self, name, None), (capacity,), np.float64))
+    self.type_id = self._resized(getattr(self, 'type_id', None), (capacity,), np.intp)
+    self.handle = self._resized(getattr(self, 'handle', None), (capacity,), np.int64)
+    self.dynamic = self._resized(getattr(self, 'dynamic', None), (capacity,), bool)
+    # Row state as of the last sync_bodies(), to only write bodies that changed
+    self.synced = self._resized(getattr(self, 'synced', None), (capacity, 6), np.float64)
+    self.capacity = capacity
+
+  def _resized(self, array, shape, dtype):
+    new = np.zeros(shape, dtype=dtype)
+    if array is not None:
+      new[:self.count] = array[:self.count]
+    return new
+
+  def _is_wall(self, obj):
+    return (
+        isinstance(obj.shapes['body'], pymunk.Segment)
+        and obj.body.body_type != pymunk.Body.DYNAMIC)
+
+  def add_object(self, obj):
+    super().add_object(obj)
+    if obj.body.body_type == pymunk.Body.KINEMATIC:
+      self.kinematic.add(obj)
+
+    if self._is_wall(obj):
+      self.walls.append(obj)
+      self._rebuild_walls()
+      return
+
+    if self.count == self.capacity:
+      self._grow(self.capacity * 2)
+    row = self.count
+    self.count += 1
+    self.row_of[obj] = row
+    self.row_objects.append(obj)
+
+    body = obj.body
+    self.radius[row] = max(bounding_radius(shape) for shape in obj.shapes.values())
+    self.dynamic[row] = body.body_type == pymunk.Body.DYNAMIC
+    self.inv_mass[row] = 1 / body.mass if self.dynamic[row] and body.mass > 0 else 0.0
+    self.elasticity[row] = obj.shapes['body'].elasticity
+    self.friction[row] = obj.shapes['body'].friction
+    self.type_id[row] = self.type_ids.get(type(obj), -1)
+    self.handle[row] = obj.handle
+    self.synced[row] = np.nan
+    self.cells = None
+    self.untouched.add(obj)  # Read it in next step, after the caller is done with it
+
+  def remove_object(self, obj):
+    super().remove_object(obj)
+    self.kinematic.discard(obj)
+    self.untouched.discard(obj)
+
+    if obj in self.walls:
+      self.walls.remove(obj)
+      self.synced_walls.pop(obj, None)
+      self._rebuild_walls()
+      return
+
+    # Swap-remove: move the last row into the hole.
+    self.cells = None
+    row = self.row_of.pop(obj)
+    last = self.count - 1
+    if row != last:
+      for name in self.ROW_FIELDS:
+        array = getattr(self, name)
+        array[row] = array[last]
+      moved = self.row_objects[last]
+      self.row_objects[row] = moved
+      self.row_of[moved] = row
+    self.row_objects.pop()
+    self.count -= 1
+
+  def _rebuild_walls(self):
+    count = len(self.walls)
+    self.seg_a = np.zeros((count, 2))
+    self.seg_b = np.zeros((count, 2))
+    self.seg_radius = np.zeros(count)
+    self.seg_elasticity = np.zeros(count)
+    self.seg_friction = np.zeros(count)
+    self.seg_type_id = np.zeros(count, dtype=np.intp)
+    self.seg_handle = np.zeros(count, dtype=np.int64)
+    for index, obj in enumerate(self.walls):
+      shape = obj.shapes['body']
+      self.seg_radius[index] = shape.radius
+      self.seg_elasticity[index] = shape.elasticity
+      self.seg_friction[index] = shape.friction
+      self.seg_type_id[index] = self.type_ids.get(type(obj), -1)
+      self.seg_handle[index] = obj.handle
+      self._read_wall(index)
+
+  def _read_wall(self, index):
+    obj = self.walls[index]
+    shape = obj.shapes['body']
+    self.seg_a[index] = obj.body.local_to_world(shape.a)
+    self.seg_b[index] = obj.body.local_to_world(shape.b)
+
+  def _read_body(self, obj):
+    if obj not in self.row_of:
+      if obj in self.walls:
+        self._read_wall(self.walls.index(obj))
+      return
+    row = self.row_of[obj]
+    body = obj.body
+    self.position[row] = body.position
+    self.velocity[row] = body.velocity
+    self.angle[row] = body.angle
+    self.angular_velocity[row] = body.angular_velocity
+
+  def touch(self, obj):
+    self.untouched.add(obj)
+
+  def freeze(self, objs):
+    objs = list(objs)
+    for obj in objs:
+      self._write_body(obj)  # Static bodies don't get synced, so catch up first
+    super().freeze(objs)
+
+  def set_body_type(self, obj, body_type, mass=None, moment=None):
+    super().set_body_type(obj, body_type, mass, moment)
+    row = self.row_of.get(obj)
+    if row is None:
+      return
+    body = obj.body
+    self.dynamic[row] = body.body_type == pymunk.Body.DYNAMIC
+    self.inv_mass[row] = 1 / body.mass if self.dynamic[row] and body.mass > 0 else 0.0
+    self.velocity[row] = 0.0
+    self.angular_velocity[row] = 0.0
+
+  @property
+  def gravity(self):
+    return pymunk.Vec2d(*self._gravity)
+
+  @gravity.setter
+  def gravity(self, value):
+    self._gravity = np.array(value, dtype=np.float64)
+
+  def sync_bodies(self):
+    # Anything added since the last step only has its state in its body so
+    # far, don't clobber that with an empty row.
+    self._read_untouched()
+    n = self.count
+    state = np.column_stack((
+        self.position[:n], self.velocity[:n], self.angle[:n], self.angular_velocity[:n]))
+    changed = self.synced[:n] != state
+    rows = np.flatnonzero(changed.any(axis=1))
+    self.synced[rows] = state[rows]
+    # Setting a body attribute costs a good microsecond, so only the ones
+    # that changed. Velocities mostly don't, outside of collisions.
+    speeding = changed[rows][:, [2, 3, 5]].any(axis=1)
+
+    moved = []
+    for row, (x, y, vx, vy, angle, angular_velocity), new_velocity in zip(
+        rows.tolist(), state[rows].tolist(), speeding.tolist()):
+      obj = self.row_objects[row]
+      moved.append(obj)
+      body = obj.body
+      if body.body_type == pymunk.Body.STATIC:
+        continue
+      body.position = (x, y)
+      body.angle = angle
+      if new_velocity:
+        body.velocity = (vx, vy)
+        body.angular_velocity = angular_velocity
+
+    # Walls aren't rows, and there aren't many, the plain version does them.
+    for obj in self.walls:
+      body = obj.body
+      x, y = body.position
+      wall_state = (x, y, body.angle)
+      if self.synced_walls.get(obj) != wall_state:
+        self.synced_walls[obj] = wall_state
+        moved.append(obj)
+
+    # Game code is about to get a go at the kinematic bodies.
+    self.untouched.update(self.kinematic)
+    return moved
+
+  def _read_untouched(self):
+    if self.untouched:
+      self.cells = None  # They may have been moved
+    for obj in self.untouched:
+      self._read_body(obj)
+    self.untouched.clear()
+
+  def step(self, dt):
+    self._read_untouched()
+
+    n = self.count
+    position = self.position[:n]
+    velocity = self.velocity[:n]
+    dynamic = self.dynamic[:n]
+
+    velocity[dynamic] += self._gravity * dt
+    position += velocity * dt
+    self.angle[:n] += self.angular_velocity[:n] * dt
+    self._move_kinematic_walls(dt)
+
+    pairs = self._circle_contacts()
+    hits = self._wall_contacts()
+
+    # Handlers can't add/remove rows under our feet, Game defers that until
+    # after the step (see commands.CommandBuffer).
+    handled = self._begin_contacts(pairs, hits)
+    pair_impulses = self._solve_circles(*pairs)
+    hit_impulses = self._solve_walls(*hits)
+    self._end_contacts(handled, pairs, hits, pair_impulses, hit_impulses)
+    if self.contact_handlers:
+      self._record_contacts(pairs, hits, pair_impulses, hit_impulses)
+      self.deliver_contacts()
+    if self.wrap_bounds:
+      self._wrap()
+    self._write_kinematic()
+    self.cells = None
+
+  def _move_kinematic_walls(self, dt):
+    """Walls live in their bodies, the few kinematic ones get moved there."""
+    for index, obj in enumerate(self.walls):
+      body = obj.body
+      if obj not in self.kinematic or not (body.velocity or body.angular_velocity):
+        continue
+      x, y = body.position
+      vx, vy = body.velocity
+      body.position = (x + vx * dt, y + vy * dt)
+      body.angle += body.angular_velocity * dt
+      self._read_wall(index)
+
+  def _write_kinematic(self):
+    """Kinematic rows go straight back into their bodies, game code steers
+    those off their body state between steps (see pre_step())."""
+    for obj in self.kinematic:
+      self._write_body(obj)
+
+  def _write_body(self, obj):
+    """Copy obj's row into its body, for when game code is about to look."""
+    row = self.row_of.get(obj)
+    if row is None or obj.body.body_type == pymunk.Body.STATIC:
+      return
+    body = obj.body
+    body.position = tuple(self.position[row])
+    body.velocity = tuple(self.velocity[row])
+    body.angle = float(self.angle[row])
+    body.angular_velocity = float(self.angular_velocity[row])
+
+  def _wrap(self):
+    """Move every row that left the wrap bounds back in on the other side.
+    Static rows stay put, same as with pymunk."""
+    n = self.count
+    movable = self.dynamic[:n].copy()
+    movable[[self.row_of[obj] for obj in self.kinematic if obj in self.row_of]] = True
+    rows = np.flatnonzero(movable)
+    self.position[rows] = self.wrapped(self.position[rows])
+
+  def _delta(self, i, j):
+    """position[j] - position[i], the short way round when wrapping."""
+    delta = self.position[j] - self.position[i]
+    if self.wrap_bounds:
+      left, bottom, right, top = self.wrap_bounds
+      size = np.array((right - left, top - bottom))
+      delta -= size * np.round(delta / size)
+    return delta
+
+  def _candidate_pairs(self, cell_size):
+    """grid_pairs over the rows, plus their wrap ghosts if we have those."""
+    n = self.count
+    position = self.position[:n]
+    if not self.wrap_ghosts:
+      return spatial.grid_pairs(position, cell_size)
+
+    # Own radius plus the biggest partner's, indexed by type_id (the last
+    # one's for type_id -1, which could be anything).
+    classes = sorted(self.type_ids, key=self.type_ids.get)
+    reach = np.array([self.partner_reach(cls) for cls in classes] + [max(self.largest_radius.values(), default=0.0)])
+    ghosts = self.wrap_offsets(position, self.radius[:n] + reach[self.type_id[:n]])
+    if not ghosts:
+      return spatial.grid_pairs(position, cell_size)
+    ghost_rows = np.array([row for row, _ in ghosts], dtype=np.intp)
+    ghost_offsets = np.array([offset for _, offset in ghosts])
+    owner = np.concatenate((np.arange(n), ghost_rows))
+    i, j = spatial.grid_pairs(np.concatenate((position, position[ghost_rows] + ghost_offsets)), cell_size)
+    i, j = owner[i], owner[j]
+    # Back to real rows: drop things meeting their own ghost, and pairs that
+    # were found both directly and across a seam.
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    keys = np.unique(i[i != j].astype(np.int64) * n + j[i != j])
+    return (keys // n).astype(np.intp), (keys % n).astype(np.intp)
+
+  def _circle_contacts(self):
+    """Returns (i, j, keep) arrays for every pair of overlapping circles that
+    are allowed to collide."""
+    n = self.count
+    if n < 2:
+      empty = np.empty(0, dtype=np.intp)
+      return empty, empty, np.empty(0, dtype=bool)
+
+    radius = self.radius[:n]
+    i, j = self._candidate_pairs(2 * radius.max())
+
+    type_id = self.type_id[:n]
+    dynamic = self.dynamic[:n]
+    # Two things that can't move never collide, same as pymunk.
+    allowed = self.categories.matrix[type_id[i], type_id[j]] & (dynamic[i] | dynamic[j])
+    i, j = i[allowed], j[allowed]
+
+    delta = self._delta(i, j)
+    reach = radius[i] + radius[j]
+    touching = (delta * delta).sum(axis=1) < reach * reach
+    i, j = i[touching], j[touching]
+    return i, j, np.ones(len(i), dtype=bool)
+
+  def _wall_contacts(self):
+    """Returns (circle rows, wall indices, keep) for circles touching walls."""
+    n = self.count
+    if not n or not len(self.walls):
+      empty = np.empty(0, dtype=np.intp)
+      return empty, empty, np.empty(0, dtype=bool)
+
+    distance = self._wall_distances(np.arange(n), None)[0]
+    reach = self.radius[:n, None] + self.seg_radius[None, :]
+    allowed = self.categories.matrix[self.type_id[:n, None], self.seg_type_id[None, :]]
+    rows, walls = np.nonzero(allowed & (distance < reach))
+    return rows, walls, np.ones(len(rows), dtype=bool)
+
+  def _wall_distances(self, rows, walls):
+    """Distance and unit normal (wall towards circle) for circle rows vs
+    walls. With walls=None it's every row against every wall, shaped (n, S)."""
+    point = self.position[rows]
+    if walls is None:
+      return spatial.point_segment_distances(point[:, None, :], self.seg_a[None, :, :], self.seg_b[None, :, :])
+    return spatial.point_segment_distances(point, self.seg_a[walls], self.seg_b[walls])
+
+  def _scatter_add(self, target, rows, values):
+    """target[rows] += values, with repeated rows adding up. Both columns
+    in one bincount over the flattened (n, 2) array."""
+    flat = (2 * rows[:, None] + (0, 1)).ravel()
+    target += np.bincount(flat, values.ravel(), minlength=2 * self.count).reshape(-1, 2)
+
+  def _solve_circles(self, i, j, keep):
+    """Push overlapping circles apart and bounce them off each other.
+    Returns the normal impulse of the first pass for each contact."""
+    impulses = np.zeros(len(keep))
+    i, j = i[keep], j[keep]
+    if not len(i):
+      return impulses
+    n = self.count
+    position = self.position[:n]
+    velocity = self.velocity[:n]
+    inv_mass_i = self.inv_mass[i]
+    inv_mass_j = self.inv_mass[j]
+    inv_mass_sum = inv_mass_i + inv_mass_j
+    movable = inv_mass_sum > 0
+    inv_mass_sum[~movable] = 1.0
+    restitution = 1 + self.elasticity[i] * self.elasticity[j]
+    reach = self.radius[i] + self.radius[j]
+    both = np.concatenate((i, j))
+
+    for iteration in range(self.ITERATIONS):
+      delta = self._delta(i, j)
+      distance = np.sqrt((delta * delta).sum(axis=1))
+      normal = delta / np.maximum(distance, 1e-9)[:, None]
+      normal[distance == 0] = (1.0, 0.0)
+      overlap = np.where(movable, np.maximum(reach - distance, 0.0), 0.0)
+
+      # Jacobi style, every contact pushes at once. Only go most of the way
+      # each pass so piles don't explode.
+      correction = normal * (0.8 * overlap / inv_mass_sum)[:, None]
+      self._scatter_add(position, both, np.concatenate((-correction * inv_mass_i[:, None], correction * inv_mass_j[:, None])))
+
+      closing = ((velocity[j] - velocity[i]) * normal).sum(axis=1)
+      impulse = np.where((closing < 0) & (overlap > 0), -restitution * closing / inv_mass_sum, 0.0)
+      impulse_vector = normal * impulse[:, None]
+      self._scatter_add(velocity, both, np.concatenate((-impulse_vector * inv_mass_i[:, None], impulse_vector * inv_mass_j[:, None])))
+      if iteration == 0:
+        impulses[keep] = impulse
+
+    return impulses
+
+  def _solve_walls(self, rows, walls, keep):
+    """Push circles out of walls and bounce them off. Walls don't move.
+    Returns the normal impulse for each contact."""
+    rows, walls = rows[keep], walls[keep]
+    dynamic = self.dynamic[rows]
+    rows, walls = rows[dynamic], walls[dynamic]
+    impulses = np.zeros(len(keep))
+    if not len(rows):
+      return impulses
+
+    distance, normal = self._wall_distances(rows, walls)
+    overlap = np.maximum(self.radius[rows] + self.seg_radius[walls] - distance, 0.0)
+    self._scatter_add(self.position[:self.count], rows, normal * overlap[:, None])
+
+    velocity = self.velocity[:self.count]
+    closing = (velocity[rows] * normal).sum(axis=1)
+    restitution = 1 + self.elasticity[rows] * self.seg_elasticity[walls]
+    bounce = np.where(closing < 0, -restitution * closing, 0.0)
+
+    # Friction eats into the sliding velocity, at most all of it.
+    tangent = velocity[rows] - normal * closing[:, None]
+    speed = np.sqrt((tangent * tangent).sum(axis=1))
+    friction = self.friction[rows] * self.seg_friction[walls] * bounce
+    slow_down = np.minimum(friction / np.maximum(speed, 1e-9), 1.0)
+    self._scatter_add(velocity, rows, normal * bounce[:, None] - tangent * slow_down[:, None])
+
+    impulses[np.flatnonzero(keep)[dynamic]] = bounce / np.maximum(self.inv_mass[rows], 1e-12)
+    return impulses
+
+  def _begin_contacts(self, pairs, hits):
+    """Run begin/pre_solve handlers for the contacts whose classes have any.
+    Contacts that get rejected are switched off in the pairs/hits keep masks.
+
+    Returns a list of (key, obj_a, obj_b, is_pair, index, first, post_solve)
+    for the handled ones that were kept, where is_pair says if index is into
+    pairs or hits. Only contacts that actually get a handler call cost more
+    than a dict lookup."""
+    handled = []
+    i, j, pair_keep = pairs
+    for a_ids, b_ids, a_objects, b_objects, rows_a, rows_b, keep in (
+        (self.type_id[i], self.type_id[j], self.row_objects, self.row_objects, i, j, pair_keep),
+        (self.type_id[hits[0]], self.seg_type_id[hits[1]], self.row_objects, self.walls, hits[0], hits[1], hits[2])):
+      index = np.flatnonzero(self.handled[a_ids, b_ids])
+      a_ids, b_ids = a_ids[index], b_ids[index]
+      handled.extend(zip(
+          [a_objects[row] for row in rows_a[index].tolist()],
+          [b_objects[row] for row in rows_b[index].tolist()],
+          itertools.repeat(keep), index.tolist(),
+          self.phases['begin'][a_ids, b_ids].tolist(),
+          self.phases['pre_solve'][a_ids, b_ids].tolist(),
+          self.phases['post_solve'][a_ids, b_ids].tolist()))
+
+    contacts = []
+    for obj_a, obj_b, keep, index, begin, pre_solve, post_solve in handled:
+      key = (obj_a.handle, obj_b.handle)
+      if key in self.ignored:
+        keep[index] = False
+        continue
+      first = key not in self.touching
+      self.touching[key] = (obj_a, obj_b)
+      if first and begin and not self._call_handlers(obj_a, obj_b, 'begin', None, 0.0, 0.0, True):
+        self.ignored.add(key)
+        keep[index] = False
+        continue
+      if pre_solve and not self._call_handlers(obj_a, obj_b, 'pre_solve', None, 0.0, 0.0, first):
+        keep[index] = False
+        continue
+      contacts.append((key, obj_a, obj_b, keep is pair_keep, index, first, post_solve))
+    return contacts
+
+  def _call_handlers(self, obj_a, obj_b, phase, normal, impulse, ke, first):
+    """call_handlers(), with both bodies brought up to date first, since
+    handlers get to see (and change, we read them back after the step) them."""
+    for obj in (obj_a, obj_b):
+      if obj not in self.handed:
+        self._write_body(obj)
+        self.handed[obj] = None
+    return self.call_handlers(obj_a, obj_b, phase, normal, impulse, ke, first)
+
+  def _end_contacts(self, contacts, pairs, hits, pair_impulses, hit_impulses):
+    """Run post_solve handlers, then separate for the pairs that stopped
+    touching, then read back whatever the handlers were handed."""
+    # The solver just moved whatever begin/pre_solve saw, again.
+    for obj in self.handed:
+      self._write_body(obj)
+
+    post_solve = [contact for contact in contacts if contact[6]]
+    if post_solve:
+      is_pair = np.array([contact[3] for contact in post_solve], dtype=bool)
+      index = np.array([contact[4] for contact in post_solve], dtype=np.intp)
+      normal = np.zeros((len(post_solve), 2))
+      impulse = np.zeros(len(post_solve))
+      inv_mass_sum = np.zeros(len(post_solve))
+      i, j, _ = pairs
+      rows, walls, _ = hits
+      pair_index, hit_index = index[is_pair], index[~is_pair]
+      normal[is_pair] = self._delta(i[pair_index], j[pair_index])
+      impulse[is_pair] = pair_impulses[pair_index]
+      inv_mass_sum[is_pair] = self.inv_mass[i[pair_index]] + self.inv_mass[j[pair_index]]
+      if len(hit_index):
+        normal[~is_pair] = -self._wall_distances(rows[hit_index], walls[hit_index])[1]
+      impulse[~is_pair] = hit_impulses[hit_index]
+      inv_mass_sum[~is_pair] = self.inv_mass[rows[hit_index]]
+      normal /= np.maximum(np.sqrt((normal * normal).sum(axis=1)), 1e-9)[:, None]
+      ke = 0.5 * impulse * impulse * inv_mass_sum
+      for (_, obj_a, obj_b, _, _, first, _), (x, y), contact_impulse, contact_ke in zip(
+          post_solve, normal.tolist(), impulse.tolist(), ke.tolist()):
+        contact_normal = pymunk.Vec2d(x, y)
+        self._call_handlers(
+            obj_a, obj_b, 'post_solve', contact_normal, contact_normal * contact_impulse, contact_ke, first)
+
+    # Rejected contacts still count as touching until they stop overlapping.
+    current = {contact[0] for contact in contacts}
+    current.update(self.ignored)
+    separate = self.phases['separate']
+    for key in list(self.touching):
+      if key in current:
+        continue
+      obj_a, obj_b = self.touching.pop(key)
+      self.ignored.discard(key)
+      if separate[self.type_ids.get(type(obj_a), -1), self.type_ids.get(type(obj_b), -1)]:
+        self._call_handlers(obj_a, obj_b, 'separate', None, 0.0, 0.0, False)
+
+    self.untouched.update(self.handed)
+    self.handed.clear()
+
+  def _record_contacts(self, pairs, hits, pair_impulses, hit_impulses):
+    """Record the contacts that batch handlers care about, straight from the
+    contact arrays."""
+    slot_mask = registry.ObjectRegistry.SLOT_MASK
+
+    i, j, keep = pairs
+    pick = keep & self.batched[self.type_id[i], self.type_id[j]]
+    i, j, impulse = i[pick], j[pick], pair_impulses[pick]
+    a_handle, b_handle = self.handle[i], self.handle[j]
+    keys = ((a_handle & slot_mask) << 32) | (b_handle & slot_mask)
+    first = ~np.isin(keys, self.batched_pair_keys)
+    self.batched_pair_keys = keys
+    delta = self._delta(i, j)
+    normal = delta / np.maximum(np.sqrt((delta * delta).sum(axis=1)), 1e-9)[:, None]
+    ke = 0.5 * impulse * impulse * (self.inv_mass[i] + self.inv_mass[j])
+    self.record_contacts(
+        a_handle, self.type_id[i], b_handle, self.type_id[j],
+        normal, normal * impulse[:, None], ke, first)
+
+    rows, walls, keep = hits
+    pick = keep & self.batched[self.type_id[rows], self.seg_type_id[walls]]
+    rows, walls, impulse = rows[pick], walls[pick], hit_impulses[pick]
+    a_handle, b_handle = self.handle[rows], self.seg_handle[walls]
+    keys = ((a_handle & slot_mask) << 32) | (b_handle & slot_mask)
+    first = ~np.isin(keys, self.batched_hit_keys)
+    self.batched_hit_keys = keys
+    normal = -self._wall_distances(rows, walls)[1]
+    ke = 0.5 * impulse * impulse * self.inv_mass[rows]
+    self.record_contacts(
+        a_handle, self.type_id[rows], b_handle, self.seg_type_id[walls],
+        normal, normal * impulse[:, None], ke, first)
+
+  # Spatial queries, straight off the arrays. Circle rows come out of a
+  # cell index over their positions, built the first time something asks
+  # after a step, so a pile of bullets doesn't check every row. There's only
+  # a handful of walls, those get checked against everything.
+
+  def _cell_index(self):
+    """The rows' PointGrid, and how far past its cells a circle can reach."""
+    n = self.count
+    reach = float(self.radius[:n].max()) if n else 0.0
+    if self.cells is None:
+      self.cells = spatial.PointGrid(self.position[:n], max(2 * reach, 1.0))
+    return self.cells, reach
+
+  def _row_candidates(self, lows, highs):
+    """(box, row) for the circle rows that may overlap each box."""
+    cells, reach = self._cell_index()
+    return cells.query(np.asarray(lows) - reach, np.asarray(highs) + reach)
+
+  def _of_class(self, cls):
+    """Boolean masks saying which circle rows and walls are cls objects."""
+    self._read_untouched()  # Every query starts here, make sure it sees new stuff
+    n = self.count
+    if cls is None:
+      return np.ones(n, dtype=bool), np.ones(len(self.walls), dtype=bool)
+    allowed = np.zeros(len(self.type_ids) + 1, dtype=bool)  # Last one is type_id -1
+    for other_class, type_id in self.type_ids.items():
+      allowed[type_id] = issubclass(other_class, cls)
+    walls = np.array([isinstance(obj, cls) for obj in self.walls], dtype=bool)
+    return allowed[self.type_id[:n]], walls
+
+  def _row_distances(self, points, radius, rows_ok):
+    """(point, row, surface distance) for cls rows within radius of each
+    point."""
+    point, rows = self._row_candidates(points - radius, points + radius)
+    keep = rows_ok[rows]
+    point, rows = point[keep], rows[keep]
+    delta = self.position[rows] - points[point]
+    distance = np.sqrt((delta * delta).sum(axis=1)) - self.radius[rows]
+    keep = distance <= radius
+    return point[keep], rows[keep], distance[keep]
+
+  def _wall_surface_distances(self, points, walls_ok):
+    """Distance from each point to the surface of every wall, shaped
+    (points, walls), inf for non-cls walls."""
+    walls = spatial.point_segment_distances(points[:, None], self.seg_a[None], self.seg_b[None])[0]
+    walls -= self.seg_radius
+    walls[:, ~walls_ok] = np.inf
+    return walls
+
+  def _objects(self, rows, walls):
+    return [self.row_objects[row] for row in rows.tolist()] + [self.walls[wall] for wall in walls.tolist()]
+
+  def query_radius(self, point, radius, cls=None):
+    return self.query_radius_many([point], radius, cls)[0]
+
+  def query_radius_many(self, points, radius, cls=None):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    rows_ok, walls_ok = self._of_class(cls)
+    point, rows, _ = self._row_distances(points, radius, rows_ok)
+    order = np.lexsort((rows, point))
+    counts = np.bincount(point, minlength=len(points))
+    row_lists = np.split(rows[order], np.cumsum(counts)[:-1])
+    walls = self._wall_surface_distances(points, walls_ok)
+    return [
+        self._objects(point_rows, np.flatnonzero(wall_distances <= radius))
+        for point_rows, wall_distances in zip(row_lists, walls)]
+
+  def query_box(self, bb, cls=None):
+    left, bottom, right, top = bb
+    rows_ok, walls_ok = self._of_class(cls)
+    _, rows = self._row_candidates([(left, bottom)], [(right, top)])
+    position, radius = self.position[rows], self.radius[rows]
+    rows = np.sort(rows[rows_ok[rows] & (
+        (position[:, 0] + radius >= left) & (position[:, 0] - radius <= right)
+        & (position[:, 1] + radius >= bottom) & (position[:, 1] - radius <= top))])
+    low = np.minimum(self.seg_a, self.seg_b) - self.seg_radius[:, None]
+    high = np.maximum(self.seg_a, self.seg_b) + self.seg_radius[:, None]
+    walls = walls_ok & (
+        (high[:, 0] >= left) & (low[:, 0] <= right) & (high[:, 1] >= bottom) & (low[:, 1] <= top))
+    return self._objects(rows, np.flatnonzero(walls))
+
+  def nearest(self, point, cls=None, max_distance=math.inf):
+    points = np.asarray(point, dtype=np.float64).reshape(1, 2)
+    rows_ok, walls_ok = self._of_class(cls)
+    _, rows, distances = self._row_distances(points, max_distance, rows_ok)
+    walls = self._wall_surface_distances(points, walls_ok)[0]
+    best_row = distances.argmin() if len(rows) else None
+    best_wall = walls.argmin() if walls.size else None
+    row_distance = distances[best_row] if best_row is not None else math.inf
+    wall_distance = walls[best_wall] if best_wall is not None else math.inf
+    if (best_row is None and best_wall is None) or min(row_distance, wall_distance) > max_distance:
+      return None
+    if row_distance <= wall_distance:
+      return self.row_objects[rows[best_row]]
+    return self.walls[best_wall]
+
+  def _ray_alphas(self, starts, ends, radius, cls):
+    """Where the rays hit circle rows and walls (see spatial.py), as (ray,
+    row, alpha) arrays for the row hits, plus (wall alphas, wall normals)
+    shaped (rays, walls), plus the rays as (starts, deltas)."""
+    starts = np.asarray(starts, dtype=np.float64).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+    deltas = ends - starts
+    rows_ok, walls_ok = self._of_class(cls)
+    ray, rows = self._row_candidates(np.minimum(starts, ends) - radius, np.maximum(starts, ends) + radius)
+    keep = rows_ok[rows]
+    ray, rows = ray[keep], rows[keep]
+    alpha = spatial.ray_circle_alphas(starts[ray], deltas[ray], self.position[rows], self.radius[rows] + radius)
+    hit = np.isfinite(alpha)
+    walls, wall_normals = spatial.ray_capsule_alphas(
+        starts[:, None], deltas[:, None], self.seg_a[None], self.seg_b[None], self.seg_radius + radius)
+    walls[:, ~walls_ok] = np.inf
+    return (ray[hit], rows[hit], alpha[hit]), walls, wall_normals, starts, deltas
+
+  def _ray_hit(self, ray, alpha, row, wall, starts, deltas, wall_normals):
+    point = starts[ray] + deltas[ray] * alpha
+    if row is not None:
+      obj = self.row_objects[row]
+      normal = point - self.position[row]
+      normal /= max(np.sqrt((normal * normal).sum()), 1e-9)
+    else:
+      obj = self.walls[wall]
+      normal = wall_normals[ray, wall]
+    return RayHit(obj, pymunk.Vec2d(*point), pymunk.Vec2d(*normal), float(alpha))
+
+  def raycast(self, start, end, radius=0, cls=None):
+    (_, rows, alphas), walls, wall_normals, starts, deltas = self._ray_alphas([start], [end], radius, cls)
+    hits = [
+        self._ray_hit(0, alpha, row, None, starts, deltas, wall_normals)
+        for row, alpha in zip(rows.tolist(), alphas.tolist())]
+    hits.extend(
+        self._ray_hit(0, walls[0, wall], None, wall, starts, deltas, wall_normals)
+        for wall in np.flatnonzero(np.isfinite(walls[0])).tolist())
+    return sorted(hits, key=lambda hit: hit.alpha)
+
+  def raycast_first(self, start, end, radius=0, cls=None):
+    return self.raycast_many([start], [end], radius, cls)[0]
+
+  def raycast_many(self, starts, ends, radius=0, cls=None):
+    (ray, rows, alphas), walls, wall_normals, starts, deltas = self._ray_alphas(starts, ends, radius, cls)
+    count = len(starts)
+    # Each ray's closest row hit: sort by alpha within ray, take the first.
+    order = np.lexsort((alphas, ray))
+    rays_hit, first = np.unique(ray[order], return_index=True)
+    best_row = np.zeros(count, dtype=np.intp)
+    row_alpha = np.full(count, np.inf)
+    best_row[rays_hit] = rows[order[first]]
+    row_alpha[rays_hit] = alphas[order[first]]
+    best_wall = walls.argmin(axis=1) if walls.shape[1] else np.zeros(count, dtype=np.intp)
+    wall_alpha = walls[np.arange(count), best_wall] if walls.shape[1] else np.full(count, np.inf)
+
+    hits = []
+    for ray in range(count):
+      if row_alpha[ray] == wall_alpha[ray] == np.inf:
+        hits.append(None)
+      elif row_alpha[ray] <= wall_alpha[ray]:
+        hits.append(self._ray_hit(ray, row_alpha[ray], best_row[ray], None, starts, deltas, wall_normals))
+      else:
+        hits.append(self._ray_hit(ray, wall_alpha[ray], None, best_wall[ray], starts, deltas, wall_normals))
+    return hits
+
+
+class WorkerPhysics(PhysicsEngineBase):
+  """The pymunk engine, in a process of its own (see worker.py), so a slow
+  step doesn't hold up drawing and gets a CPU core to itself.
+
+  step() just queues the step and returns, and the worker runs it while the
+  game goes on drawing the last one. Body state comes back through shared
+  memory: sync_bodies() copies it into the objects' bodies (so sprites,
+  update() and the query helpers see it), and game code changing a body
+  gets sent over as a velocity change the next step. The game stays at most
+  `max_lag` steps behind the worker.
+
+  Collision handlers run here, once their step's contacts come back, which
+  means the worker can't wait for their answer: begin returning False
+  doesn't stop the collision, and pre_solve handlers aren't called at all.
+  Wrapping works, but without ghosts. Queries go through a SpatialGrid of
+  the synced bodies, like CheesyPhysics.
+  """
+
+  capacity = 1 << 16  # Registry slots the shared memory has room for
+  max_lag = 2  # Steps the worker may be ahead of what the game has seen
+
+  def init(self):
+    config = self.game.config
+    self.bindings = []  # (src class, dst class, phase, method)
+    handled = set()  # Collision type pairs the worker should report
+    for src_class in self.object_classes.values():
+      for dst_class in self.categories.partners[src_class]:
+        pair = tuple(sorted((src_class.collision_type, dst_class.collision_type)))
+        for phase in ['begin', 'pre_solve', 'post_solve', 'separate']:
+          method = getattr(src_class, f'collision_{dst_class.__name__}_{phase}', None)
+          if not method:
+            continue
+          if phase == 'pre_solve':
+            logging.warning(f'WorkerPhysics can\'t call {src_class.__name__}.{method.__name__}, pre_solve runs in the worker')
+            continue
+          logging.info(f'Collision handler method for {src_class.__name__} to {dst_class.__name__} {phase}')
+          self.bindings.append((src_class, dst_class, phase, method))
+          handled.add(pair)
+    for src_class, dst_class, _, _ in self.contact_handlers:
+      handled.add(tuple(sorted((src_class.collision_type, dst_class.collision_type))))
+    self.bind_collision_handlers()
+
+    settings = {
+        'gravity': (0, -config.gravity),
+        'iterations': config.iterations,
+        'collision_slop': config.collision_slop,
+        'sleep_time_threshold': config.sleep_time,
+        'idle_speed_threshold': config.idle_speed,
+        'threads': config.threads,
+        'spatial_hash': config.spatial_hash,
+    }
+    self._gravity = pymunk.Vec2d(*settings['gravity'])
+
+    # spawn, not fork: the child has no business with our window and GL state.
+    context = multiprocessing.get_context('spawn')
+    self.transforms = worker.SharedTransforms(self.capacity, context.Lock())
+    # Commands go over a pipe, all of a step's in one message. Results come
+    # back on a queue, so the worker never waits for us to read them.
+    commands_out, self.commands = context.Pipe(duplex=False)
+    self.results = context.Queue()
+    self.process = context.Process(
+        target=worker.run,
+        args=(self.transforms.name, self.capacity, self.transforms.lock,
+              commands_out, self.results, settings, sorted(handled)),
+        daemon=True)
+    self.process.start()
+    atexit.register(self.close)
+
+    self.outbox = []  # Commands for the next message to the worker
+    self.pending = 0  # Steps sent that haven't come back yet
+    self.untouched = set()  # Objects whose velocity game code changed
+    self.placed = set()  # Objects game code moved by hand
+    # Body state per slot as of the last sync_bodies(), NaN for never
+    self.synced = np.full((0, len(worker.FIELDS)), np.nan)
+    self.cell_size = config.grid_cell_size
+    self.grid = None
+
+  def bind_collision_handlers(self):
+    self.handlers = {}
+    for src_class, dst_class, phase, method in self.bindings:
+      self.handlers.setdefault(src_class, {}).setdefault(dst_class, {})[phase] = (
+          self.handler_for(src_class, dst_class, phase, method))
+
+  def close(self):
+    """Stop the worker and let go of the shared memory."""
+    if self.process is None:
+      return
+    if self.process.is_alive():
+      self.commands.send(self.outbox + [('stop',)])
+      self.process.join(timeout=1)
+    self.process = None
+    self.transforms.close()
+
+  def _slot(self, obj):
+    return obj.handle & registry.ObjectRegistry.SLOT_MASK
+
+  def _state(self, obj):
+    body = obj.body
+    x, y = body.position
+    vx, vy = body.velocity
+    return (obj.handle, x, y, body.angle, vx, vy, body.angular_velocity)
+
+  def add_object(self, obj):
+    super().add_object(obj)
+    slot = self._slot(obj)
+    if slot >= self.capacity:
+      raise Exception(f'WorkerPhysics has room for {self.capacity} objects, raise WorkerPhysics.capacity')
+    if slot >= len(self.synced):
+      grown = np.full((max(2 * len(self.synced), slot + 1, 256), len(worker.FIELDS)), np.nan)
+      grown[:len(self.synced)] = self.synced
+      self.synced = grown
+    self.synced[slot] = self._state(obj)
+    if self.grid is not None:
+      self.grid.insert(obj, spatial.object_bb(obj))
+
+    filter = self.categories.filter_for(type(obj))
+    for shape in obj.shapes.values():
+      shape.filter = filter
+      shape.collision_type = type(obj).collision_type
+    self.outbox.append(('add', obj.handle, worker.body_spec(obj)))
+
+  def remove_object(self, obj):
+    self.outbox.append(('remove', obj.handle))
+    self.synced[self._slot(obj)] = np.nan
+    super().remove_object(obj)
+    if self.grid is not None:
+      self.grid.remove(obj)
+    self.untouched.discard(obj)
+    self.placed.discard(obj)
+
+  def touch(self, obj):
+    self.untouched.add(obj)
+
+  def reindex(self, objs):
+    self.placed.update(objs)
+    self._update_grid(objs)
+
+  def _update_grid(self, objs):
+    if self.grid is not None:
+      for obj in objs:
+        self.grid.update(obj, spatial.object_bb(obj))
+
+  def query_candidates(self, bb):
+    if self.grid is None:
+      bbs = {obj: spatial.object_bb(obj) for obj in self.objects}
+      self.grid = spatial.SpatialGrid(self.cell_size or spatial.pick_cell_size(bbs.values()))
+      for obj, obj_bb in bbs.items():
+        self.grid.insert(obj, obj_bb)
+    return self.grid.query(bb)
+
+  def set_body_type(self, obj, body_type, mass=None, moment=None):
+    super().set_body_type(obj, body_type, mass, moment)
+    self.outbox.append(('set_body_type', obj.handle, body_type, mass, moment))
+    self.synced[self._slot(obj)] = self._state(obj)
+    self.untouched.discard(obj)
+
+  def set_wrap(self, bounds, ghosts=False):
+    if ghosts:
+      logging.warning('WorkerPhysics has no wrap ghosts, things will pass through each other at the seams')
+    super().set_wrap(bounds)
+    self.outbox.append(('wrap', self.wrap_bounds))
+
+  @property
+  def gravity(self):
+    return self._gravity
+
+  @gravity.setter
+  def gravity(self, gravity):
+    self._gravity = pymunk.Vec2d(*gravity)
+    self.outbox.append(('gravity', tuple(self._gravity)))
+
+  def step(self, dt):
+    # Game side changes first. Velocities go over as the change since we
+    # last wrote or sent them, so we don't undo the steps the worker has
+    # done since, or send the same change twice.
+    for obj in self.placed:
+      if not obj.deleted:
+        self.outbox.append(('place', obj.handle, tuple(obj.body.position), obj.body.angle))
+    self.placed.clear()
+    for obj in self.untouched:
+      if obj.deleted:
+        continue
+      body = obj.body
+      row = self.synced[self._slot(obj)]
+      _, _, _, _, vx, vy, angular_velocity = row
+      change = (body.velocity.x - vx, body.velocity.y - vy)
+      spin = body.angular_velocity - angular_velocity
+      if change != (0, 0) or spin:
+        self.outbox.append(('nudge', obj.handle, change, spin))
+        row[4:] = (body.velocity.x, body.velocity.y, body.angular_velocity)
+    self.untouched.clear()
+
+    self.outbox.append(('step', dt))
+    self.commands.send(self.outbox)
+    self.outbox = []
+    self.pending += 1
+
+    # Deal with whatever steps are done, and wait for the worker if it's
+    # too far ahead of us.
+    while self.pending:
+      try:
+        result = self.results.get(block=self.pending > self.max_lag, timeout=5)
+      except queue.Empty:
+        if self.pending > self.max_lag:
+          raise Exception('The physics worker stopped answering')
+        break
+      if result is None:
+        raise Exception('The physics worker died, see its log output')
+      self.pending -= 1
+      self._deliver(*result)
+
+  def _deliver(self, steps, events):
+    """Run the handlers for one step's contacts."""
+    get = self.registry.get
+    batched = []
+    with self.game.commands.deferred():
+      for phase, handle_a, handle_b, nx, ny, ix, iy, ke, first in events:
+        obj_a, obj_b = get(handle_a), get(handle_b)
+        if obj_a is None or obj_b is None or obj_a.deleted or obj_b.deleted:
+          continue
+        if phase == 'post_solve' and self.contact_handlers:
+          batched.append((obj_a, obj_b, nx, ny, ix, iy, ke, first))
+        self.call_handlers(obj_a, obj_b, phase, pymunk.Vec2d(nx, ny), pymunk.Vec2d(ix, iy), ke, first)
+
+    if batched:
+      class_ids = self.class_ids
+      columns = list(zip(*batched))
+      self.record_contacts(
+          np.array([obj.handle for obj in columns[0]], dtype=np.int64),
+          np.array([class_ids.get(type(obj), -1) for obj in columns[0]]),
+          np.array([obj.handle for obj in columns[1]], dtype=np.int64),
+          np.array([class_ids.get(type(obj), -1) for obj in columns[1]]),
+          normal=np.array(columns[2:4]).T,
+          impulse=np.array(columns[4:6]).T,
+          total_ke=np.array(columns[6]),
+          first_contact=np.array(columns[7], dtype=bool))
+      self.deliver_contacts()
+
+  def sync_bodies(self):
+    rows, _ = self.transforms.begin_read()
+    try:
+      # Rows still holding an old object of that slot (the worker hasn't
+      # caught up yet) don't count.
+      count = min(len(self.synced), self.capacity)
+      state = rows[:count]
+      synced = self.synced[:count]
+      changed = np.flatnonzero((state[:, 0] == synced[:, 0]) & (state != synced).any(axis=1))
+      self.synced[changed] = state[changed]
+    finally:
+      self.transforms.end_read()
+
+    moved = []
+    get = self.registry.get
+    for handle, x, y, angle, vx, vy, angular_velocity in self.synced[changed].tolist():
+      obj = get(int(handle)) if handle >= 0 else None
+      if obj is None:
+        continue
+      body = obj.body
+      body.position = (x, y)
+      body.angle = angle
+      if body.body_type != pymunk.Body.STATIC:
+        body.velocity = (vx, vy)
+        body.angular_velocity = angular_velocity
+      moved.append(obj)
+    self._update_grid(moved)
+    return moved
 
 
 # Dict of all our physics engines
 IMPLEMENTATIONS = {
     'cheesy': CheesyPhysics,
     'pymunk': PymunkPhysics,
+    'vectorized': VectorizedPhysics,
+    'worker': WorkerPhysics,
 }
@@ -0,0 +1,177 @@
+import logging
+
+import numpy as np
+import pyglet
+import pymunk
+
+import contacts
+import physics
+
+
+class ProjectileHit:
+  """Stand-in for the GameObject a collision handler expects on the other end
+  of a projectile hit. Only made when something actually gets hit, flying
+  projectiles are just rows in ProjectileSystem's arrays.
+
+  Handlers can do the usual with it: check .deleted, and .delete() it.
+  """
+
+  def __init__(self, point, velocity, radius):
+    self.deleted = False
+    self.body = pymunk.Body(body_type=pymunk.Body.KINEMATIC)
+    self.body.position = point
+    self.body.velocity = velocity
+    self.shapes = {'body': pymunk.Circle(self.body, radius)}
+    self.body.game_object = self
+    self.shapes['body'].game_object = self
+
+  def delete(self):
+    self.deleted = True
+
+
+class ProjectileSystem:
+  """Fast, short lived things like bullets, without a pymunk body each.
+
+  Projectiles live in flat numpy arrays. Every physics step each one gets
+  swept from where it was to where it's going with one batched raycast
+  (physics.raycast_many), so they can't tunnel through things no matter how
+  fast they are. Hits are reported to the same collision_<cls>_* handlers a
+  real `cls` object would trigger, and stop the projectile unless begin
+  says no. All of them are drawn as streaks in a single vertex list.
+
+  `cls` is the GameObject class these pretend to be (e.g. Bullet), it's only
+  used for its name and collides_with, never instantiated.
+  """
+
+  def __init__(self, game, cls, radius=4, color=(255, 255, 200), streak=0.015, batch=None):
+    self.game = game
+    self.cls = cls
+    self.batch = batch or game.main_batch
+    self.radius = radius
+    self.color = color
+    self.streak = streak  # Seconds of travel each streak shows
+    self.time = 0.0
+    self.count = 0
+    self.capacity = 0
+    self.position = self.velocity = self.expires = None
+    self._grow(64)
+
+    # Who we hit, and what to call when we do. Both sides have to list each
+    # other in collides_with, same as for real objects.
+    self.handlers = []  # (target class, src class, dst class, phase, method)
+    targets = []
+    for target in game.physics.categories.partners[cls]:
+      targets.append(target)
+      for phase in ['begin', 'pre_solve', 'post_solve', 'separate']:
+        for src, dst in ((target, cls), (cls, target)):
+          method = getattr(src, f'collision_{dst.__name__}_{phase}', None)
+          if method:
+            logging.info(f'Projectile handler method for {src.__name__} to {dst.__name__} {phase}')
+            self.handlers.append((target, src, dst, phase, method))
+    self.targets = tuple(targets)
+    self.vertex_list = None
+
+  def __len__(self):
+    return self.count
+
+  def _grow(self, capacity):
+    def resized(array, shape):
+      new = np.zeros(shape)
+      if array is not None:
+        new[:self.count] = array[:self.count]
+      return new
+    self.position = resized(self.position, (capacity, 2))
+    self.velocity = resized(self.velocity, (capacity, 2))
+    self.expires = resized(self.expires, (capacity,))
+    self.capacity = capacity
+
+  def fire(self, position, velocity, lifespan=0.5):
+    if self.count == self.capacity:
+      self._grow(self.capacity * 2)
+    index = self.count
+    self.position[index] = position
+    self.velocity[index] = velocity
+    self.expires[index] = self.time + lifespan
+    self.count += 1
+
+  def _keep(self, alive):
+    """Drop every projectile that isn't alive, keeping the rest in order."""
+    count = int(alive.sum())
+    self.position[:count] = self.position[:self.count][alive]
+    self.velocity[:count] = self.velocity[:self.count][alive]
+    self.expires[:count] = self.expires[:self.count][alive]
+    self.count = count
+
+  def step(self, dt):
+    self.time += dt
+    if not self.count:
+      return
+
+    alive = self.expires[:self.count] > self.time
+    starts = self.position[:self.count]
+    ends = starts + self.velocity[:self.count] * dt
+    if self.targets:
+      hits = self.game.physics.raycast_many(starts, ends, radius=self.radius, cls=self.targets)
+      for index, hit in enumerate(hits):
+        if hit is not None and alive[index]:
+          alive[index] = not self._hit(index, hit)
+
+    starts[:] = ends
+    if self.game.physics.wrap_bounds:
+      starts[:] = self.game.physics.wrapped(starts)
+    self._keep(alive)
+
+  def _hit(self, index, hit):
+    """Run the handlers for projectile `index` hitting hit.obj, like a one
+    step pymunk contact. Returns True if the projectile is done for."""
+    target = hit.obj
+    proxy = ProjectileHit(hit.point, tuple(self.velocity[index]), self.radius)
+    accepted = self._call(target, proxy, 'begin', hit)
+    if accepted:
+      accepted = self._call(target, proxy, 'pre_solve', hit)
+    if accepted:
+      self._call(target, proxy, 'post_solve', hit)
+    self._call(target, proxy, 'separate', hit)
+    return accepted or proxy.deleted
+
+  def _call(self, target, proxy, phase, hit):
+    accept = True
+    for target_class, src, dst, handler_phase, method in self.handlers:
+      if handler_phase != phase or not isinstance(target, target_class):
+        continue
+      # Shapes go (src, dst), and the normal points from src to dst.
+      if src is self.cls:
+        src_obj, dst_obj = proxy, target
+        normal = -hit.normal
+      else:
+        src_obj, dst_obj = target, proxy
+        normal = hit.normal
+      arbiter = physics.Arbiter(
+          shapes=(src_obj.shapes['body'], dst_obj.shapes['body']),
+          normal=normal,
+          total_impulse=pymunk.Vec2d(0, 0),
+          total_ke=0.0,
+          is_first_contact=True)
+      method = self.game.physics.handler_for(src, dst, phase, method)
+      if method(contacts.Contact(src_obj, dst_obj, self.game, arbiter)) is False:
+        accept = False
+    return accept
+
+  def sync(self):
+    """Update the streaks, Game calls this once per frame."""
+    needed = max(self.capacity, 1) * 2
+    if self.vertex_list is None:
+      self.vertex_list = self.batch.add(
+          needed, pyglet.gl.GL_LINES, None,
+          ('v2f/stream', [0.0] * needed * 2),
+          ('c3B/static', self.color * needed))
+    elif len(self.vertex_list.vertices) < needed * 2:
+      self.vertex_list.resize(needed)
+      self.vertex_list.colors[:] = self.color * needed
+
+    # Unused slots become zero length lines, which don't draw.
+    vertices = np.zeros((len(self.vertex_list.vertices) // 4, 2, 2))
+    count = self.count
+    vertices[:count, 0] = self.position[:count] - self.velocity[:count] * self.streak
+    vertices[:count, 1] = self.position[:count]
+    self.vertex_list.vertices[:] = vertices.ravel().tolist()
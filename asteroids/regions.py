@@ -0,0 +1,180 @@
+import logging
+import math
+
+import numpy as np
+
+import physics
+
+
+class RegionSystem:
+  """Only simulate the part of a big world that's around the camera.
+
+  The world is cut into regions `region_size` across (a number for squares,
+  or a (width, height) pair). Objects of `classes` in regions more than
+  `radius` + 1 regions away from `focus()` (a function returning a world
+  position, like the middle of the screen) get packed away: taken out of the
+  game, physics and all, and kept as a row in a few numpy arrays. Packed
+  rows keep drifting along their velocity, without colliding with anything,
+  and come back as real objects once they're within `radius` regions of the
+  focus again. The ring in between is there so things on a region edge don't
+  flip back and forth.
+
+  So the physics only ever has the neighbourhood of the focus to deal with,
+  however big the world is. With wrapping turned on (physics.set_wrap()) the
+  regions wrap around with it.
+
+  Packed objects come back as cls(x=x, y=y) with their sprite scale, angle
+  and velocities restored, so only give it classes that's enough for (like
+  the asteroids example's Asteroid). Everything else about them is lost.
+  Nothing collides with packed rows, so something can be sitting where one
+  comes back (the ship, or another packed row). Those stay packed, coasting
+  along, until their spot is clear on a later check.
+
+  It's a game system, Game calls step(dt) after every physics step. It
+  doesn't draw anything, so there's no sync().
+  """
+
+  check_interval = 0.25  # Seconds between looks at what to pack and unpack
+
+  def __init__(self, game, classes, region_size, focus, radius=1):
+    self.game = game
+    self.classes = tuple(classes)
+    self.region_size = np.broadcast_to(np.asarray(region_size, dtype=np.float64), (2,))
+    self.focus = focus
+    self.radius = radius
+    self.views = [game.physics.registry.view(cls) for cls in self.classes]
+    self.count = 0
+    self.capacity = 0
+    self.kind = self.position = self.angle = self.velocity = self.angular_velocity = self.scale = None
+    self.reach = None  # physics.bounding_radius() of each packed object
+    self._grow(256)
+    self.since_check = self.check_interval  # Sort things out on the first step
+
+  def __len__(self):
+    return self.count
+
+  @property
+  def active_count(self):
+    return sum(len(view) for view in self.views)
+
+  def _grow(self, capacity):
+    def resized(array, shape, dtype=np.float64):
+      new = np.zeros(shape, dtype=dtype)
+      if array is not None:
+        new[:self.count] = array[:self.count]
+      return new
+    self.kind = resized(self.kind, (capacity,), np.intp)
+    self.position = resized(self.position, (capacity, 2))
+    self.angle = resized(self.angle, (capacity,))
+    self.velocity = resized(self.velocity, (capacity, 2))
+    self.angular_velocity = resized(self.angular_velocity, (capacity,))
+    self.scale = resized(self.scale, (capacity,))
+    self.reach = resized(self.reach, (capacity,))
+    self.capacity = capacity
+
+  def _region_counts(self):
+    """How many regions the wrap bounds are across and up, None if the
+    world doesn't wrap."""
+    bounds = self.game.physics.wrap_bounds
+    if not bounds:
+      return None
+    left, bottom, right, top = bounds
+    width, height = self.region_size
+    return np.array((
+        max(math.ceil((right - left) / width), 1),
+        max(math.ceil((top - bottom) / height), 1)))
+
+  def _distances(self, positions):
+    """How many regions away from the focus region each position is, the
+    short way round when wrapping."""
+    size = self.region_size
+    focus = np.floor(np.asarray(self.focus(), dtype=np.float64) / size)
+    offsets = np.abs(np.floor(positions / size) - focus)
+    counts = self._region_counts()
+    if counts is not None:
+      offsets %= counts
+      offsets = np.minimum(offsets, counts - offsets)
+    return offsets.max(axis=1)
+
+  def step(self, dt):
+    self.since_check += dt
+    if self.since_check < self.check_interval:
+      return
+    elapsed, self.since_check = self.since_check, 0.0
+
+    # Packed rows coast along.
+    n = self.count
+    if n:
+      self.position[:n] += self.velocity[:n] * elapsed
+      self.angle[:n] += self.angular_velocity[:n] * elapsed
+      if self.game.physics.wrap_bounds:
+        self.position[:n] = self.game.physics.wrapped(self.position[:n])
+
+    packed = self._pack()
+    unpacked = self._unpack()
+    if packed or unpacked:
+      logging.debug(f'RegionSystem: packed {packed}, unpacked {unpacked}, {self.count} packed and {self.active_count} active')
+
+  def _pack(self):
+    objs = [obj for view in self.views for obj in view if not obj.deleted]
+    if not objs:
+      return 0
+    positions = np.array([tuple(obj.body.position) for obj in objs])
+    far = np.flatnonzero(self._distances(positions) > self.radius + 1)
+    if not len(far):
+      return 0
+
+    needed = self.count + len(far)
+    if needed > self.capacity:
+      capacity = self.capacity
+      while capacity < needed:
+        capacity *= 2
+      self._grow(capacity)
+    kinds = {cls: index for index, cls in enumerate(self.classes)}
+    for row, index in enumerate(far.tolist(), start=self.count):
+      obj = objs[index]
+      body = obj.body
+      self.kind[row] = next(kinds[cls] for cls in type(obj).__mro__ if cls in kinds)
+      self.position[row] = positions[index]
+      self.angle[row] = body.angle
+      self.velocity[row] = tuple(body.velocity)
+      self.angular_velocity[row] = body.angular_velocity
+      self.scale[row] = obj.scale
+      self.reach[row] = max(physics.bounding_radius(shape) for shape in obj.shapes.values())
+      obj.delete()
+    self.count = needed
+    return len(far)
+
+  def _unpack(self):
+    n = self.count
+    if not n:
+      return 0
+    near = np.flatnonzero(self._distances(self.position[:n]) <= self.radius)
+    back = np.zeros(n, dtype=bool)
+    placed = []  # (position, reach) of rows coming back now, the spawns aren't in the physics until the step's done
+    for row in near.tolist():
+      position, reach = self.position[row], self.reach[row]
+      if self.game.physics.query_radius(tuple(position.tolist()), reach):
+        continue
+      if any(np.hypot(*(position - other)) < reach + other_reach for other, other_reach in placed):
+        continue
+      placed.append((position, reach))
+      back[row] = True
+
+      x, y = position.tolist()
+      obj = self.classes[self.kind[row]](x=x, y=y)
+      obj.scale = float(self.scale[row])
+      body = obj.body
+      body.angle = float(self.angle[row])
+      body.velocity = tuple(self.velocity[row].tolist())
+      body.angular_velocity = float(self.angular_velocity[row])
+      obj.rotation = math.degrees(-body.angle) + 180
+      self.game.add_object(obj)
+
+    if placed:
+      keep = ~back
+      count = int(keep.sum())
+      for array in (self.kind, self.position, self.angle, self.velocity, self.angular_velocity, self.scale, self.reach):
+        array[:count] = array[:n][keep]
+      self.count = count
+    return len(placed)
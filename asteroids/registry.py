@@ -0,0 +1,115 @@
+class ObjectRegistry:
+  """O(1) bookkeeping for every object in the physics engine.
+
+  Objects live in a dense list (`objects`), and removing one moves the last
+  object into its hole instead of shifting everybody down. To still be able
+  to refer to an object without holding on to it, each object gets a handle:
+  a slot number plus a generation count, packed into an int. Slots get
+  reused after an object is removed, but with a bumped generation, so a stale
+  handle just looks up as None instead of finding some other object.
+
+  There's also one dense list per class (see `view`) that is kept up to date
+  as objects come and go, so e.g. hydrosim never has to filter all objects to
+  find its drops.
+
+  Iterating in reverse is safe while removing the *current* object, since
+  the object that gets swapped into its place was already visited.
+  """
+
+  GENERATION_SHIFT = 32
+  SLOT_MASK = (1 << GENERATION_SHIFT) - 1
+
+  def __init__(self, object_classes=()):
+    self.objects = []
+    self.object_classes = set(object_classes)
+    self._slot_index = []  # slot -> index into objects, or None when free
+    self._slot_generation = []
+    self._free_slots = []
+    self._views = {}  # class -> list of objects
+    self._view_index = {}  # class -> {handle: index into that view}
+
+  def __len__(self):
+    return len(self.objects)
+
+  def __iter__(self):
+    return iter(self.objects)
+
+  def __contains__(self, obj):
+    handle = getattr(obj, 'handle', None)
+    return handle is not None and self.get(handle) is obj
+
+  def get(self, handle):
+    """Return the object for this handle, or None if it's been removed."""
+    slot = handle & self.SLOT_MASK
+    if slot >= len(self._slot_index):
+      return None
+    index = self._slot_index[slot]
+    if index is None or self._slot_generation[slot] != handle >> self.GENERATION_SHIFT:
+      return None
+    return self.objects[index]
+
+  def view(self, cls):
+    """Return the live list of objects of class cls (or its subclasses).
+
+    Don't modify it, it's ours. Same ordering rules as `objects`."""
+    if cls not in self._views:
+      self._views[cls] = [obj for obj in self.objects if isinstance(obj, cls)]
+      self._view_index[cls] = {obj.handle: i for i, obj in enumerate(self._views[cls])}
+    return self._views[cls]
+
+  def add(self, obj):
+    if obj in self:
+      raise Exception(f'Object {obj} already registered')
+
+    if self._free_slots:
+      slot = self._free_slots.pop()
+    else:
+      slot = len(self._slot_index)
+      self._slot_index.append(None)
+      self._slot_generation.append(0)
+
+    obj.handle = slot | (self._slot_generation[slot] << self.GENERATION_SHIFT)
+    self._slot_index[slot] = len(self.objects)
+    self.objects.append(obj)
+
+    for cls in self._classes_of(obj):
+      view = self.view(cls)
+      if obj.handle not in self._view_index[cls]:  # view() may have found it already
+        self._view_index[cls][obj.handle] = len(view)
+        view.append(obj)
+
+    return obj.handle
+
+  def remove(self, obj):
+    if obj not in self:
+      raise Exception(f'Object {obj} is not registered')
+
+    handle = obj.handle
+    slot = handle & self.SLOT_MASK
+    self._swap_remove(self.objects, self._slot_index[slot], self._moved_in_objects)
+
+    for cls in self._classes_of(obj):
+      index = self._view_index[cls].pop(handle)
+      self._swap_remove(self._views[cls], index, self._view_index[cls].__setitem__)
+
+    self._slot_index[slot] = None
+    self._slot_generation[slot] += 1
+    self._free_slots.append(slot)
+    obj.handle = None
+
+  def _moved_in_objects(self, handle, index):
+    self._slot_index[handle & self.SLOT_MASK] = index
+
+  def _swap_remove(self, items, index, moved):
+    last = items.pop()
+    if index < len(items):
+      items[index] = last
+      moved(last.handle, index)
+
+  def _classes_of(self, obj):
+    """Every class we keep a view for that obj is an instance of."""
+    classes = [cls for cls in type(obj).__mro__ if cls in self.object_classes]
+    classes.extend(cls for cls in self._views if cls not in classes and isinstance(obj, cls))
+    if type(obj) not in classes:
+      classes.append(type(obj))
+    return classes
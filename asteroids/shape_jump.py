@@ -10,6 +10,7 @@ import pymunk
 
 from objects import GameObject
 import resources
+import settings
 
 KEY = pyglet.window.key
 Vec2d = pymunk.Vec2d
@@ -30,18 +31,9 @@ class Block(GameObject):
     return pymunk.Poly.create_box(size, bevel_radius)
 
   @staticmethod
-  def collision_Player_begin(arbiter, space, data):
-    block_shape, player_shape = arbiter.shapes
-    game = data['game']
-
-    # This can fail because pymunk is silly.
-    try:
-      block_obj = game.get_object_from_body(block_shape.body)
-      player_obj = game.get_object_from_body(player_shape.body)
-    except KeyError:
-      return False
-
-    
+  def collision_Player_begin(contact):
+    block_obj = contact.src
+    player_obj = contact.dst
     return True
  
 
@@ -140,19 +132,9 @@ class Player(GameObject):
       self.last_fired = now
 
   @staticmethod
-  def collision_Asteroid_separate(arbiter, space, data):
+  def collision_Asteroid_separate(contact):
     logging.info('Player collided with Asteroid')
-    # I have no idea why this is (dst, src) despite everything else begin (src, dst). But it consistently is...
-    asteroid_shape, player_shape = arbiter.shapes
-    game = data['game']
-
-    # This can fail because pymunk is silly.
-    try:
-      asteroid_obj = game.get_object_from_body(asteroid_shape.body)
-      player_obj = game.get_object_from_body(player_shape.body)
-    except KeyError:
-      logging.warning(f'Failed to lookup player,asteroid objects from shapes={arbiter.shapes}')
-      return False
+    player_obj = contact.src
 
     logging.info('Deleting player object')
     player_obj.delete()
@@ -160,7 +142,9 @@ class Player(GameObject):
 
 
 def configure(config):
-  config.physics = 'pymunk'
+  if config.physics != 'pymunk':
+    # wrap_objects() reaches right into the pymunk.Space.
+    raise settings.ConfigError(f'shape_jump only runs on --physics pymunk, not {config.physics}')
   config.gravity = 0
   config.fps = 120
   config.fullscreen = True
@@ -0,0 +1,288 @@
+"""Tests for commands.py. Run with `python3 -m pytest test_*.py` from this directory.
+
+hydrosim has the same commands.py, so these cover that copy too.
+"""
+
+import threading
+
+import pymunk
+
+import commands
+
+
+class Thing:
+
+  def __init__(self, name):
+    self.name = name
+    self.deleted = False
+    self.frozen = False
+    self.body = pymunk.Body(1, 10)
+    self.shape = pymunk.Circle(self.body, 5)
+
+  def __repr__(self):
+    return self.name
+
+
+class FakePhysics:
+
+  def __init__(self, log):
+    self.log = log
+
+  def thaw(self, objs):
+    for obj in objs:
+      if obj.frozen:
+        obj.frozen = False
+        self.log.append(('thaw', obj))
+
+  def touch(self, obj):
+    self.log.append(('touch', obj))
+
+
+class FakeGame:
+  """Just the bits of Game that CommandBuffer calls."""
+
+  def __init__(self):
+    self.log = []
+    self.physics = FakePhysics(self.log)
+    self.commands = commands.CommandBuffer(self)
+
+  def _add_object(self, obj, background=False):
+    # Same signature as Game._add_object(), so a kwarg that Game wouldn't
+    # take fails here too.
+    obj.deleted = False
+    obj.background = background
+    self.log.append(('add', obj))
+
+  def _remove_object(self, obj):
+    obj.deleted = True
+    self.log.append(('remove', obj))
+
+
+def test_not_deferring_applies_right_away():
+  game = FakeGame()
+  rock = Thing('rock')
+  game.commands.update_body(rock, velocity=(1, 2))
+  assert rock.body.velocity == (1, 2)
+  assert game.log == [('touch', rock)]
+  assert not len(game.commands)
+
+
+def test_flush_order_is_deletes_spawns_body_changes():
+  game = FakeGame()
+  moved, spawned, doomed = Thing('moved'), Thing('spawned'), Thing('doomed')
+  with game.commands.deferred():
+    game.commands.update_body(moved, angle=1.0)
+    game.commands.spawn(spawned)
+    game.commands.delete(doomed)
+    assert game.log == []
+    assert len(game.commands) == 3
+
+  assert game.log == [('remove', doomed), ('add', spawned), ('touch', moved)]
+  assert moved.body.angle == 1.0
+  assert not len(game.commands)
+
+
+def test_deferred_spawn_passes_add_object_kwargs_along():
+  game = FakeGame()
+  backdrop = Thing('backdrop')
+  with game.commands.deferred():
+    game.commands.spawn(backdrop, background=True)
+    assert game.log == []
+
+  assert game.log == [('add', backdrop)]
+  assert backdrop.background
+
+
+def test_deletes_happen_once_and_cancel_spawns():
+  game = FakeGame()
+  rock, ghost = Thing('rock'), Thing('ghost')
+  with game.commands.deferred():
+    game.commands.delete(rock)
+    game.commands.delete(rock)  # Two handlers both want it gone
+    game.commands.spawn(ghost)
+    game.commands.delete(ghost)  # Gone before it ever got added
+
+  assert game.log == [('remove', rock)]
+
+
+def test_body_changes_skip_deleted_objects():
+  game = FakeGame()
+  rock = Thing('rock')
+  with game.commands.deferred():
+    game.commands.update_body(rock, velocity=(5, 5))
+    game.commands.delete(rock)
+
+  assert game.log == [('remove', rock)]
+  assert rock.body.velocity == (0, 0)
+
+
+def test_changes_made_while_flushing_get_flushed_too():
+  game = FakeGame()
+  rock, pebble = Thing('rock'), Thing('pebble')
+  remove = game._remove_object
+
+  def split(obj):
+    remove(obj)
+    game.commands.spawn(pebble)  # Like a handler in remove_object
+  game._remove_object = split
+
+  with game.commands.deferred():
+    game.commands.delete(rock)
+
+  assert game.log == [('remove', rock), ('add', pebble)]
+  assert not len(game.commands)
+
+
+def test_nested_deferred_flushes_once_at_the_outermost():
+  game = FakeGame()
+  rock = Thing('rock')
+  with game.commands.deferred():
+    with game.commands.deferred():
+      game.commands.delete(rock)
+    assert game.log == []  # The inner block exiting doesn't flush
+    assert game.commands.deferring
+  assert game.log == [('remove', rock)]
+  assert not game.commands.deferring
+
+
+def test_nested_deferred_restores_on_queued():
+  game = FakeGame()
+  calls = []
+  with game.commands.deferred(on_queued=lambda: calls.append('outer')):
+    with game.commands.deferred(on_queued=lambda: calls.append('inner')):
+      game.commands.delete(Thing('a'))
+    with game.commands.deferred():  # Keeps the outer one
+      game.commands.delete(Thing('b'))
+    game.commands.delete(Thing('c'))
+  assert calls == ['inner', 'outer', 'outer']
+  assert game.commands.on_queued is None
+
+
+def test_held_ignores_direct_flushes():
+  game = FakeGame()
+  rock = Thing('rock')
+  calls = []
+  with game.commands.deferred(on_queued=lambda: calls.append('queued')):
+    with game.commands.held():
+      game.commands.delete(rock)
+      game.commands.flush()  # e.g. a post-step callback on another thread
+      assert game.log == []
+    assert calls == []  # Nobody gets told to flush while held
+    assert game.log == []  # Still inside deferred()
+  assert game.log == [('remove', rock)]
+
+
+def test_held_on_its_own_flushes_on_exit():
+  game = FakeGame()
+  rock = Thing('rock')
+  with game.commands.held():
+    game.commands.delete(rock)
+  assert game.log == [('remove', rock)]
+
+
+def test_apply_impulse_thaws_frozen_bodies():
+  game = FakeGame()
+  rock = Thing('rock')
+  rock.frozen = True
+  game.commands.apply_impulse(rock, (10, 0))
+  assert game.log == [('thaw', rock), ('touch', rock)]
+  assert rock.body.velocity.x > 0
+
+
+def test_deferred_apply_impulse_thaws_when_flushed():
+  game = FakeGame()
+  rock = Thing('rock')
+  rock.frozen = True
+  with game.commands.deferred():
+    game.commands.apply_impulse(rock, (10, 0))
+    assert rock.frozen
+  assert game.log == [('thaw', rock), ('touch', rock)]
+  assert rock.body.velocity.x > 0
+
+
+def test_calls_go_last():
+  game = FakeGame()
+  rock, spawned = Thing('rock'), Thing('spawned')
+  with game.commands.deferred():
+    game.commands.call(game.log.append, ('call', 'boing'))
+    game.commands.update_body(rock, angle=1.0)
+    game.commands.spawn(spawned)
+    assert game.log == []
+  assert game.log == [('add', spawned), ('touch', rock), ('call', 'boing')]
+
+
+def test_not_deferring_calls_right_away():
+  game = FakeGame()
+  game.commands.call(game.log.append, 'now')
+  assert game.log == ['now']
+
+
+def test_held_runs_calls_from_another_thread_on_this_one():
+  # Game's pipelined mode: the step (and the handlers that play sounds) runs
+  # on the pipeline thread, the sounds have to start on the main one.
+  game = FakeGame()
+  threads = []
+  with game.commands.held():
+    worker = threading.Thread(target=lambda: game.commands.call(lambda: threads.append(threading.current_thread())))
+    worker.start()
+    worker.join()
+    assert threads == []
+  assert threads == [threading.main_thread()]
+
+
+class PymunkGame(FakeGame):
+  """FakeGame with a real pymunk.Space, set up the way PymunkPhysics does
+  it: handlers queue changes, a post-step callback flushes them."""
+
+  def __init__(self):
+    super().__init__()
+    self.space = pymunk.Space()
+    self.objects = {}
+
+  def _add_object(self, obj, **kwargs):
+    super()._add_object(obj, **kwargs)
+    self.space.add(obj.body, obj.shape)
+    self.objects[obj.shape] = obj
+
+  def _remove_object(self, obj):
+    super()._remove_object(obj)
+    self.space.remove(obj.body, obj.shape)
+    del self.objects[obj.shape]
+
+  def schedule_flush(self):
+    self.space.add_post_step_callback(self.flush_commands, self.commands)
+
+  def flush_commands(self, space, key):
+    self.commands.flush()
+
+
+def test_post_step_flush_inside_outer_deferred():
+  # Game.physics_step() wraps the whole step in deferred(), and
+  # PymunkPhysics.step() defers again with a post-step callback. The
+  # callback's flush has to apply the changes right there, while the space
+  # is unlocked, and not leave them for the outer block.
+  game = PymunkGame()
+  bullet, rock, debris = Thing('bullet'), Thing('rock'), Thing('debris')
+  bullet.shape.collision_type = 1
+  rock.shape.collision_type = 2
+  bullet.body.position = (0, 0)
+  rock.body.position = (8, 0)
+  for obj in (bullet, rock):
+    game._add_object(obj)
+  game.log.clear()
+
+  def begin(arbiter, space, data):
+    game.commands.delete(game.objects[arbiter.shapes[1]])
+    game.commands.spawn(debris)
+    return True
+  game.space.add_collision_handler(1, 2).begin = begin
+
+  with game.commands.deferred():
+    with game.commands.deferred(on_queued=game.schedule_flush):
+      game.space.step(1 / 60)
+    assert game.log == [('remove', rock), ('add', debris)]
+    assert not len(game.commands)
+    assert rock.body.space is None
+    assert debris.body.space is game.space
+
+  assert game.log == [('remove', rock), ('add', debris)]  # Nothing twice
@@ -0,0 +1,80 @@
+"""Tests for how PymunkPhysics calls collision_<Dst>_<phase> handlers. Run
+with `python3 -m pytest test_*.py` from this directory.
+
+hydrosim has the same physics.py, so these cover that copy too.
+"""
+
+import types
+
+import pymunk
+import pytest
+
+import commands
+import physics
+
+
+class Thing:
+  deleted = False
+  contacts = None  # Set per test, (class name, src, dst, normal x)
+
+  def __init__(self, x):
+    self.body = pymunk.Body(1.0, pymunk.moment_for_circle(1.0, 0, 10))
+    self.body.position = (x, 0)
+    self.shapes = {'body': pymunk.Circle(self.body, 10)}
+    self.shapes['body'].collision_type = self.collision_type
+
+
+class Anvil(Thing):
+  collides_with = ['Anvil', 'Feather']
+
+
+class Feather(Thing):
+  collides_with = ['Anvil']
+
+  @staticmethod
+  def collision_Anvil_begin(contact):
+    Thing.contacts.append(('Feather', contact.src, contact.dst, contact.normal.x))
+
+
+def world(profile):
+  # Same stand-in game as benchmark.py.
+  config = types.SimpleNamespace(
+      gravity=0, fps=120, broadphase='grid', grid_cell_size=None, autotune=False, iterations=None,
+      collision_slop=None, spatial_hash=None, threads=None, sleep_time=None, idle_speed=None)
+  game = types.SimpleNamespace(config=config)
+  game.commands = commands.CommandBuffer(game)
+  engine = physics.IMPLEMENTATIONS['pymunk'](game, {'Anvil': Anvil, 'Feather': Feather})
+  engine.profile_collisions(profile)
+  Thing.contacts = []
+  return engine
+
+
+@pytest.mark.parametrize('profile', [False, True])
+def test_handler_gets_its_own_object_as_src(profile):
+  # Anvil has the lower collision_type, so pymunk's shapes come as (anvil,
+  # feather) and the handler on Feather has to see them flipped.
+  engine = world(profile)
+  anvil, feather = Anvil(0), Feather(15)
+  for obj in (anvil, feather):
+    engine.add_object(obj)
+  engine.step(1 / 120)
+
+  assert Thing.contacts == [('Feather', feather, anvil, -1.0)]
+
+
+@pytest.mark.parametrize('profile', [False, True])
+def test_same_class_handler(profile):
+  Anvil.collision_Anvil_begin = staticmethod(
+      lambda contact: Thing.contacts.append(('Anvil', contact.src, contact.dst, contact.normal.x)))
+  try:
+    engine = world(profile)
+    left, right = Anvil(0), Anvil(15)
+    for obj in (left, right):
+      engine.add_object(obj)
+    engine.step(1 / 120)
+  finally:
+    del Anvil.collision_Anvil_begin
+
+  [(_, src, dst, normal_x)] = Thing.contacts
+  assert {src, dst} == {left, right}
+  assert normal_x == (1.0 if src is left else -1.0)
@@ -0,0 +1,95 @@
+"""Tests for hooks.py. Run with `python3 -m pytest test_*.py` from this directory.
+
+hydrosim has the same hooks.py, so these cover that copy too.
+"""
+
+import types
+
+import pytest
+
+import hooks
+
+
+class FakeTime:
+  """Stands in for time.perf_counter(), hooks only move it forward."""
+
+  def __init__(self):
+    self.now = 100.0
+
+  def perf_counter(self):
+    return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  fake = FakeTime()
+  monkeypatch.setattr(hooks, 'time', fake)
+  return fake
+
+
+def scheduler():
+  game = types.SimpleNamespace(clock=types.SimpleNamespace(time=0.0))
+  return hooks.HookScheduler(game)
+
+
+def test_idle_hook_recovers_from_one_slow_call(clock):
+  schedule = scheduler()
+  durations = [0.2]  # The first call takes forever, like a label's first layout
+  calls = []
+
+  def update_label(game):
+    calls.append(clock.now)
+    clock.now += durations.pop(0) if durations else 0.0001
+  schedule.add(update_label, 'idle')
+
+  frame = 1 / 60
+  budget = 0.005  # Time left over each frame, way under 0.2s
+
+  schedule.run_idle(budget)
+  assert len(calls) == 1
+
+  # Too slow to fit for a while, but not for good.
+  frames = 0
+  while len(calls) == 1:
+    clock.now += frame
+    schedule.run_idle(budget)
+    frames += 1
+    assert frames * frame <= hooks.HookScheduler.max_idle_wait + frame
+
+  # Now that it's been quick, it fits every frame again.
+  for _ in range(10):
+    clock.now += frame
+    schedule.run_idle(budget)
+  assert len(calls) == 12
+
+
+def test_idle_hooks_that_dont_fit_wait(clock):
+  schedule = scheduler()
+  calls = []
+
+  def slow(game):
+    calls.append(clock.now)
+    clock.now += 0.01
+  schedule.add(slow, 'idle')
+
+  schedule.run_idle(1.0)
+  clock.now += 0.1
+  schedule.run_idle(0.001)
+  assert len(calls) == 1
+
+
+def test_idle_hooks_run_when_there_is_never_time(clock):
+  # Headless, or always behind: run_idle(0.0) every frame.
+  schedule = scheduler()
+  calls = []
+
+  def hook(game):
+    calls.append(clock.now)
+    clock.now += 0.001
+  schedule.add(hook, 'idle')
+
+  for _ in range(300):
+    clock.now += 0.01
+    schedule.run_idle(0.0)
+  # Once straight away (nothing known about it yet), then every max_idle_wait.
+  assert 3 <= len(calls) <= 5
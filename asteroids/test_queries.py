@@ -0,0 +1,60 @@
+"""Tests for the physics engines' spatial queries. Run with
+`python3 -m pytest test_*.py` from this directory.
+
+hydrosim has the same physics.py, so these cover that copy too.
+"""
+
+import types
+
+import pymunk
+import pytest
+
+import commands
+import physics
+
+
+class Thing:
+  deleted = False
+
+  def __init__(self, x, y, radius=10):
+    self.body = pymunk.Body(body_type=pymunk.Body.KINEMATIC)
+    self.body.position = (x, y)
+    self.shapes = {'body': pymunk.Circle(self.body, radius)}
+
+
+# Bullet and Ship collide with exactly the same classes, so they share a
+# category bit.
+class Rock(Thing):
+  collides_with = ['Bullet', 'Ship']
+
+
+class Bullet(Thing):
+  collides_with = ['Rock']
+
+
+class Ship(Thing):
+  collides_with = ['Rock']
+
+
+def world(engine_name):
+  # Same stand-in game as benchmark.py.
+  config = types.SimpleNamespace(
+      gravity=0, fps=120, broadphase='grid', grid_cell_size=None, autotune=False, iterations=None,
+      collision_slop=None, spatial_hash=None, threads=None, sleep_time=None, idle_speed=None)
+  game = types.SimpleNamespace(config=config)
+  game.commands = commands.CommandBuffer(game)
+  return physics.IMPLEMENTATIONS[engine_name](game, {cls.__name__: cls for cls in (Rock, Bullet, Ship)})
+
+
+@pytest.mark.parametrize('engine_name', ['pymunk', 'cheesy', 'vectorized'])
+def test_queries_only_return_the_class_asked_for(engine_name):
+  engine = world(engine_name)
+  bullet, ship = Bullet(50, 0), Ship(100, 0)
+  for obj in (bullet, ship):
+    engine.add_object(obj)
+  engine.step(1 / 120)
+
+  assert engine.nearest((0, 0), cls=Ship) is ship
+  assert engine.raycast_first((0, 0), (200, 0), cls=Ship).obj is ship
+  assert engine.nearest((0, 0), cls=Rock) is None
+  assert engine.nearest((0, 0)) is bullet
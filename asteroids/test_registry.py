@@ -0,0 +1,150 @@
+"""Tests for registry.py. Run with `python3 -m pytest test_*.py` from this directory.
+
+hydrosim has the same registry.py, so these cover that copy too.
+"""
+
+import pytest
+
+from registry import ObjectRegistry
+
+
+class Thing:
+  pass
+
+
+class Rock(Thing):
+  pass
+
+
+class Ship(Thing):
+  pass
+
+
+def test_handles_find_their_objects():
+  registry = ObjectRegistry()
+  things = [Thing() for _ in range(3)]
+  for thing in things:
+    registry.add(thing)
+
+  assert len(registry) == 3
+  for thing in things:
+    assert registry.get(thing.handle) is thing
+    assert thing in registry
+
+
+def test_adding_twice_raises():
+  registry = ObjectRegistry()
+  thing = Thing()
+  registry.add(thing)
+  with pytest.raises(Exception):
+    registry.add(thing)
+
+
+def test_removing_unknown_raises():
+  with pytest.raises(Exception):
+    ObjectRegistry().remove(Thing())
+
+
+def test_swap_remove_keeps_handles_working():
+  registry = ObjectRegistry()
+  first, middle, last = Thing(), Thing(), Thing()
+  for thing in (first, middle, last):
+    registry.add(thing)
+
+  registry.remove(first)
+
+  # last got swapped into first's spot, its handle still has to find it.
+  assert registry.objects == [last, middle]
+  assert registry.get(last.handle) is last
+  assert registry.get(middle.handle) is middle
+  assert first.handle is None
+  assert first not in registry
+
+
+def test_reused_slot_gets_new_generation():
+  registry = ObjectRegistry()
+  old = Thing()
+  old_handle = registry.add(old)
+  registry.remove(old)
+
+  new = Thing()
+  new_handle = registry.add(new)
+
+  assert new_handle & ObjectRegistry.SLOT_MASK == old_handle & ObjectRegistry.SLOT_MASK
+  assert new_handle != old_handle
+  assert registry.get(new_handle) is new
+
+
+def test_stale_handles_look_up_as_none():
+  registry = ObjectRegistry()
+  things = [Thing() for _ in range(4)]
+  handles = [registry.add(thing) for thing in things]
+  for thing in things[:2]:
+    registry.remove(thing)
+  for _ in range(2):
+    registry.add(Thing())  # Reuses both freed slots
+
+  assert registry.get(handles[0]) is None
+  assert registry.get(handles[1]) is None
+  assert registry.get(handles[2]) is things[2]
+  assert registry.get(handles[3]) is things[3]
+  assert registry.get(1000) is None  # Never handed out
+
+
+def test_views_track_adds_and_removes():
+  registry = ObjectRegistry([Rock, Ship])
+  rocks = [Rock() for _ in range(4)]
+  ship = Ship()
+  for obj in rocks[:2] + [ship] + rocks[2:]:
+    registry.add(obj)
+
+  rock_view = registry.view(Rock)
+  assert sorted(map(id, rock_view)) == sorted(map(id, rocks))
+  assert registry.view(Ship) == [ship]
+
+  registry.remove(rocks[0])
+  registry.remove(ship)
+  registry.remove(rocks[3])
+
+  assert registry.view(Rock) is rock_view  # Same live list
+  assert sorted(map(id, rock_view)) == sorted(map(id, [rocks[1], rocks[2]]))
+  assert registry.view(Ship) == []
+
+  # And removing from the view's new layout still works.
+  registry.remove(rocks[2])
+  assert rock_view == [rocks[1]]
+  registry.add(rocks[0])
+  assert sorted(map(id, rock_view)) == sorted(map(id, [rocks[0], rocks[1]]))
+
+
+def test_view_of_base_class_after_the_fact():
+  registry = ObjectRegistry([Rock, Ship])
+  rock, ship = Rock(), Ship()
+  registry.add(rock)
+  registry.add(ship)
+
+  things = registry.view(Thing)
+  assert sorted(map(id, things)) == sorted(map(id, [rock, ship]))
+
+  registry.remove(rock)
+  another = Rock()
+  registry.add(another)
+  assert sorted(map(id, things)) == sorted(map(id, [ship, another]))
+
+
+def test_reverse_iteration_survives_removing_current():
+  registry = ObjectRegistry()
+  things = [Thing() for _ in range(5)]
+  for thing in things:
+    registry.add(thing)
+
+  doomed = things[::2]
+  seen = []
+  for index in reversed(range(len(registry.objects))):
+    thing = registry.objects[index]
+    seen.append(thing)
+    if thing in doomed:
+      registry.remove(thing)
+
+  assert sorted(map(id, seen)) == sorted(map(id, things))
+  assert sorted(map(id, registry.objects)) == sorted(map(id, things[1::2]))
@@ -0,0 +1,72 @@
+"""Tests for the physics engines' wrap-around world. Run with
+`python3 -m pytest test_*.py` from this directory.
+
+hydrosim has the same physics.py, so these cover that copy too.
+"""
+
+import types
+
+import pymunk
+import pytest
+
+import commands
+import physics
+
+
+class Rock:
+  collides_with = ['Rock']
+  deleted = False
+
+  def __init__(self, x, y, vx=0.0, radius=25):
+    self.body = pymunk.Body(1.0, pymunk.moment_for_circle(1.0, 0, radius))
+    self.body.position = (x, y)
+    self.body.velocity = (vx, 0)
+    self.shapes = {'body': pymunk.Circle(self.body, radius)}
+    self.shapes['body'].elasticity = 0.8
+
+
+def wrapped_world(engine_name):
+  # Same stand-in game as benchmark.py.
+  config = types.SimpleNamespace(
+      gravity=0, fps=120, broadphase='grid', grid_cell_size=None, autotune=False, iterations=None,
+      collision_slop=None, spatial_hash=None, threads=None, sleep_time=None, idle_speed=None)
+  game = types.SimpleNamespace(config=config)
+  game.commands = commands.CommandBuffer(game)
+  engine = physics.IMPLEMENTATIONS[engine_name](game, {'Rock': Rock})
+  engine.set_wrap((0, 0, 1000, 1000), ghosts=True)
+  return engine
+
+
+@pytest.mark.parametrize('engine_name', ['pymunk', 'vectorized'])
+def test_pair_straddling_the_seam_collides(engine_name):
+  engine = wrapped_world(engine_name)
+  # 37 + 5 = 42 apart across the seam, radii add up to 50. Neither one is
+  # within its own radius of the edge.
+  # Heading into each other through the seam.
+  right = Rock(1000 - 37, 500, vx=50)
+  left = Rock(5, 500, vx=-50)
+  for rock in (right, left):
+    engine.add_object(rock)
+
+  for _ in range(3):
+    engine.step(1 / 120)
+  engine.sync_bodies()
+
+  # They bounce: right one heads back left, left one back right.
+  assert right.body.velocity.x < 0 < left.body.velocity.x
+
+
+@pytest.mark.parametrize('engine_name', ['pymunk', 'vectorized'])
+def test_pair_clear_of_each_other_across_the_seam_doesnt(engine_name):
+  engine = wrapped_world(engine_name)
+  # 55 apart across the seam, and only closing 0.8 px a step.
+  right = Rock(1000 - 40, 500, vx=50)
+  left = Rock(15, 500, vx=-50)
+  for rock in (right, left):
+    engine.add_object(rock)
+
+  for _ in range(3):
+    engine.step(1 / 120)
+  engine.sync_bodies()
+
+  assert right.body.velocity.x == 50 and left.body.velocity.x == -50
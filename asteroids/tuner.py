@@ -0,0 +1,133 @@
+import logging
+import os
+import statistics
+import sys
+import time
+
+import pymunk
+
+
+class SpaceTuner:
+  """Picks pymunk.Space settings (solver iterations, collision slop, spatial
+  hash, solver threads) from what's actually in the space and how long steps
+  take, instead of leaving everything at pymunk's defaults.
+
+  Anything set explicitly in the config (--iterations, --collision-slop,
+  --spatial-hash, --threads) is applied once and then left alone. With
+  --autotune the rest gets adjusted every `interval` steps, and whenever
+  something changes the full set is logged as command line flags, so a good
+  configuration can be pinned down and reproduced without the tuner.
+  """
+
+  interval = 60  # Steps between looks at the space
+  hash_threshold = 500  # Switch from the bb tree to a spatial hash past this many shapes
+  default_iterations = 10
+  min_iterations = 4
+
+  def __init__(self, space, config):
+    self.space = space
+    self.config = config
+    self.autotune = config.autotune
+    self.pinned = {
+        name for name in ('iterations', 'collision_slop', 'spatial_hash', 'threads')
+        if getattr(config, name) is not None}
+
+    self.steps = 0
+    self.step_time = 0.0  # Exponential moving average, in seconds
+    self.budget = 1 / config.fps
+    self.spatial_hash = None  # (dim, count) once we're using one
+
+    if config.iterations is not None:
+      space.iterations = config.iterations
+    if config.collision_slop is not None:
+      space.collision_slop = config.collision_slop
+    if config.spatial_hash is not None:
+      self.use_spatial_hash(*config.spatial_hash)
+    if config.threads is not None:
+      space.threads = config.threads
+
+  @staticmethod
+  def make_space(config):
+    """pymunk only does threaded solving if the space was made that way."""
+    threaded = (
+        (config.threads or 1) > 1
+        or (config.autotune and config.threads is None and (os.cpu_count() or 1) > 1))
+    return pymunk.Space(threaded=threaded and sys.platform != 'win32')
+
+  def use_spatial_hash(self, dim, count):
+    self.space.use_spatial_hash(dim, count)
+    self.spatial_hash = (dim, count)
+
+  def flags(self):
+    """The current settings as command line flags."""
+    flags = [
+        f'--iterations {self.space.iterations}',
+        f'--collision-slop {self.space.collision_slop:.3g}',
+        f'--threads {self.space.threads}',
+    ]
+    if self.spatial_hash:
+      flags.append(f'--spatial-hash {self.spatial_hash[0]:.3g},{self.spatial_hash[1]}')
+    return ' '.join(flags)
+
+  def timed_step(self, step, dt):
+    """Run step(dt), keeping track of how long it takes, and retune now and
+    then."""
+    start = time.perf_counter()
+    step(dt)
+    elapsed = time.perf_counter() - start
+    self.step_time = elapsed if not self.steps else 0.9 * self.step_time + 0.1 * elapsed
+
+    self.steps += 1
+    if self.autotune and self.steps % self.interval == 0:
+      before = self.flags()
+      self.tune()
+      if self.flags() != before:
+        logging.info(f'SpaceTuner: {len(self.space.shapes)} shapes, step {self.step_time * 1000:.2f}ms, now using {self.flags()}')
+
+  def moving_sizes(self):
+    """Diameters of (a sample of) the shapes that can move."""
+    sizes = []
+    for body in self.space.bodies:
+      if body.body_type == pymunk.Body.STATIC:
+        continue
+      for shape in body.shapes:
+        bb = shape.bb
+        sizes.append(max(bb.right - bb.left, bb.top - bb.bottom))
+      if len(sizes) >= 256:
+        break
+    return sizes
+
+  def tune(self):
+    space = self.space
+    count = len(space.shapes)
+    sizes = self.moving_sizes()
+    size = statistics.median(sizes) if sizes else None
+
+    # Resting piles jitter less when shapes may overlap a little, scale the
+    # allowed overlap with how big things are.
+    if size and 'collision_slop' not in self.pinned:
+      space.collision_slop = min(max(0.02 * size, 0.1), 1.0)
+
+    # The default bb tree is great for a few shapes of wildly different sizes.
+    # Lots of similar sized ones are what the spatial hash is for, sized to
+    # the typical shape with ~10 cells per shape (per the pymunk docs).
+    if size and count >= self.hash_threshold and 'spatial_hash' not in self.pinned:
+      if self.spatial_hash:
+        dim, cells = self.spatial_hash
+        resize = not (0.75 < size / dim < 1.33) or count * 10 > 2 * cells
+      else:
+        resize = True
+      if resize:
+        self.use_spatial_hash(round(size, 1), count * 10)
+
+    # Trade solver accuracy for speed when steps blow the budget, and give it
+    # back once there's room again.
+    if 'iterations' not in self.pinned:
+      if self.step_time > 0.5 * self.budget and space.iterations > self.min_iterations:
+        space.iterations -= 1
+      elif self.step_time < 0.25 * self.budget and space.iterations < self.default_iterations:
+        space.iterations += 1
+
+    # The second solver thread only pays off with a lot going on.
+    if 'threads' not in self.pinned and (os.cpu_count() or 1) > 1:
+      space.threads = 2 if count >= self.hash_threshold else 1
@@ -0,0 +1,101 @@
+import logging
+
+import numpy as np
+import pymunk
+
+
+# No object has this category, but every shape has it in its mask, so that
+# spatial queries can find objects that don't collide with anything.
+QUERY_CATEGORY = 1 << 31
+
+
+class CategoryRegistry:
+  """Collision types, categories and masks for the classes one Game uses.
+
+  Two classes collide when *both* list each other in collides_with, same as
+  pymunk's ShapeFilter rule. Every class gets its own collision_type (that's
+  what collision handlers are keyed on), but category bits are shared:
+  classes that collide with exactly the same set of classes are
+  interchangeable as far as filtering goes, so they get the same bit. That
+  keeps masks as tight as they can be, and pymunk throws away pairs that
+  can't collide before doing any narrowphase work on them.
+
+  pymunk only has 32 category bits (and we keep one for queries). Past that
+  the leftover classes share one overflow bit that lets them through the
+  filter, and `interacts()` has to sort them out instead (PymunkPhysics does
+  that with collision handlers).
+  """
+
+  max_categories = 30  # Plus the overflow bit and QUERY_CATEGORY
+
+  def __init__(self, classes):
+    self.classes = list(classes)
+    self.index = {cls: i for i, cls in enumerate(self.classes)}
+    by_name = {cls.__name__: cls for cls in self.classes}
+
+    def partners(cls):
+      found = set()
+      for name in cls.collides_with:
+        other = by_name.get(name)
+        if other is None:
+          logging.warning(f'{cls.__name__} collides with {name}, which is not a class in this game')
+        elif cls.__name__ in other.collides_with:
+          found.add(other)
+      return tuple(sorted(found, key=self.index.get))
+
+    self.partners = {cls: partners(cls) for cls in self.classes}  # cls -> classes it collides with
+
+    # One spare row/column of False for classes we don't know (index -1).
+    count = len(self.classes)
+    self.matrix = np.zeros((count + 1, count + 1), dtype=bool)
+    for cls, others in self.partners.items():
+      for other in others:
+        self.matrix[self.index[cls], self.index[other]] = True
+
+    # Handler ids. Small ints, 0 is pymunk's default so we skip it.
+    for cls in self.classes:
+      cls.collision_type = self.index[cls] + 1
+
+    # Classes with the same partners share a category bit. The busiest
+    # groups get real bits first, since those filter out the most pairs.
+    groups = {}
+    for cls in self.classes:
+      groups.setdefault(frozenset(self.partners[cls]), []).append(cls)
+    ordered = sorted(groups.items(), key=lambda item: -len(item[0]))
+    self.overflow = [cls for _, members in ordered[self.max_categories:] for cls in members]
+    overflow_bit = 1 << self.max_categories
+
+    self.category = {}
+    for bit, (_, members) in enumerate(ordered):
+      for cls in members:
+        self.category[cls] = 1 << bit if bit < self.max_categories else overflow_bit
+
+    self.mask = {}
+    self.filters = {}
+    for cls in self.classes:
+      mask = 0
+      for other in self.partners[cls]:
+        mask |= self.category[other]
+      self.mask[cls] = mask
+      self.filters[cls] = pymunk.ShapeFilter(categories=self.category[cls], mask=mask | QUERY_CATEGORY)
+      logging.debug(f'{cls.__name__}: collision_type={cls.collision_type} filter={self.filters[cls]}')
+
+    if self.overflow:
+      logging.info(f'{len(groups)} collision groups, more than {self.max_categories} categories: {len(self.overflow)} classes get filtered by handlers')
+
+  def interacts(self, cls, other):
+    """True if objects of these two classes collide."""
+    return other in self.partners.get(cls, ())
+
+  def filter_for(self, cls):
+    """The shared ShapeFilter for cls' shapes."""
+    return self.filters[cls]
+
+  def query_mask(self, cls):
+    """Mask that finds every shape of cls (or its subclasses, or one of a
+    tuple of classes), and as little else as possible."""
+    mask = 0
+    for other in self.classes:
+      if issubclass(other, cls):
+        mask |= self.category[other]
+    return mask
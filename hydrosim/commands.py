@@ -0,0 +1,142 @@
+import contextlib
+import logging
+
+
+class CommandBuffer:
+  """Queue of structural changes (spawns, deletes, body tweaks) made while
+  it isn't safe to make them, e.g. from inside a collision handler while
+  pymunk is in the middle of space.step().
+
+  Game.add_object()/remove_object() go through here automatically, so game
+  code doesn't need to know whether it's being called mid-step or not.
+  Everything queued gets applied in one batch by flush(): deletes first
+  (each object only once, no matter how many handlers asked), then spawns,
+  then body changes for objects that are still around, then call()s.
+  """
+
+  def __init__(self, game):
+    self.game = game
+    self.depth = 0
+    self.holding = 0
+    self.flushing = False
+    self.spawns = {}  # obj -> add_object kwargs, in order
+    self.deletes = {}  # Used as an ordered set
+    self.body_changes = []  # (obj, function) pairs
+    self.calls = []  # (function, args, kwargs)
+    # Called whenever something gets queued, lets the physics engine
+    # schedule a flush (pymunk post-step callback) while we're deferring.
+    self.on_queued = None
+
+  @property
+  def deferring(self):
+    return self.depth > 0
+
+  @contextlib.contextmanager
+  def deferred(self, on_queued=None):
+    """Queue changes instead of applying them until the outermost deferred()
+    block exits, then flush."""
+    self.depth += 1
+    previous_on_queued, self.on_queued = self.on_queued, on_queued or self.on_queued
+    try:
+      yield self
+    finally:
+      self.on_queued = previous_on_queued
+      self.depth -= 1
+      if not self.depth:
+        self.flush()
+
+  @contextlib.contextmanager
+  def held(self):
+    """Like deferred(), but nothing gets applied before this block exits,
+    not even by a direct flush(). For when whatever queues changes runs on
+    another thread, and they have to be made on this one (see Game's
+    pipelined mode)."""
+    self.holding += 1
+    self.depth += 1
+    try:
+      yield self
+    finally:
+      self.holding -= 1
+      self.depth -= 1
+      if not self.depth:
+        self.flush()
+
+  def __len__(self):
+    return len(self.spawns) + len(self.deletes) + len(self.body_changes) + len(self.calls)
+
+  def _queued(self):
+    if self.on_queued and not self.holding:
+      self.on_queued()
+
+  def spawn(self, obj, **add_object_kwargs):
+    self.spawns[obj] = add_object_kwargs
+    self._queued()
+
+  def delete(self, obj):
+    if obj in self.spawns:
+      # Never made it into the game, so there's nothing to remove.
+      del self.spawns[obj]
+      return
+    self.deletes[obj] = None
+    self._queued()
+
+  def update_body(self, obj, **attrs):
+    """Set attributes (velocity=..., angle=...) on obj.body."""
+    def apply():
+      for attr, value in attrs.items():
+        setattr(obj.body, attr, value)
+    self._change_body(obj, apply)
+
+  def apply_impulse(self, obj, impulse, point=(0, 0)):
+    def apply():
+      self.game.physics.thaw([obj])  # A frozen body (see hydrosim's lod.py) would ignore it
+      obj.body.apply_impulse_at_local_point(impulse, point)
+    self._change_body(obj, apply)
+
+  def call(self, function, *args, **kwargs):
+    """Call function(*args, **kwargs) along with the other changes. For
+    side effects that can't happen mid-step either, or anywhere but the
+    main thread, like starting a sound."""
+    if not self.deferring:
+      function(*args, **kwargs)
+      return
+    self.calls.append((function, args, kwargs))
+    self._queued()
+
+  def _change_body(self, obj, apply):
+    if not self.deferring:
+      apply()
+      self.game.physics.touch(obj)
+      return
+    self.body_changes.append((obj, apply))
+    self._queued()
+
+  def flush(self):
+    if self.flushing:
+      return  # Stuff queued by the changes we're applying, the loop below gets it.
+    if self.holding:
+      return  # held() flushes on the way out
+
+    self.flushing = True
+    try:
+      while len(self):
+        deletes, self.deletes = self.deletes, {}
+        spawns, self.spawns = self.spawns, {}
+        body_changes, self.body_changes = self.body_changes, []
+        calls, self.calls = self.calls, []
+        logging.debug(
+            f'CommandBuffer.flush: {len(deletes)} deletes, {len(spawns)} spawns, '
+            f'{len(body_changes)} body changes, {len(calls)} calls')
+
+        for obj in deletes:
+          self.game._remove_object(obj)
+        for obj, kwargs in spawns.items():
+          self.game._add_object(obj, **kwargs)
+        for obj, apply in body_changes:
+          if not obj.deleted:
+            apply()
+            self.game.physics.touch(obj)
+        for function, args, kwargs in calls:
+          function(*args, **kwargs)
+    finally:
+      self.flushing = False
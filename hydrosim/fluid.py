@@ -0,0 +1,271 @@
+import numpy as np
+import pyglet
+from pyglet import gl
+
+import spatial
+
+
+class PointGroup(pyglet.graphics.Group):
+  """Round, smoothed GL_POINTS of one size."""
+
+  def __init__(self, size, parent=None):
+    super().__init__(parent)
+    self.size = size
+
+  def set_state(self):
+    gl.glPointSize(self.size)
+    gl.glEnable(gl.GL_POINT_SMOOTH)
+    gl.glEnable(gl.GL_BLEND)
+    gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+
+  def unset_state(self):
+    gl.glDisable(gl.GL_POINT_SMOOTH)
+    gl.glPointSize(1)
+
+
+class FluidSystem:
+  """Particle fluid, for way more water than one pymunk body per drop allows.
+
+  Particles are rows in numpy arrays, stepped with double density relaxation
+  (Clavet et al., "Particle-based Viscoelastic Fluid Simulation"): every step
+  particles get moved by their velocity, then pushed apart or pulled
+  together depending on how crowded it is around them, and the velocity is
+  whatever that movement works out to. Neighbours come from
+  spatial.grid_pairs(), so there's no Python code per particle anywhere.
+
+  Objects of `boundary_cls` (Segments, like hydrosim's Floor) are walls the
+  fluid can't get through. Each step, `on_contact(fluid, rows, walls,
+  normals)` gets told which particle rows touched which of those objects
+  (`walls` indexes into `fluid.walls`), so the game can give walls special
+  powers by editing `fluid.velocity` or calling `fluid.remove()`.
+
+  It's a game system, Game calls step(dt) after every physics step and
+  sync() once per frame. Everything gets drawn as one vertex list of points.
+  """
+
+  radius = 8.0  # Particles feel each other this far out
+  rest_density = 4.0  # How crowded the fluid likes to be
+  stiffness = 1500.0  # How hard it pushes back when it's more crowded than that
+  near_stiffness = 4000.0  # Keeps particles from clumping up on each other
+  viscosity = 0.3  # Fraction of the neighbours' relative velocity taken on per step
+  wall_friction = 0.1  # Fraction of the sliding velocity walls take per step
+  max_speed = 2000.0
+  sort_interval = 30  # Steps between memory reshuffles, see _sort()
+
+  def __init__(self, game, boundary_cls, on_contact=None, color=(40, 120, 255, 200), point_size=6, batch=None):
+    self.game = game
+    self.boundaries = game.physics.registry.view(boundary_cls)
+    self.on_contact = on_contact
+    self.batch = batch or game.main_batch
+    self.group = PointGroup(point_size)
+    self.color = color
+    self.count = 0
+    self.capacity = 0
+    self.position = self.velocity = None
+    self._grow(1024)
+    self.walls = []  # The boundary objects, as of the last step
+    self.steps = 0
+    self.vertex_list = None
+
+  def __len__(self):
+    return self.count
+
+  def _grow(self, capacity):
+    def resized(array):
+      new = np.zeros((capacity, 2))
+      if array is not None:
+        new[:self.count] = array[:self.count]
+      return new
+    self.position = resized(self.position)
+    self.velocity = resized(self.velocity)
+    self.capacity = capacity
+
+  def add(self, positions, velocities=None):
+    """Add particles at positions (an array of (x, y)), optionally moving."""
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    needed = self.count + len(positions)
+    if needed > self.capacity:
+      capacity = self.capacity
+      while capacity < needed:
+        capacity *= 2
+      self._grow(capacity)
+    rows = slice(self.count, needed)
+    self.position[rows] = positions
+    self.velocity[rows] = 0.0 if velocities is None else velocities
+    self.count = needed
+
+  def remove(self, rows):
+    """Remove particles by row (an index array, or a bool mask over rows).
+    Row numbers don't mean anything past the step they came from, particles
+    get reordered now and then."""
+    alive = np.ones(self.count, dtype=bool)
+    alive[rows] = False
+    count = int(alive.sum())
+    self.position[:count] = self.position[:self.count][alive]
+    self.velocity[:count] = self.velocity[:self.count][alive]
+    self.count = count
+
+  def step(self, dt):
+    n = self.count
+    if not n:
+      return
+    position = self.position[:n]
+    velocity = self.velocity[:n]
+
+    velocity += np.array(tuple(self.game.physics.gravity)) * dt
+    speed = np.sqrt((velocity * velocity).sum(axis=1))
+    too_fast = speed > self.max_speed
+    if too_fast.any():
+      velocity[too_fast] *= (self.max_speed / speed[too_fast])[:, None]
+
+    previous = position.copy()
+    position += velocity * dt
+
+    # The pair math works on x and y separately, gathering from two flat
+    # arrays is a lot faster than from an (n, 2) one.
+    x, y = position[:, 0].copy(), position[:, 1].copy()
+    i, j, q, ux, uy = self._neighbours(x, y)
+    self._relax(x, y, dt, i, j, q, ux, uy)
+    position[:, 0], position[:, 1] = x, y
+    contacts = self._collide_walls(position)
+
+    velocity[:] = (position - previous) / dt
+    self._wall_friction(velocity, *contacts)
+    self._viscosity(velocity, i, j, q)
+
+    self.steps += 1
+    if self.steps % self.sort_interval == 0:
+      self._sort()
+
+    rows, walls, normals = contacts
+    if self.on_contact and len(rows):
+      self.on_contact(self, rows, walls, normals)
+
+  def _sort(self):
+    """Put particles that are close together next to each other in memory,
+    so the neighbour lookups mostly hit the cache."""
+    n = self.count
+    cells = np.floor(self.position[:n] / self.radius).astype(np.int64)
+    cells -= cells.min(axis=0)
+    order = np.argsort(cells[:, 0] * (int(cells[:, 1].max()) + 1) + cells[:, 1], kind='stable')
+    self.position[:n] = self.position[:n][order]
+    self.velocity[:n] = self.velocity[:n][order]
+
+  def _neighbours(self, x, y):
+    """Pairs closer than radius, with q = 1 - distance / radius and the unit
+    vector (ux, uy) from i to j."""
+    # Cells of half the radius, see grid_pairs().
+    i, j = spatial.grid_pairs(np.stack([x, y], axis=1), self.radius / 2, max_distance=self.radius)
+    q, ux, uy = np.empty(len(i)), np.empty(len(i)), np.empty(len(i))
+    for pairs in spatial.blocks(len(i)):
+      bi, bj = i[pairs], j[pairs]
+      dx = x.take(bj) - x.take(bi)
+      dy = y.take(bj) - y.take(bi)
+      distance = np.maximum(np.sqrt(dx * dx + dy * dy), 1e-9)
+      q[pairs] = 1 - distance / self.radius
+      ux[pairs] = dx / distance
+      uy[pairs] = dy / distance
+    return i, j, q, ux, uy
+
+  def _relax(self, x, y, dt, i, j, q, ux, uy):
+    """Double density relaxation: push particles apart where it's crowded,
+    pull them together where it's sparse."""
+    n = len(x)
+    q2 = q * q
+    q3 = q2 * q
+    density = np.bincount(i, q2, minlength=n) + np.bincount(j, q2, minlength=n)
+    near_density = np.bincount(i, q3, minlength=n) + np.bincount(j, q3, minlength=n)
+    pressure = self.stiffness * (density - self.rest_density)
+    near_pressure = self.near_stiffness * near_density
+
+    # Each pair pushes both particles half way, along the line between them.
+    push = np.empty(len(i))
+    for pairs in spatial.blocks(len(i)):
+      bi, bj = i[pairs], j[pairs]
+      push[pairs] = (
+          (pressure.take(bi) + pressure.take(bj)) * q[pairs]
+          + (near_pressure.take(bi) + near_pressure.take(bj)) * q2[pairs])
+    push *= 0.25 * dt * dt
+    np.clip(push, -0.125 * self.radius, 0.125 * self.radius, out=push)
+    px, py = ux * push, uy * push
+    x += np.bincount(j, px, minlength=n) - np.bincount(i, px, minlength=n)
+    y += np.bincount(j, py, minlength=n) - np.bincount(i, py, minlength=n)
+
+  def _read_walls(self):
+    self.walls = list(self.boundaries)
+    count = len(self.walls)
+    a = np.zeros((count, 2))
+    b = np.zeros((count, 2))
+    radius = np.zeros(count)
+    friction = np.zeros(count)
+    for index, obj in enumerate(self.walls):
+      shape = obj.shapes['body']
+      a[index] = obj.body.local_to_world(shape.a)
+      b[index] = obj.body.local_to_world(shape.b)
+      radius[index] = shape.radius
+      friction[index] = shape.friction
+    return a, b, radius, friction
+
+  def _collide_walls(self, position):
+    """Push particles out of walls. Returns (rows, walls, normals) for every
+    particle that touched one."""
+    a, b, radius, self.wall_frictions = self._read_walls()
+    if not len(self.walls):
+      return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty((0, 2))
+
+    # Only look closer at particles inside a wall's bounding box, checked
+    # for all walls at once.
+    reach = radius + self.radius * 0.5  # Particles are about radius / 2 big
+    low = np.minimum(a, b) - reach[:, None]
+    high = np.maximum(a, b) + reach[:, None]
+    x, y = position[:, 0, None], position[:, 1, None]
+    rows, walls = np.nonzero((x >= low[:, 0]) & (x <= high[:, 0]) & (y >= low[:, 1]) & (y <= high[:, 1]))
+    distance, normal = spatial.point_segment_distances(position[rows], a[walls], b[walls])
+    touching = np.flatnonzero(distance < reach[walls])
+    rows, walls, distance, normal = rows[touching], walls[touching], distance[touching], normal[touching]
+
+    # One in a corner gets pushed out of both walls.
+    push = normal * (reach[walls] - distance)[:, None]
+    n = len(position)
+    position[:, 0] += np.bincount(rows, push[:, 0], minlength=n)
+    position[:, 1] += np.bincount(rows, push[:, 1], minlength=n)
+    return rows, walls, normal
+
+  def _wall_friction(self, velocity, rows, walls, normals):
+    """Particles on a wall don't move into it, and slide a little slower."""
+    if not len(rows):
+      return
+    v = velocity[rows]
+    into = np.minimum((v * normals).sum(axis=1), 0.0)
+    v -= normals * into[:, None]
+    along = v - normals * (v * normals).sum(axis=1)[:, None]
+    v -= along * (self.wall_friction * self.wall_frictions[walls])[:, None]
+    velocity[rows] = v
+
+  def _viscosity(self, velocity, i, j, q):
+    """XSPH style smoothing: neighbours drift towards moving together."""
+    if not len(i):
+      return
+    n = len(velocity)
+    weight = np.bincount(i, q, minlength=n) + np.bincount(j, q, minlength=n)
+    scale = self.viscosity / np.maximum(weight, 1.0)
+    for axis in range(2):
+      v = velocity[:, axis].copy()
+      relative = (v.take(j) - v.take(i)) * q
+      velocity[:, axis] += (np.bincount(i, relative, minlength=n) - np.bincount(j, relative, minlength=n)) * scale
+
+  def sync(self):
+    """Update the points, Game calls this once per frame."""
+    if self.vertex_list is None:
+      self.vertex_list = self.batch.add(
+          self.capacity, gl.GL_POINTS, self.group,
+          'v2f/stream',
+          ('c4B/static', self.color * self.capacity))
+    elif self.vertex_list.get_size() < self.capacity:
+      self.vertex_list.resize(self.capacity)
+      self.vertex_list.colors[:] = self.color * self.capacity
+
+    # Write straight into the vertex buffer, no Python list of 2n floats.
+    vertices = np.ctypeslib.as_array(self.vertex_list.vertices).reshape(-1, 2)
+    vertices[:self.count] = self.position[:self.count]
+    vertices[self.count:] = -1e6  # Unused slots go way off screen
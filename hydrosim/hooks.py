@@ -0,0 +1,132 @@
+import time
+
+
+CADENCES = ('step', 'frame', 'interval', 'idle')
+
+
+class Hook:
+  """One function the game calls on some cadence, with its timing."""
+
+  smoothing = 0.25  # How much a slower call moves `recent` up
+
+  def __init__(self, function, cadence, interval=None, name=None):
+    self.function = function
+    self.cadence = cadence
+    self.interval = interval
+    self.name = name or getattr(function, '__name__', repr(function))
+    self.next_time = None  # Simulation time an interval hook is due next
+    self.calls = 0
+    self.seconds = 0.0
+    self.worst = 0.0
+    self.recent = 0.0  # How long a call takes these days, see run_idle()
+    self.last_call = time.perf_counter()  # Or when it was added
+
+  @property
+  def average(self):
+    return self.seconds / self.calls if self.calls else 0.0
+
+  def __call__(self, game):
+    start = time.perf_counter()
+    try:
+      self.function(game)
+    finally:
+      elapsed = time.perf_counter() - start
+      self.calls += 1
+      self.seconds += elapsed
+      self.worst = max(self.worst, elapsed)
+      # A quick call counts right away, slow ones only nudge it up, so one
+      # spike doesn't make it look slow for long.
+      if self.calls == 1 or elapsed < self.recent:
+        self.recent = elapsed
+      else:
+        self.recent += (elapsed - self.recent) * self.smoothing
+      self.last_call = start
+
+
+class HookScheduler:
+  """Game code that runs on a cadence, instead of all of it after every
+  physics step (Game.post_physics_step), which multiplies with the steps a
+  slow frame has to catch up on. A hook is called as function(game), and
+  its cadence is one of:
+    step: after every physics step, for things that need step precision.
+    frame: once per update(), however many steps that ran.
+    interval: every `interval` seconds of simulation time (game.clock), so
+      it keeps in step with the simulation, checked after every step.
+    idle: once per frame, but only if the frame pacer has time left over
+      before the next frame, going by how long its recent calls took. One
+      that hasn't had a turn for max_idle_wait seconds (we're behind, it
+      had one slow call, or we're headless) gets called anyway.
+
+  With --pipeline the physics steps run on another thread while the frame
+  draws, and step and interval hooks can't run there in between. They get
+  their calls after the frame's steps are all done, once per step, and
+  every one sees the world and game.clock as of the last step (see
+  Game.draw_pipelined()).
+
+  Every hook keeps its calls and time spent, see table() (F3 shows it
+  along with the collision profile).
+  """
+
+  max_idle_wait = 1.0  # Seconds an idle hook can go without a call
+
+  def __init__(self, game):
+    self.game = game
+    self.hooks = {cadence: [] for cadence in CADENCES}
+
+  def add(self, function, cadence='step', interval=None, name=None):
+    """Start calling function(game) on cadence. Returns the Hook, for
+    remove() and its timing."""
+    if cadence not in self.hooks:
+      raise ValueError(f'Unknown hook cadence {cadence!r}, pick one of {", ".join(CADENCES)}')
+    if (cadence == 'interval') != (interval is not None):
+      raise ValueError('interval goes with the interval cadence, and only with it')
+    hook = Hook(function, cadence, interval, name)
+    if cadence == 'interval':
+      hook.next_time = self.game.clock.time + interval
+    self.hooks[cadence].append(hook)
+    return hook
+
+  def remove(self, hook):
+    self.hooks[hook.cadence].remove(hook)
+
+  def run(self, cadence):
+    game = self.game
+    for hook in list(self.hooks[cadence]):
+      hook(game)
+
+  def run_step(self):
+    """After a physics step: the step hooks, and interval hooks that are due."""
+    game = self.game
+    for hook in list(self.hooks['step']):
+      hook(game)
+    now = game.clock.time
+    for hook in list(self.hooks['interval']):
+      if now >= hook.next_time:
+        hook(game)
+        # Once per step at most. If we're way behind, start over from now
+        # rather than calling it over and over.
+        hook.next_time = max(hook.next_time + hook.interval, now)
+
+  def run_idle(self, time_left):
+    """Idle hooks that look like they fit in time_left seconds, going by
+    how long their recent calls took, plus any that have waited too long.
+    A lifetime average would let one slow call (say, the first layout of a
+    label) starve a hook for good, it'd never get the calls to bring it
+    back down."""
+    game = self.game
+    for hook in list(self.hooks['idle']):
+      start = time.perf_counter()
+      if hook.recent > time_left and start - hook.last_call < self.max_idle_wait:
+        continue
+      hook(game)
+      time_left -= time.perf_counter() - start
+
+  def table(self):
+    """The timings as text, slowest first."""
+    rows = sorted((hook for hooks in self.hooks.values() for hook in hooks), key=lambda hook: -hook.seconds)
+    lines = [f'{"hook":<20} {"cadence":<9} {"calls":>8} {"ms":>9} {"us/call":>8} {"worst us":>9}']
+    for hook in rows:
+      lines.append(
+          f'{hook.name[:20]:<20} {hook.cadence:<9} {hook.calls:>8} {hook.seconds * 1000:>9.1f} '
+          f'{hook.average * 1e6:>8.1f} {hook.worst * 1e6:>9.1f}')
+    return '\n'.join(lines)
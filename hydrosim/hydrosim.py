@@ -3,13 +3,15 @@ import functools
 import logging
 import math
 from random import random, randint
-import time
 import traceback
 
+import numpy as np
 import pyglet
 import pymunk
 
 from objects import GameObject
+import fluid
+import lod
 import resources
 
 KEY = pyglet.window.key
@@ -22,13 +24,6 @@ MOUSE_X = 0
 MOUSE_Y = 0
 
 
-def ALL_MASKS():  # So it works from either old or new pymunk
-  try:
-    return pymunk.ShapeFilter.ALL_MASKS()
-  except:
-    return pymunk.ShapeFilter.ALL_MASKS
-
-
 class Drop(GameObject):
   #image = resources.bullet_image
   image = resources.coconut_image
@@ -40,28 +35,19 @@ class Drop(GameObject):
     pyglet.sprite.Sprite.update(self, scale=scale * 0.1)
 
   @staticmethod
-  def collision_Floor_begin(arbiter, space, data):
-    drop_shape, floor_shape = arbiter.shapes
-    game = data['game']
-
-    # This can fail because pymunk is silly.
-    try:
-      drop_obj = game.get_object_from_body(drop_shape.body)
-      floor_obj = game.get_object_from_body(floor_shape.body)
-    except KeyError:
-      game.play_effect("wilhelm")
-      return False
+  def collision_Floor_begin(contact):
+    game = contact.game
+    drop_obj = contact.src
+    floor_obj = contact.dst
 
     if floor_obj.is_goal:
       drop_obj.delete()
-      if drop_obj in game.drops:
-        game.drops.remove(drop_obj)
 
     else:
       # Sound effect
       '''
-      if arbiter.is_first_contact:
-        print(f'thing={arbiter.impulse_velocity}')
+      if contact.first_contact:
+        print(f'thing={contact.arbiter.impulse_velocity}')
         volume = 0.5  # arbiter.total_ke
         if floor_obj.is_boing:
           game.play_effect("boing", volume=volume)
@@ -70,50 +56,41 @@ class Drop(GameObject):
       '''
 
       #force = Vec2d(1000, 0)
-      force = arbiter.normal * (10000 if floor_obj.is_boing else 100)
-      drop_shape.body.apply_impulse_at_local_point(force, (0, 0))
+      force = contact.normal * (10000 if floor_obj.is_boing else 100)
+      game.commands.apply_impulse(drop_obj, force)
 
     return True
 
   @staticmethod
-  def collision_Floor_post_solve(arbiter, space, data):
-    drop_shape, floor_shape = arbiter.shapes
-    game = data['game']
-
-    # This can fail because pymunk is silly.
-    try:
-      drop_obj = game.get_object_from_body(drop_shape.body)
-      floor_obj = game.get_object_from_body(floor_shape.body)
-    except KeyError:
-      game.play_effect("wilhelm")
-      return False
-
-    if not floor_obj.is_goal:
-      # Sound effect
-      if arbiter.is_first_contact:
-        print(f'thing={arbiter.total_ke}')
-        volume = 0.0
-        #if arbiter.total_ke < 100000:
-        #  try:
-        #    volume = math.log10(arbiter.total_ke) / 6.0
-        #  except ValueError:
-        #    volume = 0.5
-        #if arbiter.total_ke < 10000:
-        #  volume = 0.0
-        mass = drop_obj.body.mass
-        energy = arbiter.total_ke
-
-        print(f"volume == {volume}")
-        if floor_obj.is_boing:
-          game.play_effect("boing", volume=volume)
-        elif energy > 1000000:
-          game.play_effect("blip", volume=1.0)
+  def collision_Floor_batch(events, game):
+    # Every drop/floor contact from the whole step at once, so a big pile of
+    # drops sitting on a floor doesn't cost a Python call per drop.
+    first = events.first_contact
+    if not first.any():
+      return
+
+    # Sound effects, at most one of each per step however many drops landed
+    energy = events.total_ke[first]
+    floors = events.objects(events.dst[first])
+    is_boing = np.array([floor is not None and floor.is_boing for floor in floors])
+    is_goal = np.array([floor is None or floor.is_goal for floor in floors])
+    volume = 0.0
+    #if energy < 100000:
+    #  try:
+    #    volume = math.log10(energy) / 6.0
+    #  except ValueError:
+    #    volume = 0.5
+    #if energy < 10000:
+    #  volume = 0.0
+    if (is_boing & ~is_goal).any():
+      game.play_effect("boing", volume=volume)
+    if (~is_boing & ~is_goal & (energy > 1000000)).any():
+      game.play_effect("blip", volume=1.0)
 
 
 class Floor(GameObject):
   image = resources.bullet_image
   collides_with = ['Drop']
-  shape_to_obj = {}  # Map pymunk 'body' shape Segments to their owning Floor object
 
   def create_body(
       self,
@@ -138,7 +115,6 @@ class Floor(GameObject):
     self.shapes['body'].elasticity = 0.8
     self.shapes['body'].friction = 0.8
     self.shapes['body'].collision_type = self.collision_type  # Very important!
-    self.shape_to_obj[self.shapes['body']] = self
 
     self.body.angle += rotate
 
@@ -163,66 +139,63 @@ class Floor(GameObject):
   def update(self, now, dt):
     self.rect.rotation = math.degrees(-self.body.angle) + 180
 
-  def cleanup(self):
-    # Called when we get deleted, remove our entry from our shape_to_obj tracking map
-    for shape, obj in list(self.shape_to_obj.items()):
-      if obj is self:
-        del self.shape_to_obj[shape]
-
 
 def configure(config):
-  config.physics = 'pymunk'
+  if config.physics == 'cheesy':
+    logging.warning('The cheesy engine has no collision response, the drops will fall right through the floors')
   config.fps = 120
   config.fullscreen = True
   config.window_width = None
   config.window_height = None
   #config.vsync = True
+  if config.sleep_time is None:
+    config.sleep_time = 0.5  # Let the piles of drops at the bottom doze off
 
 
-def update(game):
-  # Settings and stuff
-  min_x, min_y = 0, 0
-  max_x, max_y = game.window.get_size()
+# Our bits of game logic, run by game.hooks (see init()) only as often as
+# they need to be.
 
+def spawn_drop(game):
+  """Interval hook, one new drop every time it's called."""
   max_drops = 2000
-  drops_per_second = 1  #XXX 100 before
-  seconds_per_drop = 1 / drops_per_second
   drop_spawn = (1000, 500)
   spawn_jitter = (100, 100)
   max_scale = 10.0  # TODO: we got the sprite to scale, but not the collision body. fix that so things look way better.
 
-  # Drop spawner
-  if time.time() - game.last_drop > seconds_per_drop:
-    game.last_drop = time.time()
+  if len(game.drops) >= max_drops:
+    return
+
+  x_jitter = randint(-spawn_jitter[0]/2, spawn_jitter[0]/2)
+  y_jitter = randint(-spawn_jitter[1]/2, spawn_jitter[1]/2)
 
-    if len(game.drops) < max_drops:
-      x_jitter = randint(-spawn_jitter[0]/2, spawn_jitter[0]/2)
-      y_jitter = randint(-spawn_jitter[1]/2, spawn_jitter[1]/2)
+  #scale = 1 + random() * max_scale  # big ones take up most of the space.
+  scale = 1.0
+  while random() < 0.8 and scale < max_scale:
+    scale += random()
 
-      #scale = 1 + random() * max_scale  # big ones take up most of the space.
-      scale = 1.0
-      while random() < 0.8 and scale < max_scale:
-        scale += random()
+  drop = Drop(
+    x=drop_spawn[0] + x_jitter,
+    y=drop_spawn[1] + y_jitter,
+    mass=randint(1, 10),  # Massless dynamic bodies end up at NaN
+    scale=min(scale, max_scale),
+  )
+  game.add_object(drop)
 
-      drop = Drop(
-        x=drop_spawn[0] + x_jitter,
-        y=drop_spawn[1] + y_jitter,
-        mass=randint(0, 10),
-        scale=min(scale, max_scale),
-      )
-      game.drops.append(drop)
-      game.add_object(drop)
 
-  # Delete fallen drops
-  for drop in list(game.drops):
+def cull_drops(game):
+  """Frame hook, deletes drops that left the screen."""
+  max_x, max_y = game.window.get_size()
+
+  # Backwards, since deleting a drop shuffles the last one into its spot
+  # (see registry.ObjectRegistry).
+  for drop in reversed(game.drops):
     x, y = drop.body.position
     if y < 0 or y > max_y or x < 0 or x > max_x:
       drop.delete()
-      game.drops.remove(drop)
 
-  game.obj_count_update()
 
-  # Draw the floor cursor
+def update_cursor_preview(game):
+  """Frame hook, draws the floor cursor for a while after it turned."""
   if game.show_cursor_frames_left > 0:
     if game.show_cursor is None:
       game.show_cursor = pyglet.shapes.Rectangle(
@@ -241,7 +214,47 @@ def update(game):
   elif game.show_cursor:
     game.show_cursor.delete()
     game.show_cursor = None
- 
+
+
+def update_fluid(game):
+  """Frame hook for --fluid, pours in particles and deletes fallen ones."""
+  max_x, max_y = game.window.get_size()
+  spawn = (1000, 500)
+  jitter = (100, 100)
+  max_particles = 30000
+  particles_per_second = 2000
+
+  # Pour in however many particles we're due since last time
+  now = game.clock.time
+  due = min(int((now - game.last_drop) * particles_per_second), max_particles - len(game.fluid))
+  if due > 0:
+    game.last_drop = now
+    offsets = (np.random.random((due, 2)) - 0.5) * jitter
+    game.fluid.add(np.array(spawn) + offsets, velocities=(0, -200))
+  elif len(game.fluid) >= max_particles:
+    game.last_drop = now
+
+  # Delete fallen particles
+  x, y = game.fluid.position[:len(game.fluid)].T
+  fallen = (y < 0) | (y > max_y) | (x < 0) | (x > max_x)
+  if fallen.any():
+    game.fluid.remove(fallen)
+
+
+def fluid_contact(fluid, rows, walls, normals):
+  # Same deal as Drop.collision_Floor_begin(): goals eat water, boing floors
+  # fling it away.
+  is_goal = np.array([floor.is_goal for floor in fluid.walls])[walls]
+  is_boing = np.array([floor.is_boing for floor in fluid.walls])[walls]
+  if is_boing.any():
+    boing_speed = 1500
+    bounced, normal = rows[is_boing], normals[is_boing]
+    speed = (fluid.velocity[bounced] * normal).sum(axis=1)
+    fluid.velocity[bounced] += normal * np.maximum(boing_speed - speed, 0)[:, None]
+  if is_goal.any():
+    fluid.remove(rows[is_goal])
+
+
 def on_mouse_press(game, x, y, button, modifiers):
   #print(f'on_mouse_press(x={x}, y={y}, button={button}, modifiers={modifiers})')
   if button in (MOUSE.LEFT, MOUSE.MIDDLE):
@@ -250,14 +263,9 @@ def on_mouse_press(game, x, y, button, modifiers):
     floor = Floor(x=x, y=y, rotate=angle, batch=game.main_batch, is_boing=button == MOUSE.MIDDLE)
     game.add_object(floor)
   elif button == MOUSE.RIGHT:
-    point = (x, y)
-    info = game.physics.space.point_query_nearest(
-      point,
-      max_distance=250,
-      shape_filter=pymunk.ShapeFilter(categories=ALL_MASKS() ^ Floor.collision_type),
-    )
-    if info and info.shape and info.shape in Floor.shape_to_obj:
-      Floor.shape_to_obj[info.shape].delete()
+    floor = game.physics.nearest((x, y), cls=Floor, max_distance=250)
+    if floor:
+      floor.delete()
 
 
 def on_mouse_motion(game, x, y, dx, dy):
@@ -267,7 +275,9 @@ def on_mouse_motion(game, x, y, dx, dy):
   MOUSE_Y = y
 
   if game.cursor_obj:
-    game.cursor_obj.body.position = (x, y)
+    # Sweep over there during the next step, so it shoves drops around instead
+    # of jumping through them.
+    game.cursor_obj.move_to((x, y), game.cursor_angle)
     game.cursor_obj.rect.position = (x, y)
 
   if game.show_cursor:
@@ -276,23 +286,25 @@ def on_mouse_motion(game, x, y, dx, dy):
 def on_mouse_scroll(game, x, y, scroll_x, scroll_y):
   game.cursor_angle += scroll_y * 0.05
   game.show_cursor_frames_left = 100
+  if game.cursor_obj:
+    game.cursor_obj.move_to((MOUSE_X, MOUSE_Y), game.cursor_angle)
 
 
 def on_key_press(game, symbol, modifiers):  # Basic, one direction at a time
   current_magnitude = 900  #XXX
 
   if symbol == KEY.LEFT:
-    game.physics.space.gravity = (-current_magnitude, 0)
+    game.physics.gravity = (-current_magnitude, 0)
   elif symbol == KEY.RIGHT:
-    game.physics.space.gravity = (current_magnitude, 0)
+    game.physics.gravity = (current_magnitude, 0)
   elif symbol == KEY.UP:
-    game.physics.space.gravity = (0, current_magnitude)
+    game.physics.gravity = (0, current_magnitude)
   elif symbol == KEY.DOWN:
-    game.physics.space.gravity = (0, -current_magnitude)
+    game.physics.gravity = (0, -current_magnitude)
 
 
 def on_key_press2(game, symbol, modifiers):  # Toggle gravity in each direction
-  current = list(game.physics.space.gravity)
+  current = list(game.physics.gravity)
 
   if symbol == KEY.LEFT:
     current[0] = 0 if current[0] else 900
@@ -305,21 +317,33 @@ def on_key_press2(game, symbol, modifiers):  # Toggle gravity in each direction
   else:
     return
 
-  game.physics.space.gravity = current
+  game.physics.gravity = current
 
 
 def init(game):
   # Set background RGBA
   pyglet.gl.glClearColor(255, 255, 255, 255)
 
-  # Game state for our update() method
-  game.last_drop = time.time()
-  game.drops = []
+  # Game state for our hooks
+  game.last_drop = game.clock.time
+  game.drops = game.physics.registry.view(Drop)  # Kept up to date for us
   screen_width, screen_height = game.window.get_size()
   center_x = screen_width / 2
   center_y = screen_height / 2
   game.cursor_obj = None
 
+  # Tens of thousands of particles of water instead of pymunk drops
+  game.fluid = None
+  if game.config.fluid:
+    game.fluid = fluid.FluidSystem(game, Floor, on_contact=fluid_contact)
+    game.systems.append(game.fluid)
+
+  # Freeze the drops piling up at the bottom once they settle down
+  game.lod = None
+  if game.config.lod and game.fluid is None:
+    game.lod = lod.PileLOD(game, Drop, anchors=(Floor,))
+    game.systems.append(game.lod)
+
   if game.config.cursor:
     game.cursor_obj = Floor(x=0, y=0, rotate=0, height=200, batch=game.main_batch, body_type=pymunk.Body.KINEMATIC)
     game.add_object(game.cursor_obj)
@@ -340,16 +364,21 @@ def init(game):
       'font_name': 'Courier New',
       'font_size': 16,
       'color': (80, 80, 120, 255),
-      'x': screen_width - 200,
+      'x': screen_width - 360,
       'y': screen_height - 40,
       'batch': game.main_batch,
   }
   obj_count_label = pyglet.text.Label("Objects: 0", **text_opts)
 
-  def obj_count_update():
-    obj_count_label.text = f"objects: {len(game.drops)}"
+  def obj_count_update(game):
+    if game.fluid is not None:
+      obj_count_label.text = f"particles: {len(game.fluid)}"
+      return
+    moving = len(game.drops) - (game.lod.frozen_count if game.lod else 0)
+    obj_count_label.text = f"objects: {len(game.drops)} ({moving} moving)"
 
-  game.obj_count_update = obj_count_update
+  # Relaying out the label is slow, and nobody needs it every frame.
+  game.hooks.add(obj_count_update, 'idle')
 
   # Throw in a floor or two
   floor1 = Floor(x=1000, y=500, rotate=10, batch=game.main_batch)
@@ -373,6 +402,12 @@ def init(game):
 
   # Damping makes interactions settle down nicely but also causes our asteroids to just "stop" at some point.
   #game.physics.space.damping = 0.8
-  game.post_physics_step = lambda: update(game)
+  drops_per_second = 1  #XXX 100 before
+  if game.fluid is not None:
+    game.hooks.add(update_fluid, 'frame')
+  else:
+    game.hooks.add(spawn_drop, 'interval', interval=1 / drops_per_second)
+    game.hooks.add(cull_drops, 'frame')
+  game.hooks.add(update_cursor_preview, 'frame')
   game.window.set_mouse_visible(True)
   game.play_song('stuff', loop=True)
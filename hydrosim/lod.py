@@ -0,0 +1,187 @@
+import logging
+
+import pymunk
+
+import physics
+
+
+class PileLOD:
+  """Physics level of detail for piles of things that have come to rest,
+  like hydrosim's drops at the bottom of the screen.
+
+  Every `check_interval` seconds it looks for objects of `cls` that have
+  been slower than `rest_speed` for `rest_time` seconds. Resting objects
+  that touch each other form a cluster, and a cluster gets frozen (see
+  PhysicsEngineBase.freeze()) if it's sitting on one of `anchors` (static
+  objects, like floors) or on an already frozen cluster. Resting objects
+  touching one of `cls` that still moves are left out, so the pile freezes
+  from the bottom up while the top is still settling. Frozen objects keep
+  their sprites where they are, they just stop costing anything to
+  simulate.
+
+  Clusters thaw again when:
+    - gravity changes,
+    - something they rest on goes away (a floor gets deleted, or the
+      cluster underneath thaws),
+    - something fast (or kinematic, like hydrosim's cursor) comes within
+      `thaw_radius` of them,
+    - game code applies an impulse to one of them (commands.apply_impulse
+      thaws just that one).
+
+  It's a game system, Game calls step(dt) after every physics step. It
+  doesn't draw anything, so there's no sync().
+  """
+
+  check_interval = 0.25  # Seconds between looks for resting clusters
+  rest_speed = 20.0  # Slower than this counts as resting
+  rest_time = 1.0  # Seconds of resting before we freeze something
+  wake_speed = 150.0  # Faster than this thaws frozen stuff nearby
+  thaw_radius = 10.0  # How close that is, past the edge of the fast thing
+  contact_margin = 2.0  # Gap that still counts as touching
+
+  def __init__(self, game, cls, anchors=()):
+    self.game = game
+    self.cls = cls
+    self.anchors = tuple(anchors)
+    self.objects = game.physics.registry.view(cls)
+    self.rest = {}  # obj -> seconds it's been resting
+    self.clusters = []  # (set of frozen objs, set of objs they rest on)
+    self.gravity = tuple(game.physics.gravity)
+    self.since_check = 0.0
+
+  @property
+  def frozen_count(self):
+    return sum(1 for obj in self.game.physics.frozen if isinstance(obj, self.cls))
+
+  def step(self, dt):
+    physics_engine = self.game.physics
+
+    gravity = tuple(physics_engine.gravity)
+    if gravity != self.gravity:
+      self.gravity = gravity
+      self.thaw_all()
+
+    self._thaw_unsupported()
+    self._wake_near(physics_engine.arriving)
+
+    self.since_check += dt
+    if self.since_check >= self.check_interval:
+      self._check(self.since_check)
+      self.since_check = 0.0
+
+  def thaw_all(self):
+    for members, _ in self.clusters:
+      self.game.physics.thaw(members)
+    self.clusters = []
+    self.rest.clear()
+
+  def _is_frozen(self, obj):
+    return obj in self.game.physics.frozen
+
+  def _thaw_unsupported(self):
+    """Thaw clusters whose anchors went away, until nothing else drops."""
+    changed = True
+    while changed and self.clusters:
+      changed = False
+      kept = []
+      for members, anchors in self.clusters:
+        if any(anchor.deleted or (isinstance(anchor, self.cls) and not self._is_frozen(anchor))
+               for anchor in anchors):
+          self.game.physics.thaw(members)
+          for obj in members:
+            self.rest.pop(obj, None)
+          changed = True
+        else:
+          kept.append((members, anchors))
+      self.clusters = kept
+
+  def _wake_near(self, movers):
+    """Thaw frozen objects close to any of movers."""
+    physics_engine = self.game.physics
+    woken = []
+    for mover in movers:
+      if mover.deleted:
+        continue
+      for shape in mover.shapes.values():
+        shape.cache_bb()
+        bb = shape.bb
+        margin = self.thaw_radius
+        for obj in physics_engine.query_box(
+            (bb.left - margin, bb.bottom - margin, bb.right + margin, bb.top + margin), cls=self.cls):
+          if self._is_frozen(obj):
+            woken.append(obj)
+    if woken:
+      physics_engine.thaw(woken)
+      for obj in woken:
+        self.rest.pop(obj, None)
+      # Whatever was resting on them is taken care of by _thaw_unsupported().
+
+  def _check(self, elapsed):
+    physics_engine = self.game.physics
+
+    # Who's resting, and who's moving fast enough to wake things up
+    resting = set()
+    fast = []
+    for obj in self.objects:
+      if self._is_frozen(obj):
+        continue
+      speed = obj.body.velocity.length
+      if speed < self.rest_speed:
+        self.rest[obj] = self.rest.get(obj, 0.0) + elapsed
+        if self.rest[obj] >= self.rest_time:
+          resting.add(obj)
+      else:
+        self.rest.pop(obj, None)
+        if speed > self.wake_speed:
+          fast.append(obj)
+    self._wake_near(fast)
+    self._thaw_unsupported()
+
+    # Who touches what. Resting objects touching something that still moves
+    # stay awake, they're the edge of the pile.
+    touching = {}
+    for obj in resting:
+      reach = max(physics.bounding_radius(shape) for shape in obj.shapes.values()) + self.contact_margin
+      touching[obj] = [
+          other for other in physics_engine.query_radius(obj.body.position, reach)
+          if other is not obj and not other.deleted]
+    calm = {
+        obj for obj, others in touching.items()
+        if not any(isinstance(other, self.cls) and other not in resting and not self._is_frozen(other)
+                   for other in others)}
+
+    # Flood fill the calm ones into touching clusters, and freeze the ones
+    # that have something to rest on.
+    seen = set()
+    frozen = []
+    for start in calm:
+      if start in seen:
+        continue
+      seen.add(start)
+      members, anchors = {start}, set()
+      todo = [start]
+      while todo:
+        for other in touching[todo.pop()]:
+          if other in calm:
+            if other not in seen:
+              seen.add(other)
+              members.add(other)
+              todo.append(other)
+          elif self._is_frozen(other) and isinstance(other, self.cls):
+            anchors.add(other)
+          elif isinstance(other, self.anchors) and other.body.body_type == pymunk.Body.STATIC:
+            anchors.add(other)
+
+      if anchors:
+        physics_engine.freeze(members)
+        members = {obj for obj in members if self._is_frozen(obj)}  # Massless ones stay as they are
+        if members:
+          self.clusters.append((members, anchors))
+          frozen.extend(members)
+
+    for obj in frozen:
+      self.rest.pop(obj, None)
+    for obj in [obj for obj in self.rest if obj.deleted]:
+      del self.rest[obj]
+    if frozen:
+      logging.debug(f'PileLOD: froze {len(frozen)} {self.cls.__name__}s, {self.frozen_count} frozen in {len(self.clusters)} clusters')
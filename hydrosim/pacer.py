@@ -0,0 +1,80 @@
+import time
+
+import numpy as np
+
+
+class FramePacer:
+  """Keeps frames a steady `frame_time` apart, see Game.run().
+
+  time.sleep() on its own wakes up whenever the OS gets round to it, which
+  can be a millisecond or more late, and pyglet's scheduler is built on it.
+  So we sleep until `spin_time` before the deadline and busy-wait the rest,
+  which costs a bit of CPU per frame and gets us within microseconds.
+
+  With `synced` on (vsync), flipping the window already waits for the
+  display, so wait() doesn't, it just keeps the stats.
+
+  The last `history` frame intervals are kept for stats(), the typical and
+  worst frame times and how far off the target they are.
+  """
+
+  spin_time = 0.002  # Seconds before the deadline we stop sleeping and spin
+  history = 600
+
+  def __init__(self, frame_time, synced=False):
+    self.frame_time = frame_time
+    self.synced = synced
+    self.deadline = None
+    self.last_frame = None
+    self.intervals = np.zeros(self.history)
+    self.count = 0  # Intervals recorded so far
+    self.late_frames = 0  # Frames that missed their deadline
+
+  def wait(self):
+    """Wait until it's time for the next frame to start, and return how
+    long it's been since the last one started."""
+    now = time.perf_counter()
+    if self.deadline is None:
+      self.deadline = now
+    elif not self.synced:
+      if now > self.deadline:
+        self.late_frames += 1
+      else:
+        sleep = self.deadline - now - self.spin_time
+        if sleep > 0:
+          time.sleep(sleep)
+        while time.perf_counter() < self.deadline:
+          pass
+      now = time.perf_counter()
+
+    # Late frames push the schedule back rather than rushing the next few
+    # out to catch up.
+    self.deadline = max(self.deadline + self.frame_time, now)
+    interval = 0.0 if self.last_frame is None else now - self.last_frame
+    if self.last_frame is not None:
+      self.intervals[self.count % self.history] = interval
+      self.count += 1
+    self.last_frame = now
+    return interval
+
+  def time_left(self):
+    """Seconds until the next frame is due."""
+    if self.deadline is None:
+      return 0.0
+    return max(self.deadline - time.perf_counter(), 0.0)
+
+  def stats(self):
+    """Frame interval percentiles and jitter (how far intervals are from
+    frame_time) in milliseconds, over the last `history` frames. None until
+    there's been a frame."""
+    if not self.count:
+      return None
+    intervals = self.intervals[:min(self.count, self.history)] * 1000
+    jitter = np.abs(intervals - self.frame_time * 1000)
+    p50, p95, p99 = np.percentile(intervals, (50, 95, 99))
+    j50, j95, j99 = np.percentile(jitter, (50, 95, 99))
+    return {
+        'p50': p50, 'p95': p95, 'p99': p99,
+        'jitter_p50': j50, 'jitter_p95': j95, 'jitter_p99': j99,
+        'late_frames': self.late_frames,
+    }
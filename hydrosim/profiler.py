@@ -0,0 +1,57 @@
+import time
+
+
+class CollisionProfiler:
+  """Counts and times collision handler calls per (src class, dst class,
+  phase), to find out which class pair is eating the step budget.
+
+  The physics engines only route handlers through here while `enabled` is
+  on, otherwise they're bound directly and this costs nothing.
+  """
+
+  def __init__(self):
+    self.enabled = False
+    self.stats = {}  # (src name, dst name, phase) -> [calls, accepted, rejected, seconds]
+
+  def reset(self):
+    self.stats.clear()
+
+  def call(self, key, method, *args):
+    stats = self.stats.get(key)
+    if stats is None:
+      stats = self.stats[key] = [0, 0, 0, 0.0]
+    start = time.perf_counter()
+    try:
+      result = method(*args)
+    finally:
+      stats[3] += time.perf_counter() - start
+      stats[0] += 1
+    if result is False:
+      stats[2] += 1
+    else:
+      stats[1] += 1
+    return result
+
+  def wrap(self, src_class, dst_class, phase, method):
+    """Return a stand-in for a collision handler method that records it."""
+    key = (src_class.__name__, dst_class.__name__, phase)
+
+    def profiled(*args):
+      return self.call(key, method, *args)
+
+    profiled.__name__ = method.__name__
+    return profiled
+
+  def table(self):
+    """The stats as text, slowest first."""
+    rows = sorted(self.stats.items(), key=lambda item: -item[1][3])
+    lines = [f'{"src":<10} {"dst":<10} {"phase":<10} {"calls":>8} {"ok":>8} {"reject":>7} {"ms":>9} {"us/call":>8}']
+    for (src, dst, phase), (calls, accepted, rejected, seconds) in rows:
+      lines.append(
+          f'{src:<10} {dst:<10} {phase:<10} {calls:>8} {accepted:>8} {rejected:>7} '
+          f'{seconds * 1000:>9.1f} {seconds * 1e6 / max(calls, 1):>8.1f}')
+    return '\n'.join(lines)
+
+  def dump(self, path):
+    with open(path, 'w') as f:
+      f.write(self.table() + '\n')
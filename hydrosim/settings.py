@@ -1,6 +1,8 @@
 import argparse
+import os
 import random
 import sys
+import tempfile
 
 import physics
 import resources
@@ -33,9 +35,44 @@ def build_config(args=None):
       default=60,
       help='Game updates per second')
 
+  parser.add_argument(
+      '--physics-fps',
+      type=int,
+      default=None,
+      help='Physics steps per second, overriding what the game module picks')
+
+  parser.add_argument(
+      '--render-fps',
+      type=int,
+      default=None,
+      help='Frames drawn per second, with sprites interpolated between physics steps (default: one frame per physics step, no interpolation)')
+
+  parser.add_argument(
+      '--time-scale',
+      type=float,
+      default=1.0,
+      help='Seconds of simulation per second of real time, F6/F7 halve/double it and F5 pauses')
+
   parser.add_argument('--fullscreen', action='store_true')
   parser.add_argument('--vsync', action='store_true')
 
+  parser.add_argument(
+      '--headless',
+      action='store_true',
+      help='No window, no drawing, no sound: just step the physics as fast as it goes')
+
+  parser.add_argument(
+      '--headless-size',
+      default='1920x1080',
+      metavar='WIDTHxHEIGHT',
+      help='How big the game thinks the window is with --headless')
+
+  parser.add_argument(
+      '--steps',
+      type=int,
+      default=0,
+      help='With --headless, stop after this many physics steps (default: run until Ctrl-C)')
+
   parser.add_argument(
       '--window-width',
       type=int,
@@ -50,7 +87,101 @@ def build_config(args=None):
       '--physics',
       default='pymunk',
       choices=sorted(physics.IMPLEMENTATIONS),
-      help='Which physics engine to use')
+      help='Which physics engine to use. pymunk is the fastest at the sizes these games run at, '
+           'vectorized only pulls ahead of it past about 50k bodies (see benchmark.py)')
+
+  parser.add_argument(
+      '--max-steps',
+      type=int,
+      default=8,
+      help='Most physics steps a frame runs to catch up, 0 for no limit')
+
+  parser.add_argument(
+      '--overload',
+      default='drop',
+      choices=['drop', 'slow', 'spread'],
+      help='What happens to the time past --max-steps: dropped, the simulation slows down, or it gets caught up later')
+
+  parser.add_argument(
+      '--pipeline',
+      action='store_true',
+      help='Run the next frame\'s physics steps on a background thread while this one draws. '
+           'Per-step game code (step hooks, post_physics_step) then runs after all of them')
+
+  parser.add_argument(
+      '--broadphase',
+      default='grid',
+      choices=['grid', 'all-pairs'],
+      help='How the cheesy physics engine finds colliding pairs')
+
+  parser.add_argument(
+      '--grid-cell-size',
+      type=float,
+      default=None,
+      help='Broadphase grid cell size in pixels (default: median object size)')
+
+  parser.add_argument(
+      '--autotune',
+      action='store_true',
+      help='Let the pymunk engine tune the settings below that aren\'t given')
+
+  parser.add_argument(
+      '--iterations',
+      type=int,
+      default=None,
+      help='pymunk solver iterations (pymunk default: 10)')
+
+  parser.add_argument(
+      '--collision-slop',
+      type=float,
+      default=None,
+      help='How much pymunk lets shapes overlap (pymunk default: 0.1)')
+
+  parser.add_argument(
+      '--spatial-hash',
+      default=None,
+      metavar='DIM,COUNT',
+      help='Use a pymunk spatial hash with this cell size and cell count instead of the bb tree')
+
+  parser.add_argument(
+      '--threads',
+      type=int,
+      default=None,
+      choices=[1, 2],
+      help='pymunk solver threads')
+
+  parser.add_argument(
+      '--sleep-time',
+      type=float,
+      default=None,
+      help='Seconds a pymunk body has to sit still before it falls asleep (default: never)')
+
+  parser.add_argument(
+      '--idle-speed',
+      type=float,
+      default=None,
+      help='Speed under which a pymunk body counts as sitting still (pymunk default: based on gravity)')
+
+  parser.add_argument(
+      '--fluid',
+      action='store_true',
+      help='Simulate the water as a particle fluid instead of pymunk drops')
+
+  parser.add_argument(
+      '--no-lod',
+      dest='lod',
+      action='store_false',
+      help='Don\'t freeze piles of drops that have come to rest')
+
+  parser.add_argument(
+      '--profile-collisions',
+      action='store_true',
+      help='Count and time collision handlers from the start (F3 toggles, F4 saves)')
+
+  parser.add_argument(
+      '--profile-file',
+      default=os.path.join(tempfile.gettempdir(), 'collision_profile.txt'),
+      help='Where F4 saves the collision handler profile (default: the temp dir, not the checkout)')
 
   parser.add_argument(
       '--gravity',
@@ -68,6 +199,19 @@ def build_config(args=None):
   config = parser.parse_args(args)
 
   # Validate the config is good before returning it, raise useful error message.
+  if config.spatial_hash:
+    try:
+      dim, count = config.spatial_hash.split(',')
+      config.spatial_hash = (float(dim), int(count))
+    except ValueError:
+      raise ConfigError(f'--spatial-hash wants DIM,COUNT like 20,5000, not {config.spatial_hash}')
+
+  try:
+    width, height = config.headless_size.lower().split('x')
+    config.headless_size = (int(width), int(height))
+  except ValueError:
+    raise ConfigError(f'--headless-size wants WIDTHxHEIGHT like 1920x1080, not {config.headless_size}')
+
   if config.fullscreen:
     config.window_width = None
     config.window_height = None
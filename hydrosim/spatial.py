@@ -0,0 +1,426 @@
+import math
+import statistics
+
+import numpy as np
+
+
+def object_bb(obj):
+  """Return the (left, bottom, right, top) box around all of obj's shapes.
+
+  This also refreshes pymunk's cached shape data, which the narrowphase
+  (shape.shapes_collide) relies on when the body isn't in a pymunk.Space.
+  """
+  left = bottom = math.inf
+  right = top = -math.inf
+  for shape in obj.shapes.values():
+    bb = shape.cache_bb()
+    left = min(left, bb.left)
+    bottom = min(bottom, bb.bottom)
+    right = max(right, bb.right)
+    top = max(top, bb.top)
+  return left, bottom, right, top
+
+
+def pick_cell_size(bbs):
+  """Derive a cell size from a bunch of bounding boxes.
+
+  Using the median object diameter means a typical object touches 1-4 cells,
+  while a handful of huge ones (like hydrosim's screen wide floors) don't blow
+  up the cell size for everybody else.
+  """
+  extents = [max(r - l, t - b) for l, b, r, t in bbs]
+  if not extents:
+    return 64.0
+  return max(statistics.median(extents), 1.0)
+
+
+class SpatialGrid:
+  """Uniform grid (aka spatial hash) broadphase.
+
+  Objects get bucketed into every cell their bounding box touches. Moving an
+  object only touches the cell dict when it actually crosses a cell boundary,
+  so a mostly-settled world costs nearly nothing to keep up to date.
+
+  Objects spanning more than `max_cells` cells are kept in a separate 'large'
+  set instead, since bucketing a screen wide floor into thousands of cells is
+  a great way to make every step slow. Those get checked against everybody
+  at once with numpy, off a copy of the bounding boxes kept as an array.
+  """
+
+  def __init__(self, cell_size, max_cells=64):
+    self.cell_size = float(cell_size)
+    self.max_cells = max_cells
+    self.cells = {}  # (cx, cy) -> set of objects
+    self.ranges = {}  # obj -> (cx0, cy0, cx1, cy1), or None when 'large'
+    self.bbs = {}  # obj -> (left, bottom, right, top)
+    self.large = set()
+    # The same bounding boxes as rows of an array, for the large objects.
+    self.rows = {}  # obj -> row in boxes and row_objs
+    self.row_objs = []
+    self.boxes = np.empty((16, 4))
+
+  def __len__(self):
+    return len(self.ranges)
+
+  def __contains__(self, obj):
+    return obj in self.ranges
+
+  def cell_range(self, bb):
+    size = self.cell_size
+    left, bottom, right, top = bb
+    return (
+        math.floor(left / size), math.floor(bottom / size),
+        math.floor(right / size), math.floor(top / size))
+
+  def insert(self, obj, bb):
+    if obj in self.ranges:
+      raise Exception(f'Object {obj} already in the grid')
+    self.bbs[obj] = bb
+    self.ranges[obj] = self._bucket(obj, self.cell_range(bb))
+    row = len(self.row_objs)
+    if row == len(self.boxes):
+      self.boxes = np.concatenate((self.boxes, np.empty_like(self.boxes)))
+    self.boxes[row] = bb
+    self.rows[obj] = row
+    self.row_objs.append(obj)
+
+  def remove(self, obj):
+    cell_range = self.ranges.pop(obj)
+    del self.bbs[obj]
+    self._unbucket(obj, cell_range)
+    # Swap the last row into the hole.
+    row = self.rows.pop(obj)
+    last = self.row_objs.pop()
+    if last is not obj:
+      self.boxes[row] = self.boxes[len(self.row_objs)]
+      self.row_objs[row] = last
+      self.rows[last] = row
+
+  def update(self, obj, bb):
+    """Move obj to its new bounding box, re-bucketing only if needed."""
+    self.bbs[obj] = bb
+    self.boxes[self.rows[obj]] = bb
+    new_range = self.cell_range(bb)
+    old_range = self.ranges[obj]
+    if old_range == new_range:
+      return
+    if old_range is None and self._too_big(new_range):
+      return  # Still large, nothing to do.
+    self._unbucket(obj, old_range)
+    self.ranges[obj] = self._bucket(obj, new_range)
+
+  def _too_big(self, cell_range):
+    cx0, cy0, cx1, cy1 = cell_range
+    return (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > self.max_cells
+
+  def _bucket(self, obj, cell_range):
+    if self._too_big(cell_range):
+      self.large.add(obj)
+      return None
+
+    cx0, cy0, cx1, cy1 = cell_range
+    for cx in range(cx0, cx1 + 1):
+      for cy in range(cy0, cy1 + 1):
+        cell = self.cells.get((cx, cy))
+        if cell is None:
+          cell = self.cells[(cx, cy)] = set()
+        cell.add(obj)
+    return cell_range
+
+  def _unbucket(self, obj, cell_range):
+    if cell_range is None:
+      self.large.discard(obj)
+      return
+
+    cx0, cy0, cx1, cy1 = cell_range
+    for cx in range(cx0, cx1 + 1):
+      for cy in range(cy0, cy1 + 1):
+        cell = self.cells[(cx, cy)]
+        cell.discard(obj)
+        if not cell:
+          del self.cells[(cx, cy)]
+
+  def query(self, bb):
+    """Return the set of objects whose bounding boxes overlap bb."""
+    left, bottom, right, top = bb
+    found = set()
+    if all(math.isfinite(value) for value in bb):
+      cx0, cy0, cx1, cy1 = self.cell_range(bb)
+      area = (cx1 - cx0 + 1) * (cy1 - cy0 + 1)
+    else:
+      area = math.inf
+    if area <= len(self.cells):
+      for cx in range(cx0, cx1 + 1):
+        for cy in range(cy0, cy1 + 1):
+          found.update(self.cells.get((cx, cy), ()))
+      found.update(self.large)
+      candidates = found
+    else:
+      candidates = self.bbs  # Huge query, cheaper to just look at everything
+
+    bbs = self.bbs
+    return {
+        obj for obj in candidates
+        if not (bbs[obj][0] > right or left > bbs[obj][2] or bbs[obj][1] > top or bottom > bbs[obj][3])}
+
+  def candidate_pairs(self):
+    """Yield each pair of objects whose bounding boxes overlap, exactly once."""
+    bbs = self.bbs
+    ranges = self.ranges
+
+    for (cx, cy), cell in self.cells.items():
+      if len(cell) < 2:
+        continue
+      members = list(cell)
+      for i, obj1 in enumerate(members):
+        range1 = ranges[obj1]
+        l1, b1, r1, t1 = bbs[obj1]
+        for obj2 in members[i + 1:]:
+          l2, b2, r2, t2 = bbs[obj2]
+          if l1 > r2 or l2 > r1 or b1 > t2 or b2 > t1:
+            continue
+          # A pair sharing several cells is only reported from the first
+          # cell they share, so we don't need a 'seen' set.
+          range2 = ranges[obj2]
+          if (cx, cy) != (max(range1[0], range2[0]), max(range1[1], range2[1])):
+            continue
+          yield obj1, obj2
+
+    # Large objects get a plain bounding box check against everybody, all
+    # rows at once.
+    if not self.large:
+      return
+    count = len(self.row_objs)
+    left, bottom, right, top = self.boxes[:count].T
+    done = np.zeros(count, dtype=bool)
+    for big in self.large:
+      row = self.rows[big]
+      done[row] = True
+      bl, bb, br, bt = self.boxes[row]
+      hits = ~done & (left <= br) & (bl <= right) & (bottom <= bt) & (bb <= top)
+      for other in np.flatnonzero(hits).tolist():
+        yield big, self.row_objs[other]
+
+
+# Pair math goes this many pairs at a time. Every step of a numpy formula
+# makes a temporary the size of its input, and with a few hundred thousand
+# pairs those all come from main memory. Blocks this big stay in the cache,
+# which runs about twice as fast, and are still big enough that the Python
+# loop over them doesn't matter.
+BLOCK = 1 << 15
+
+
+def blocks(count):
+  """Slices over range(count), BLOCK at a time."""
+  return [slice(start, start + BLOCK) for start in range(0, count, BLOCK)]
+
+
+def grid_pairs(positions, cell_size, max_distance=None):
+  """Find every pair of points that are at most one grid cell apart.
+
+  This is the numpy flavour of SpatialGrid: points get sorted by cell, then
+  each point's neighbours are found with a table of where each cell starts,
+  so no Python code runs per point. Any two points closer than cell_size are
+  guaranteed to be in the result (plus some that aren't, the caller does the
+  exact distance check).
+
+  Or pass max_distance to get exactly the pairs at most that far apart. The
+  distance check happens here, on points in cell order, which is a lot
+  cheaper than doing it afterwards. max_distance can be bigger than
+  cell_size, then points look that many cells out, and smaller cells waste
+  less time on pairs that turn out too far apart: half of max_distance
+  checks about a third fewer than cells of max_distance.
+
+  Returns two int arrays (i, j) with i != j, each unordered pair once.
+  """
+  count = len(positions)
+  if count < 2:
+    empty = np.empty(0, dtype=np.intp)
+    return empty, empty
+
+  # A NaN position (say, an impulse on a massless body) would wreck the cell
+  # math for everybody, so leave those points out.
+  finite = np.isfinite(positions).all(axis=1)
+  if not finite.all():
+    index = np.flatnonzero(finite)
+    i, j = grid_pairs(positions[index], cell_size, max_distance)
+    return index[i], index[j]
+
+  # How many cells out a point's neighbours can be.
+  reach = 1 if max_distance is None else max(int(np.ceil(max_distance / cell_size)), 1)
+  cells = np.floor(positions / cell_size).astype(np.int64)
+  cx = cells[:, 0] - cells[:, 0].min() + reach  # So neighbours stay >= 0
+  cy = cells[:, 1] - cells[:, 1].min() + reach
+  column = int(cy.max()) + reach + 1
+  keys = cx * column + cy
+
+  order = np.argsort(keys, kind='stable')
+  sorted_keys = keys.take(order)
+  # Work in sorted order from here on, so lookups walk memory in order.
+  if max_distance is not None:
+    x, y = positions[:, 0].take(order), positions[:, 1].take(order)
+    limit = max_distance * max_distance
+
+  # With a reasonably dense world a table of where each cell starts and ends
+  # beats searchsorted by a mile. Sparse worlds would need a huge table though.
+  num_cells = (int(cx.max()) + reach + 1) * column
+  if num_cells <= 8 * count + 1024:
+    cell_counts = np.bincount(sorted_keys, minlength=num_cells)
+    cell_ends = np.cumsum(cell_counts)
+    cell_starts = cell_ends - cell_counts
+    starts, ends = cell_starts.take, cell_ends.take
+  else:
+    starts = lambda keys: np.searchsorted(sorted_keys, keys, side='left')
+    ends = lambda keys: np.searchsorted(sorted_keys, keys, side='right')
+
+  # Each point pairs up with its own cell and half of the ones around it, so
+  # each pair of cells is only visited once. Keys count up a column and then
+  # on to the next, so those cells are runs of points: the rest of our own
+  # cell plus the ones above it, and a run in each column to the right.
+  here = np.arange(count)
+  runs = [(here + 1, ends(sorted_keys + reach))]
+  for dx in range(1, reach + 1):
+    runs.append((starts(sorted_keys + dx * column - reach), ends(sorted_keys + dx * column + reach)))
+  all_i, all_j = [], []
+  for first, last in runs:
+    counts = last - first
+    ends_at = np.cumsum(counts)
+    starts_at = ends_at - counts
+    # A BLOCK of candidates at a time, over points in order.
+    bounds = np.searchsorted(ends_at, np.arange(0, ends_at[-1], BLOCK), side='right').tolist() + [count]
+    for low, high in zip(bounds, bounds[1:]):
+      block_counts = counts[low:high]
+      # Both sides as positions in sorted order, back to point numbers at the end.
+      i = np.repeat(here[low:high], block_counts)
+      j = np.arange(len(i)) + np.repeat(first[low:high] - (starts_at[low:high] - starts_at[low]), block_counts)
+      if max_distance is not None:
+        # repeat() walks memory in order, which take() doesn't, so the i side
+        # goes that way. flatnonzero + take, boolean indexing is several
+        # times slower on arrays this big.
+        delta_x = x.take(j) - np.repeat(x[low:high], block_counts)
+        delta_y = y.take(j) - np.repeat(y[low:high], block_counts)
+        keep = np.flatnonzero(delta_x * delta_x + delta_y * delta_y <= limit)
+        i, j = i.take(keep), j.take(keep)
+      all_i.append(order.take(i))
+      all_j.append(order.take(j))
+
+  if not all_i:
+    empty = np.empty(0, dtype=np.intp)
+    return empty, empty
+  return np.concatenate(all_i), np.concatenate(all_j)
+
+
+class PointGrid:
+  """The cell index grid_pairs() builds, kept around for box queries: points
+  sorted by cell, so the points in a column of cells are one searchsorted
+  away. Asking about a lot of boxes at once costs about as much as asking
+  about one, with no Python code per box or point.
+
+  Points with a NaN in them are left out, same as grid_pairs().
+  """
+
+  def __init__(self, positions, cell_size):
+    self.cell_size = float(cell_size)
+    finite = np.flatnonzero(np.isfinite(positions).all(axis=1))
+    cells = np.floor(positions[finite] / self.cell_size).astype(np.int64)
+    if len(cells):
+      self.low, self.high = cells.min(axis=0), cells.max(axis=0)
+    else:
+      self.low = self.high = np.zeros(2, dtype=np.int64)
+    cells -= self.low
+    self.column = int(self.high[1] - self.low[1]) + 1
+    keys = cells[:, 0] * self.column + cells[:, 1]
+    order = np.argsort(keys, kind='stable')
+    self.keys = keys[order]
+    self.points = finite[order]
+
+  def _cells(self, corners):
+    # Clipped to the grid before going to ints, so huge (or infinite) boxes
+    # just cover every cell.
+    span = (self.high - self.low).astype(np.float64)
+    return np.clip(np.floor(corners / self.cell_size) - self.low, -1, span + 1).astype(np.int64)
+
+  def query(self, lows, highs):
+    """Candidate points for each of the boxes lows[k]-highs[k] (corner
+    arrays shaped (m, 2)): every point inside a box is in there, plus some
+    close by that aren't. Returns (box, point) index arrays."""
+    if not len(self.keys):
+      empty = np.empty(0, dtype=np.intp)
+      return empty, empty
+    low = np.maximum(self._cells(np.asarray(lows, dtype=np.float64)), 0)
+    high = np.minimum(self._cells(np.asarray(highs, dtype=np.float64)), self.high - self.low)
+
+    # One searchsorted per (box, column of cells it covers).
+    columns = np.maximum(high[:, 0] - low[:, 0] + 1, 0) * (high[:, 1] >= low[:, 1])
+    box = np.repeat(np.arange(len(low)), columns)
+    cx = low[box, 0] + np.arange(len(box)) - np.repeat(np.cumsum(columns) - columns, columns)
+    start = np.searchsorted(self.keys, cx * self.column + low[box, 1], side='left')
+    counts = np.searchsorted(self.keys, cx * self.column + high[box, 1], side='right') - start
+
+    total = int(counts.sum())
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(box, counts), self.points[np.repeat(start, counts) + offsets]
+
+
+# Geometry for the numpy engines. Everything broadcasts, so e.g. passing
+# points shaped (m, 1, 2) and segments shaped (1, n, 2) gives (m, n) results.
+
+def point_segment_distances(points, a, b):
+  """Distance from points to the segments a-b, and the unit normal pointing
+  from the segment towards the point."""
+  ab = b - a
+  length2 = np.maximum((ab * ab).sum(axis=-1), 1e-12)
+  t = np.clip(((points - a) * ab).sum(axis=-1) / length2, 0.0, 1.0)
+  delta = points - (a + ab * t[..., None])
+  distance = np.sqrt((delta * delta).sum(axis=-1))
+  normal = delta / np.maximum(distance, 1e-9)[..., None]
+  return distance, normal
+
+
+def ray_circle_alphas(starts, deltas, centers, radii):
+  """How far (0..1) along each ray start + alpha * delta it enters each
+  circle, inf where it doesn't. Like pymunk, a ray starting inside a circle
+  doesn't hit it."""
+  offset = starts - centers
+  qa = np.maximum((deltas * deltas).sum(axis=-1), 1e-12)
+  qb = (offset * deltas).sum(axis=-1)
+  qc = (offset * offset).sum(axis=-1) - radii * radii
+  det = qb * qb - qa * qc
+  with np.errstate(invalid='ignore'):
+    alpha = (-qb - np.sqrt(det)) / qa
+  return np.where((det >= 0) & (alpha >= 0) & (alpha <= 1), alpha, np.inf)
+
+
+def ray_capsule_alphas(starts, deltas, a, b, radii):
+  """ray_circle_alphas() for capsules: the segments a-b fattened by radii.
+  Returns (alpha, normal) where normal is the surface normal at the hit."""
+  ab = b - a
+  length = np.maximum(np.sqrt((ab * ab).sum(axis=-1)), 1e-9)
+  side_normal = np.stack([-ab[..., 1], ab[..., 0]], axis=-1) / length[..., None]
+
+  # Flat sides: the ray has to cross the line `radii` away from the segment,
+  # on the side it starts from, somewhere between the end caps.
+  start_side = ((starts - a) * side_normal).sum(axis=-1)
+  facing = np.where(start_side >= 0, 1.0, -1.0)
+  approach = (deltas * side_normal).sum(axis=-1)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    side_alpha = (facing * radii - start_side) / approach
+  hit = starts + deltas * np.nan_to_num(side_alpha, posinf=0, neginf=0)[..., None]
+  along = ((hit - a) * ab).sum(axis=-1) / (length * length)
+  side_ok = (
+      (np.abs(start_side) > radii) & (side_alpha >= 0) & (side_alpha <= 1)
+      & (along >= 0) & (along <= 1))
+  side_alpha = np.where(side_ok, side_alpha, np.inf)
+
+  # Round ends
+  a_alpha = ray_circle_alphas(starts, deltas, a, radii)
+  b_alpha = ray_circle_alphas(starts, deltas, b, radii)
+
+  alpha = np.minimum(side_alpha, np.minimum(a_alpha, b_alpha))
+  point = starts + deltas * np.where(np.isfinite(alpha), alpha, 0)[..., None]
+  cap_normal = point_segment_distances(point, a, b)[1]
+  normal = np.where(
+      (alpha == side_alpha)[..., None],
+      side_normal * facing[..., None] * np.ones_like(point),
+      cap_normal)
+  return alpha, normal
@@ -0,0 +1,312 @@
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+import pymunk
+import pymunk.batch
+
+
+# One row per registry slot: the handle living there (so a reused slot can't
+# be mistaken for its old object), then the body state.
+FIELDS = ('handle', 'x', 'y', 'angle', 'vx', 'vy', 'angular_velocity')
+HEADER = 3  # int64s: front buffer, buffer being read (-1 for none), steps published
+
+
+class SharedTransforms:
+  """Double buffered body transforms in shared memory, written by the physics
+  worker and read by the game without copying.
+
+  The worker fills the back buffer and then flips `front` to it. The reader
+  marks the front buffer as being read while it looks, and the worker skips
+  publishing a step rather than scribble over a buffer that's being read.
+  """
+
+  def __init__(self, capacity, lock, name=None):
+    self.capacity = capacity
+    self.lock = lock
+    size = HEADER * 8 + 2 * capacity * len(FIELDS) * 8
+    if name is None:
+      self.shm = shared_memory.SharedMemory(create=True, size=size)
+    else:
+      self.shm = shared_memory.SharedMemory(name=name)
+    self.owner = name is None
+    self.header = np.ndarray((HEADER,), dtype=np.int64, buffer=self.shm.buf)
+    self.buffers = np.ndarray(
+        (2, capacity, len(FIELDS)), dtype=np.float64, buffer=self.shm.buf, offset=HEADER * 8)
+    if self.owner:
+      self.header[:] = (0, -1, 0)
+      self.buffers[:, :, 0] = -1  # No handle is negative
+
+  @property
+  def name(self):
+    return self.shm.name
+
+  def begin_read(self):
+    """The front buffer and how many steps it's had, until end_read()."""
+    with self.lock:
+      front = int(self.header[0])
+      self.header[1] = front
+      steps = int(self.header[2])
+    return self.buffers[front], steps
+
+  def end_read(self):
+    with self.lock:
+      self.header[1] = -1
+
+  def back_buffer(self):
+    """The buffer to write the next step into, None if it's being read."""
+    with self.lock:
+      back = 1 - int(self.header[0])
+      if self.header[1] == back:
+        return None
+    return back
+
+  def publish(self, back, steps):
+    with self.lock:
+      self.header[0] = back
+      self.header[2] = steps
+
+  def close(self):
+    # Views into the buffer have to go before it can be closed.
+    self.header = self.buffers = None
+    self.shm.close()
+    if self.owner:
+      self.shm.unlink()
+
+
+def shape_spec(shape):
+  """What the worker needs to build a copy of a pymunk shape."""
+  if isinstance(shape, pymunk.Circle):
+    geometry = ('circle', shape.radius, tuple(shape.offset))
+  elif isinstance(shape, pymunk.Segment):
+    geometry = ('segment', tuple(shape.a), tuple(shape.b), shape.radius)
+  else:
+    geometry = ('poly', [tuple(v) for v in shape.get_vertices()], shape.radius)
+  filter = shape.filter
+  return {
+      'geometry': geometry,
+      'elasticity': shape.elasticity,
+      'friction': shape.friction,
+      'collision_type': shape.collision_type,
+      'filter': (filter.group, filter.categories, filter.mask),
+      'sensor': shape.sensor,
+  }
+
+
+def body_spec(obj):
+  """What the worker needs to build a copy of obj's body and shapes."""
+  body = obj.body
+  dynamic = body.body_type == pymunk.Body.DYNAMIC
+  return {
+      'body_type': body.body_type,
+      'mass': body.mass if dynamic else 0,
+      'moment': body.moment if dynamic else 0,
+      'position': tuple(body.position),
+      'angle': body.angle,
+      'velocity': tuple(body.velocity),
+      'angular_velocity': body.angular_velocity,
+      'shapes': [shape_spec(shape) for shape in obj.shapes.values()],
+  }
+
+
+def _build(spec):
+  body = pymunk.Body(body_type=spec['body_type'])
+  if spec['body_type'] == pymunk.Body.DYNAMIC:
+    body.mass = spec['mass']
+    body.moment = spec['moment']
+  body.position = spec['position']
+  body.angle = spec['angle']
+  body.velocity = spec['velocity']
+  body.angular_velocity = spec['angular_velocity']
+
+  shapes = []
+  for shape_info in spec['shapes']:
+    kind, *geometry = shape_info['geometry']
+    if kind == 'circle':
+      radius, offset = geometry
+      shape = pymunk.Circle(body, radius, offset)
+    elif kind == 'segment':
+      a, b, radius = geometry
+      shape = pymunk.Segment(body, a, b, radius)
+    else:
+      vertices, radius = geometry
+      shape = pymunk.Poly(body, vertices, radius=radius)
+    shape.elasticity = shape_info['elasticity']
+    shape.friction = shape_info['friction']
+    shape.collision_type = shape_info['collision_type']
+    shape.filter = pymunk.ShapeFilter(*shape_info['filter'])
+    shape.sensor = shape_info['sensor']
+    shapes.append(shape)
+  return body, shapes
+
+
+class Worker:
+  """The physics world on the other side of WorkerPhysics: a plain pymunk
+  space, stepped when the game says so. Commands come in over a pipe, a
+  list of them at a time, each step's contacts go back on a queue, and body
+  state goes out through SharedTransforms.
+  """
+
+  def __init__(self, transforms, commands, results, settings, handled_pairs):
+    self.transforms = transforms
+    self.commands = commands
+    self.results = results
+    threads = settings.get('threads') or 1
+    self.space = pymunk.Space(threaded=threads > 1)
+    self.space.gravity = settings['gravity']
+    for name in ('iterations', 'collision_slop', 'sleep_time_threshold', 'idle_speed_threshold', 'threads'):
+      if settings.get(name) is not None:
+        setattr(self.space, name, settings[name])
+    if settings.get('spatial_hash') is not None:
+      self.space.use_spatial_hash(*settings['spatial_hash'])
+    self.wrap_bounds = None
+
+    self.bodies = {}  # handle -> (body, shapes)
+    self.body_table = None  # (sorted body ids, handles), rebuilt after adds/removes
+    self.buffer = pymunk.batch.Buffer()
+    self.steps = 0
+    self.events = []
+
+    for a, b in handled_pairs:
+      handler = self.space.add_collision_handler(a, b)
+      handler.begin = self._recorder('begin')
+      handler.post_solve = self._recorder('post_solve')
+      handler.separate = self._recorder('separate')
+
+  def _recorder(self, phase):
+    events = self.events
+
+    def record(arbiter, space, data):
+      shape_a, shape_b = arbiter.shapes
+      normal = arbiter.normal
+      impulse = arbiter.total_impulse if phase == 'post_solve' else (0.0, 0.0)
+      events.append((
+          phase, shape_a.handle, shape_b.handle, normal.x, normal.y, impulse[0], impulse[1],
+          arbiter.total_ke if phase == 'post_solve' else 0.0, arbiter.is_first_contact))
+      return True
+
+    return record
+
+  def run(self):
+    while True:
+      for command, *args in self.commands.recv():
+        if command == 'stop':
+          return
+        getattr(self, command)(*args)
+
+  def add(self, handle, spec):
+    body, shapes = _build(spec)
+    for shape in shapes:
+      shape.handle = handle
+    self.space.add(body, *shapes)
+    self.bodies[handle] = (body, shapes)
+    self.body_table = None
+
+  def remove(self, handle):
+    body, shapes = self.bodies.pop(handle)
+    self.space.remove(body, *shapes)
+    self.body_table = None
+
+  def nudge(self, handle, velocity, angular_velocity):
+    """Add to a body's velocity, which is how game side changes (impulses,
+    driving kinematic bodies) get here without undoing our last few steps."""
+    body = self.bodies[handle][0]
+    if body.body_type == pymunk.Body.STATIC:
+      return
+    body.velocity += velocity
+    body.angular_velocity += angular_velocity
+    if body.body_type == pymunk.Body.DYNAMIC:
+      body.activate()
+
+  def place(self, handle, position, angle):
+    body, shapes = self.bodies[handle]
+    body.position = position
+    body.angle = angle
+    self.space.reindex_shapes_for_body(body)
+
+  def set_body_type(self, handle, body_type, mass, moment):
+    body, shapes = self.bodies[handle]
+    self.space.remove(body, *shapes)  # Same as PymunkPhysics.set_body_type()
+    body.body_type = body_type
+    if body_type == pymunk.Body.DYNAMIC:
+      body.mass, body.moment = mass, moment
+      body.velocity = (0, 0)
+      body.angular_velocity = 0
+    self.space.add(body, *shapes)
+    self.body_table = None
+
+  def gravity(self, gravity):
+    self.space.gravity = gravity
+    if self.space.sleep_time_threshold != float('inf'):
+      for body in self.space.bodies:
+        if body.body_type == pymunk.Body.DYNAMIC:
+          body.activate()
+
+  def wrap(self, bounds):
+    self.wrap_bounds = bounds
+
+  def step(self, dt):
+    self.space.step(dt)
+    if self.wrap_bounds:
+      self._wrap()
+    self.steps += 1
+    self._publish()
+    events = list(self.events)
+    self.events.clear()
+    self.results.put((self.steps, events))
+
+  def _wrap(self):
+    left, bottom, right, top = self.wrap_bounds
+    for body, shapes in self.bodies.values():
+      if body.body_type == pymunk.Body.STATIC:
+        continue
+      x, y = body.position
+      if not (left <= x < right and bottom <= y < top):
+        body.position = (left + (x - left) % (right - left), bottom + (y - bottom) % (top - bottom))
+        self.space.reindex_shapes_for_body(body)
+
+  def _publish(self):
+    back = self.transforms.back_buffer()
+    if back is None:
+      return  # The game is still looking at it, it gets the next step instead
+
+    fields = pymunk.batch.BodyFields
+    self.buffer.clear()
+    pymunk.batch.get_space_bodies(
+        self.space,
+        fields.BODY_ID | fields.POSITION | fields.ANGLE | fields.VELOCITY | fields.ANGULAR_VELOCITY,
+        self.buffer)
+    ids = np.frombuffer(self.buffer.int_buf(), dtype=np.uintp)
+    state = np.frombuffer(self.buffer.float_buf(), dtype=np.float64).reshape(-1, 6)
+
+    if self.body_table is None:
+      pairs = sorted((body.id, handle) for handle, (body, _) in self.bodies.items())
+      self.body_table = (
+          np.array([body_id for body_id, _ in pairs], dtype=np.uintp),
+          np.array([handle for _, handle in pairs], dtype=np.int64))
+    table_ids, table_handles = self.body_table
+    # searchsorted gives the spot a body would go even if it isn't in the
+    # table (say, one added since the table was built), so check it's there.
+    index = np.searchsorted(table_ids, ids)
+    known = np.flatnonzero(index < len(table_ids))
+    known = known[table_ids[index[known]] == ids[known]]
+    handles = table_handles[index[known]]
+    state = state[known]
+    slots = handles & 0xFFFFFFFF  # registry.ObjectRegistry.SLOT_MASK
+
+    rows = self.transforms.buffers[back]
+    rows[slots, 0] = handles
+    rows[slots, 1:] = state
+    self.transforms.publish(back, self.steps)
+
+
+def run(name, capacity, lock, commands, results, settings, handled_pairs):
+  """Entry point of the worker process."""
+  transforms = SharedTransforms(capacity, lock, name=name)
+  try:
+    Worker(transforms, commands, results, settings, handled_pairs).run()
+  except Exception:
+    logging.exception('Physics worker died')
+    results.put(None)
+  finally:
+    transforms.close()